@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+from typing import Literal
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from ...db.vector_db import VECTOR_SHARDS
+from ...deps import get_admin_user
+from ...models.open_ai.scheduler import scheduler
+from ...services.reindex import REINDEX_RATE, ReindexJob, ReindexRunning, get_status
+from ...utils import profiler
+from ...utils.tracing import in_background
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(dependencies=[Depends(get_admin_user)])
+
+
+@router.get("/scheduler")
+async def scheduler_stats():
+    """Queue depth and queue wait times of the LLM scheduler per priority class."""
+    return scheduler.stats()
+
+
+@router.get("/profile")
+async def profile(
+    seconds: float = Query(10, gt=0, le=profiler.PROFILE_MAX_SECONDS),
+    interval_ms: float = Query(5, ge=1, le=1000),
+    format: Literal["collapsed", "speedscope"] = "collapsed",
+    tasks: bool = True,
+):
+    """
+    Profile the worker serving this request for the given number of seconds and
+    return the samples as collapsed stacks, for flamegraph.pl or speedscope, or
+    as speedscope JSON. With tasks the await chain of every asyncio task is
+    sampled too, which shows where handlers like analyze_appointment and
+    query_data are suspended, not only what is running on a thread.
+    """
+    loop = asyncio.get_running_loop() if tasks else None
+    logger.info(f"Profiling worker for {seconds}s every {interval_ms}ms")
+    try:
+        result = await asyncio.to_thread(
+            profiler.sample, seconds, interval_ms / 1000, loop
+        )
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    name = f"wilson-{time.strftime('%Y%m%d-%H%M%S')}"
+    if format == "speedscope":
+        return JSONResponse(
+            result.speedscope(name),
+            headers={"Content-Disposition": f"attachment; filename={name}.json"},
+        )
+    return PlainTextResponse(
+        result.collapsed(),
+        headers={"Content-Disposition": f"attachment; filename={name}.folded"},
+    )
+
+
+@router.post("/reindex")
+async def start_reindex(
+    background_tasks: BackgroundTasks,
+    backend: Literal["openai", "onnx"] = "openai",
+    shards: int = Query(VECTOR_SHARDS, ge=1),
+    rate: float = Query(REINDEX_RATE, gt=0),
+    flip: bool = True,
+):
+    """
+    Re-index the vector store into a new collection version embedded with
+    backend and split into shards, at most rate chunks per second, and flip the
+    alias when done.
+    """
+    job = ReindexJob(backend=backend, shards=shards, rate=rate, flip=flip)
+    try:
+        await job.acquire()
+    except ReindexRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    background_tasks.add_task(in_background(job.run, "reindex"))
+    return job.status()
+
+
+@router.get("/reindex")
+async def reindex_status():
+    """Progress of the last re-index, started by any worker."""
+    status = await get_status()
+    if status is None:
+        raise HTTPException(status_code=404, detail="No re-index has been started")
+    return status
@@ -1,9 +1,12 @@
+import asyncio
+import io
 import json
 import logging
 import os
+import re
 import time
 from pprint import pprint
-from typing import Type
+from typing import Any, List, Type
 from uuid import uuid4
 
 import aioredis
@@ -12,7 +15,7 @@ from dotenv import load_dotenv
 from fastapi import APIRouter, BackgroundTasks, File, Header, HTTPException, UploadFile
 from fastapi.responses import JSONResponse
 from llama_index.core import SimpleDirectoryReader
-from llama_index.readers.s3 import S3Reader
+from llama_index.core.schema import Document
 from openai import AsyncOpenAI, OpenAI
 from psycopg2.extensions import connection
 from pydantic import BaseModel, Field
@@ -28,7 +31,16 @@ from ...db.relational_db import (
 from ...db.vector_db import load_documents
 from ...deps import get_current_user
 from ...models.open_ai import prompts as oai_prompts
-from ...models.open_ai.utils import OAIRequest, a_send_rqt
+from ...models.open_ai.prompt_budget import (
+    DEFAULT_TOKEN_BUDGET,
+    EXTRACTOR_TOKEN_BUDGETS,
+    count_tokens,
+    pack_context,
+    split_into_chunks,
+    strip_boilerplate,
+)
+from ...models.open_ai.scheduler import Priority, scheduler
+from ...models.open_ai.utils import OAIRequest, create_client
 from ...pydantic_models.pyd_models import (
     AppointmentMeta,
     ApptRqt,
@@ -37,6 +49,14 @@ from ...pydantic_models.pyd_models import (
     Summary,
     specialties,
 )
+from ...services.pdf_extraction import (
+    PDFTimeoutError,
+    PDFTooLargeError,
+    pdf_extractor,
+)
+from ...services.timeline import refresh_timeline
+from ...utils.metrics import external_call, record_cache, timer
+from ...utils.tracing import in_background
 from ...utils.utils import create_hash_id
 
 load_dotenv()
@@ -47,17 +67,44 @@ AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+# set to point at an s3 compatible store such as minio, e.g. for load tests
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+ANALYSIS_DEADLINE = float(os.getenv("ANALYSIS_DEADLINE", 45))
+
+# extractors that need the whole document, the metadata is in its header
+CONTENT_EXTRACTORS = ("Perscriptions", "FollowUps", "Summary")
+# documents that would be cut to fit the smallest budget of a content extractor
+# are extracted chunk by chunk, and every chunk fits all of their budgets
+_SMALLEST_CONTENT_BUDGET = min(
+    EXTRACTOR_TOKEN_BUDGETS.get(name, DEFAULT_TOKEN_BUDGET)
+    for name in CONTENT_EXTRACTORS
+)
+MAP_REDUCE_THRESHOLD = min(
+    int(os.getenv("MAP_REDUCE_THRESHOLD", _SMALLEST_CONTENT_BUDGET)),
+    _SMALLEST_CONTENT_BUDGET,
+)
+MAP_REDUCE_CHUNK_TOKENS = min(
+    int(os.getenv("MAP_REDUCE_CHUNK_TOKENS", MAP_REDUCE_THRESHOLD)),
+    _SMALLEST_CONTENT_BUDGET,
+)
+
+# extracted page text is keyed by the s3 uri of the upload
+PAGES_KEY = "pages:{}"
+PAGES_EXPIRE = 60 * 60 * 24
 
+# stored with every chunk in the vector db, structure_context needs the provider
+# name and appointment datetime to label the context it hands to the LLM
 METADATA_PARAMS = [
     "user_id",
     "provider_id",
+    "provider_name",
     "filename",
-    "appointment_date",
+    "appointment_datetime",
 ]
 
-client = AsyncOpenAI()
+client = create_client()
 redis = aioredis.from_url(REDIS_URL)
 mongo_db_client = MongoClient(MONGODB_URL)
 
@@ -70,14 +117,31 @@ s3_client = boto3.client(
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
     region_name=AWS_REGION,
+    endpoint_url=S3_ENDPOINT_URL,
 )
 
 
 class AppointmentAnalysis:
 
-    def __init__(self, client: OpenAI | AsyncOpenAI, context: str):
+    def __init__(
+        self,
+        client: OpenAI | AsyncOpenAI,
+        pages: List[str],
+        user_id: int | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        deadline: float | None = ANALYSIS_DEADLINE,
+    ):
         self._client = client
-        self.context = context
+        self.pages = strip_boilerplate(pages)
+        self.user_id = user_id
+        self.priority = priority
+        self.deadline = deadline
+        self.missing: list[str] = []
+
+    def document(self, extractor: str) -> str:
+        """The document text packed into the token budget of an extractor."""
+        budget = EXTRACTOR_TOKEN_BUDGETS.get(extractor, DEFAULT_TOKEN_BUDGET)
+        return pack_context(self.pages, budget)
 
     @property
     def perscriptions_rqt(self) -> OAIRequest:
@@ -86,7 +150,9 @@ class AppointmentAnalysis:
             oai_prompts.PERSCRIPTION_SYS_MSG,
             Perscriptions.model_json_schema(),
         )
-        user_msg = oai_prompts.PERSCRIPTION_USER_MSG.format(self.context)
+        user_msg = oai_prompts.PERSCRIPTION_USER_MSG.format(
+            self.document("Perscriptions")
+        )
         response_schema = Perscriptions
         return OAIRequest(
             system_msg=system_msg, user_msg=user_msg, response_schema=response_schema
@@ -99,7 +165,9 @@ class AppointmentAnalysis:
             oai_prompts.METADATA_SYS_MSG.format(", ".join(specialties.keys())),
             AppointmentMeta.model_json_schema(),
         )
-        user_msg = oai_prompts.METADATA_USER_MSG.format(self.context)
+        user_msg = oai_prompts.METADATA_USER_MSG.format(
+            self.document("AppointmentMeta")
+        )
         response_schema = AppointmentMeta
         return OAIRequest(
             system_msg=system_msg, user_msg=user_msg, response_schema=response_schema
@@ -111,7 +179,7 @@ class AppointmentAnalysis:
         system_msg = oai_prompts.build_system_msg(
             oai_prompts.FOLLOWUP_SYS_MSG, FollowUps.model_json_schema()
         )
-        user_msg = oai_prompts.FOLLOWUP_USER_MSG.format(self.context)
+        user_msg = oai_prompts.FOLLOWUP_USER_MSG.format(self.document("FollowUps"))
         response_schema = FollowUps
         return OAIRequest(
             system_msg=system_msg, user_msg=user_msg, response_schema=response_schema
@@ -123,43 +191,303 @@ class AppointmentAnalysis:
         system_msg = oai_prompts.build_system_msg(
             oai_prompts.SUMMARY_SYS_MSG, Summary.model_json_schema()
         )
-        user_msg = oai_prompts.SUMMARY_USER_MSG.format(self.context)
+        user_msg = oai_prompts.SUMMARY_USER_MSG.format(self.document("Summary"))
         response_schema = Summary
         return OAIRequest(
             system_msg=system_msg, user_msg=user_msg, response_schema=response_schema
         )
 
     async def a_get_info(self) -> dict[str, Type[BaseModel]]:
-        """Async function to extract info from a given document using the OpenAI API."""
+        """
+        Async function to extract info from a given document using the OpenAI API.
+        Sections that fail or are not ready by the deadline are left out of the
+        response and their names are recorded in self.missing. Documents over
+        MAP_REDUCE_THRESHOLD tokens are extracted chunk by chunk.
+        """
+        if count_tokens("\n\n".join(self.pages)) > MAP_REDUCE_THRESHOLD:
+            return await self.a_get_info_map_reduce()
+
         rqts = [
             self.perscriptions_rqt,
             self.metadata_rqt,
             self.followups_rqt,
             self.summary_rqt,
         ]
+        responses = await self._send_all(
+            {rqt.response_schema.__name__: rqt for rqt in rqts}, self.deadline
+        )
+        self.missing = [
+            rqt.response_schema.__name__
+            for rqt in rqts
+            if rqt.response_schema.__name__ not in responses
+        ]
+        return responses
+
+    async def a_get_info_map_reduce(self) -> dict[str, Type[BaseModel]]:
+        """
+        Extract info from a long document by splitting it into token bounded
+        chunks and running the prescription, follow up and summary extractors
+        over every chunk concurrently. Drugs and follow up tasks are merged in
+        document order and the chunk summaries are summarized once more. The
+        metadata is taken from the start of the document as usual.
+        """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        chunks = split_into_chunks(self.pages, MAP_REDUCE_CHUNK_TOKENS)
+        logger.info(f"Running map reduce extraction over {len(chunks)} chunks")
+
+        rqts = {("AppointmentMeta", 0): self.metadata_rqt}
+        for i, chunk in enumerate(chunks):
+            chunk_analysis = AppointmentAnalysis(self._client, [chunk])
+            rqts[("Perscriptions", i)] = chunk_analysis.perscriptions_rqt
+            rqts[("FollowUps", i)] = chunk_analysis.followups_rqt
+            rqts[("Summary", i)] = chunk_analysis.summary_rqt
+        chunk_responses = await self._send_all(rqts, self.deadline)
+
+        # a section is only complete if every chunk of it was extracted
+        sections = {}
+        for name, i in rqts:
+            sections.setdefault(name, [])
+            if (name, i) in chunk_responses and sections[name] is not None:
+                sections[name].append(chunk_responses[(name, i)])
+            else:
+                sections[name] = None
+
+        responses = {}
+        if sections["AppointmentMeta"]:
+            responses["AppointmentMeta"] = sections["AppointmentMeta"][0]
+        if sections["Perscriptions"]:
+            responses["Perscriptions"] = merge_perscriptions(sections["Perscriptions"])
+        if sections["FollowUps"]:
+            responses["FollowUps"] = merge_followups(sections["FollowUps"])
+        if sections["Summary"]:
+            summaries = [response.summary for response in sections["Summary"]]
+            if len(summaries) == 1:
+                responses["Summary"] = sections["Summary"][0]
+            else:
+                remaining = None
+                if self.deadline is not None:
+                    remaining = max(self.deadline - (loop.time() - started), 0)
+                summary_rqt = AppointmentAnalysis(
+                    self._client, ["\n\n".join(summaries)]
+                ).summary_rqt
+                responses.update(
+                    await self._send_all({"Summary": summary_rqt}, remaining)
+                )
+
+        self.missing = [name for name in sections if name not in responses]
+        return responses
+
+    async def _send_all(
+        self, rqts: dict[Any, OAIRequest], deadline: float | None
+    ) -> dict[Any, Type[BaseModel]]:
+        """
+        Send requests concurrently and return the responses that succeed within
+        the deadline, keyed the same way as the requests.
+        """
+        tasks = {}
+        for key, rqt in rqts.items():
+            logger.debug(f"Sending rqt for {key}")
+            rqt.deadline = deadline
+            tasks[key] = asyncio.create_task(
+                scheduler.send(
+                    self._client, rqt, priority=self.priority, user_id=self.user_id
+                )
+            )
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=deadline)
+
         responses = {}
-        for rqt in rqts:
-            logger.debug(f"Sending rqt for {rqt.response_schema.__name__}")
-            response = await a_send_rqt(self._client, rqt)
-            responses[rqt.response_schema.__name__] = response
+        for key, task in tasks.items():
+            if task.done() and not task.cancelled() and task.exception() is None:
+                responses[key] = task.result()
+                continue
+
+            if task.done() and not task.cancelled():
+                logger.warning(f"Failed to extract {key} with {task.exception()!r}")
+            else:
+                logger.warning(f"Failed to extract {key} within {deadline}s")
+                task.cancel()
 
         return responses
 
 
+def _normalize_name(name: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", name).split()).casefold()
+
+
+def merge_perscriptions(results: List[Perscriptions]) -> Perscriptions:
+    """
+    Merge the drugs extracted from each chunk of a document. Drugs are deduped
+    by technical name, keeping the first mention and filling in instructions
+    from later mentions if the first had none.
+    """
+    drugs = {}
+    for result in results:
+        for drug in result.drugs:
+            key = _normalize_name(drug.technical_name)
+            if key not in drugs:
+                drugs[key] = drug.model_copy()
+            elif not drugs[key].instructions.strip() and drug.instructions.strip():
+                drugs[key].instructions = drug.instructions
+    return Perscriptions(drugs=list(drugs.values()))
+
+
+def merge_followups(results: List[FollowUps]) -> FollowUps:
+    """Merge the follow up tasks extracted from each chunk, dropping duplicates."""
+    tasks = {}
+    for result in results:
+        for task in result.tasks:
+            tasks.setdefault(_normalize_name(task.task), task)
+    return FollowUps(tasks=list(tasks.values()))
+
+
 async def cache_data(key: str, value: str, expire: int = 3600):
-    async with redis.client() as conn:
-        await conn.set(key, value, ex=expire)
+    with external_call("redis", "set"):
+        async with redis.client() as conn:
+            await conn.set(key, value, ex=expire)
 
 
 async def get_cached_data(key: str):
-    async with redis.client() as conn:
-        return await conn.get(key)
+    with external_call("redis", "get"):
+        async with redis.client() as conn:
+            return await conn.get(key)
+
+
+async def cache_pages(s3_uri: str, pages: List[str]) -> None:
+    """Store the extracted text of each page of an upload keyed by its s3 uri."""
+    await cache_data(PAGES_KEY.format(s3_uri), json.dumps(pages), expire=PAGES_EXPIRE)
+
+
+async def load_context(s3_uri: str) -> List[Document]:
+    """
+    Load the pages of an uploaded document. The text extracted at upload time is
+    used when available, otherwise we fall back to reading the file from s3.
+    """
+    cached_pages = await get_cached_data(PAGES_KEY.format(s3_uri))
+    record_cache("pages", cached_pages is not None)
+    if cached_pages:
+        logger.debug(f"Extracted text found for {s3_uri}")
+        return [
+            Document(text=text, metadata={"page_label": str(i + 1)})
+            for i, text in enumerate(json.loads(cached_pages))
+        ]
+
+    s3_key = s3_uri.split(f"s3://{S3_BUCKET_NAME}/")[1]
+    logger.debug(f"No extracted text found, reading data from key = {s3_key}")
+    with external_call("s3", "get_object"):
+        s3_object = await asyncio.to_thread(
+            s3_client.get_object, Bucket=S3_BUCKET_NAME, Key=s3_key
+        )
+        content = await asyncio.to_thread(s3_object["Body"].read)
+    with timer("pdf_extract"):
+        return [
+            Document(text=text, metadata={"page_label": str(page_number + 1)})
+            async for page_number, text in pdf_extractor.iter_pages(content)
+        ]
+
+
+async def get_appointment_info(
+    context: List[Document],
+    data_location: str,
+    user_id: int | None = None,
+    priority: Priority = Priority.INTERACTIVE,
+    deadline: float | None = ANALYSIS_DEADLINE,
+) -> dict[str, Any]:
+    """
+    Analyze a document, reusing the cached result if it was analyzed before.
+    If some sections could not be extracted in time, their names are listed
+    under the "missing" key and the partial result is not cached.
+    """
+    text = " ".join([doc.text for doc in context])
+
+    # check if response in redis cache first
+    cache_key = create_hash_id(text, {"filename": data_location})
+    encoded_info = await get_cached_data(cache_key)
+    info = json.loads(encoded_info) if encoded_info else None
+    record_cache("analysis", info is not None)
+
+    if not info:
+        logger.debug(f"Cache miss for {cache_key}")
+        pages = [doc.text for doc in context]
+        appt = AppointmentAnalysis(client, pages, user_id, priority, deadline)
+        with timer("llm_extraction"):
+            info = await appt.a_get_info()
+        info = {k: v.model_dump() for k, v in info.items()}  # make serializable
+        if appt.missing:
+            info["missing"] = appt.missing
+            return info
+
+        logger.debug(f"Caching info = {pprint(info)}")
+        await cache_data(cache_key, json.dumps(info))
+
+    return info
+
+
+async def resolve_provider(info: dict[str, Any]) -> tuple[dict[str, Any], bool]:
+    """
+    Find the NPI of the provider who wrote the note. Returns the provider info
+    along with whether the provider already exists in the db.
+    """
+    provider_info: dict[str, any] = info.get("AppointmentMeta", {}).get("provider_info")
+    with timer("provider_lookup"):
+        if not provider_info.get("npi"):
+            provider_info["npi"] = await get_provider_id(
+                provider_collection, provider_info
+            )
+        existing_record = get_provider_by_npi(provider_collection, provider_info["npi"])
+    return provider_info, existing_record is not None
+
+
+def build_params(
+    user_id: int,
+    data_location: str,
+    info: dict[str, Any],
+    provider_info: dict[str, Any],
+) -> dict[str, Any]:
+    """Build the params used for the relational and vector db inserts."""
+    return {
+        "user_id": user_id,
+        "provider_id": provider_info["npi"],  # this is going to be NPI
+        "provider_name": f"{provider_info['first_name']} {provider_info['last_name']}",
+        "filename": data_location,
+        "summary": info.get("Summary", {}).get("summary"),
+        "appointment_datetime": info.get("AppointmentMeta", {}).get("datetime"),
+        "follow_ups": json.dumps(info.get("FollowUps", {})),
+        "perscriptions": json.dumps(info.get("Perscriptions", {})),
+    }
+
+
+def format_analysis(
+    info: dict[str, Any], provider_info: dict[str, Any] | None
+) -> dict[str, Any]:
+    """
+    Format the analysis of a document for the front end. Sections that could
+    not be extracted are listed under "missing".
+    """
+    return_provider_info = None
+    if provider_info:
+        return_provider_info = {
+            "first_name": provider_info["first_name"],
+            "last_name": provider_info["last_name"],
+            "specialty": provider_info["specialty"],
+        }
+
+    follow_ups = info.get("FollowUps", {}).get("tasks", [])
+    return {
+        "prescriptions": info.get("Perscriptions", {}).get("drugs"),
+        "provider_info": return_provider_info,
+        "follow_ups": [task["task"] for task in follow_ups],
+        "summary": info.get("Summary", {}).get("summary"),
+        "missing": info.get("missing", []),
+    }
 
 
 def insert_vector_db(context, params: dict[str, any]):
     try:
         v_db_params = {k: v for k, v in params.items() if k in METADATA_PARAMS}
-        load_documents(context, v_db_params)
+        with timer("vector_upsert"):
+            load_documents(context, v_db_params)
         logger.info(f"Context loaded into vector db")
 
     except Exception as e:
@@ -172,12 +500,13 @@ def insert_vector_db(context, params: dict[str, any]):
 def insert_db(conn: connection, params: dict[str, any]):
     """All necessary relational db inserts are done here."""
     try:
-        appt_id = upsert_appointment(conn, params)[0]
-        logger.debug(f"Appointment inserted into db with id {appt_id}")
+        with timer("db_write"):
+            appt_id = upsert_appointment(conn, params)[0]
+            logger.debug(f"Appointment inserted into db with id {appt_id}")
 
-        params.update({"appointment_id": appt_id})
-        upsert_prescription(conn, params)
-        logger.debug(f"Prescriptions inserted into db")
+            params.update({"appointment_id": appt_id})
+            upsert_prescription(conn, params)
+            logger.debug(f"Prescriptions inserted into db")
 
     except Exception as e:
         raise HTTPException(
@@ -198,88 +527,71 @@ async def upload_pdf(file: UploadFile = File(...), x_user_id: str = Header(...))
             status_code=400, detail="Invalid file type. Please upload a PDF."
         )
     try:
+        pdf_extractor.check_size(file.size)
+    except PDFTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    try:
+        content = await file.read()
         file_key = f"{x_user_id}/pdf/{uuid4()}_{file.filename}"
         logger.debug(f"Uploading file to s3 with key {file_key}")
-        s3_client.upload_fileobj(
-            file.file,
-            S3_BUCKET_NAME,
-            file_key,
-            ExtraArgs={"ContentType": file.content_type},
-        )
+        with external_call("s3", "upload"):
+            s3_client.upload_fileobj(
+                io.BytesIO(content),
+                S3_BUCKET_NAME,
+                file_key,
+                ExtraArgs={"ContentType": file.content_type},
+            )
         s3_uri = f"s3://{S3_BUCKET_NAME}/{file_key}"
-        return {"s3_uri": s3_uri}
 
     except Exception as e:
         return JSONResponse(status_code=500, content={"message": str(e)})
 
+    # parse the pdf once here so /analyze does not need to read it back from s3
+    try:
+        with timer("pdf_extract"):
+            pages = await pdf_extractor.extract_pages(content)
+        await cache_pages(s3_uri, pages)
+    except Exception as e:
+        logger.warning(f"Failed to extract text for {s3_uri} with error {str(e)}")
 
-@router.post("/analyze")
-async def analyze_appointment(appt_rqt: ApptRqt, background_tasks: BackgroundTasks):
-    s3_key = appt_rqt.data_location.split(f"s3://{S3_BUCKET_NAME}/")[1]
-    logger.debug(f"Reading data from key = {s3_key}")
-
-    loader = S3Reader(
-        bucket=S3_BUCKET_NAME,
-        key=s3_key,
-        aws_access_id=AWS_ACCESS_KEY_ID,
-        aws_access_secret=AWS_SECRET_ACCESS_KEY,
-    )
-    context = loader.load_data()
-    text = " ".join([doc.text for doc in context])
+    return {"s3_uri": s3_uri}
 
-    # check if response in redis cache first
-    cache_key = create_hash_id(text, {"filename": appt_rqt.data_location})
-    encoded_info = await get_cached_data(cache_key)
-    info = json.loads(encoded_info) if encoded_info else None
-
-    if not info:
-        logger.debug(f"Cache miss for {cache_key}")
-        appt = AppointmentAnalysis(client, context)
-        info = await appt.a_get_info()
-        info = {k: v.model_dump() for k, v in info.items()}  # make serializable
-        logger.debug(f"Caching info = {pprint(info)}")
-        await cache_data(cache_key, json.dumps(info))
 
+@router.post("/analyze")
+async def analyze_appointment(appt_rqt: ApptRqt, background_tasks: BackgroundTasks):
+    try:
+        context = await load_context(appt_rqt.data_location)
+    except PDFTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except PDFTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    info = await get_appointment_info(context, appt_rqt.data_location, appt_rqt.user_id)
     logger.info(f"info = {pprint(info)}")
 
-    provider_info: dict[str, any] = info.get("AppointmentMeta", {}).get("provider_info")
-    if not provider_info.get("npi"):
-        provider_info["npi"] = await get_provider_id(provider_collection, provider_info)
-    else:
-        provider_info["npi"] = provider_info.get("npi")
+    if info.get("missing"):
+        # return what we have, the document is stored once a full analysis succeeds
+        logger.warning(f"Analysis incomplete, missing {info['missing']}")
+        provider_info = info.get("AppointmentMeta", {}).get("provider_info")
+        return format_analysis(info, provider_info)
 
-    existing_record = get_provider_by_npi(provider_collection, provider_info["npi"])
-    if not existing_record:
+    provider_info, provider_exists = await resolve_provider(info)
+    if not provider_exists:
         logger.info(f"Provider not found in db - inserting record")
-        background_tasks.add_task(upsert_provider, provider_collection, provider_info)
+        background_tasks.add_task(
+            in_background(upsert_provider), provider_collection, provider_info
+        )
 
     # by here we need to have information verified
-    params = {
-        "user_id": appt_rqt.user_id,
-        "provider_id": provider_info["npi"],  # this is going to be NPI
-        "filename": appt_rqt.data_location,
-        "summary": info.get("Summary", {}).get("summary"),
-        "appointment_datetime": info.get("AppointmentMeta", {}).get("datetime"),
-        "follow_ups": json.dumps(info.get("FollowUps", {})),
-        "perscriptions": json.dumps(info.get("Perscriptions", {})),
-    }
-
-    background_tasks.add_task(insert_db, conn, params)
-    background_tasks.add_task(insert_vector_db, context, params)
+    params = build_params(appt_rqt.user_id, appt_rqt.data_location, info, provider_info)
 
-    return_provider_info = {
-        "first_name": provider_info["first_name"],
-        "last_name": provider_info["last_name"],
-        "specialty": provider_info["specialty"],
-    }
+    background_tasks.add_task(in_background(insert_db), conn, params)
+    background_tasks.add_task(
+        in_background(refresh_timeline), conn, provider_collection, appt_rqt.user_id
+    )
+    background_tasks.add_task(in_background(insert_vector_db), context, params)
 
-    response = {
-        "prescriptions": info.get("Perscriptions", {}).get("drugs"),
-        "provider_info": return_provider_info,
-        "follow_ups": [task["task"] for task in info.get("FollowUps", {}).get("tasks")],
-        "summary": info.get("Summary", {}).get("summary"),
-    }
-    return response
+    return format_analysis(info, provider_info)
 
 
 @router.get("/{user_id}")
@@ -308,12 +620,10 @@ async def get_appointments(user_id: int):
 
 
 if __name__ == "__main__":
-    import asyncio
-
-    client = AsyncOpenAI()
+    client = create_client()
 
     context = SimpleDirectoryReader("../data").load_data()
-    appt = AppointmentAnalysis(client, context)
+    appt = AppointmentAnalysis(client, [doc.text for doc in context])
 
     logger.info("Starting timer")
     start_time = time.time()
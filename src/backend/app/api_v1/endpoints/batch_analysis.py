@@ -0,0 +1,321 @@
+"""
+Batch analysis of documents that have already been uploaded to s3. This is used
+to backfill the history of new users who arrive with many past visit notes.
+
+Run from the command line with e.g.
+    python -m app.api_v1.endpoints.batch_analysis --user-id 1 --prefix 1/pdf/
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Annotated, Any, Dict, List
+from uuid import uuid4
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+
+from ...db.nosql_db import upsert_provider
+from ...db.relational_db import create_connection
+from ...deps import get_current_user
+from ...models.open_ai.scheduler import Priority
+from ...pydantic_models.pyd_models import BatchRqt
+from ...services.timeline import refresh_timeline
+from ...utils.tracing import in_background
+from .appointments import (
+    S3_BUCKET_NAME,
+    build_params,
+    get_appointment_info,
+    insert_db,
+    insert_vector_db,
+    load_context,
+    provider_collection,
+    redis,
+    resolve_provider,
+    s3_client,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", 4))
+BATCH_DB_CONCURRENCY = int(os.getenv("BATCH_DB_CONCURRENCY", 2))
+BATCH_VECTOR_CONCURRENCY = int(os.getenv("BATCH_VECTOR_CONCURRENCY", 2))
+BATCH_EXPIRE = 60 * 60 * 24 * 7
+
+# the state of every document in a job and the job summary live in redis
+CHECKPOINT_KEY = "batch:{}:documents"
+STATUS_KEY = "batch:{}:status"
+PENDING = "pending"
+DONE = "done"
+
+
+def list_documents(user_id: int, prefix: str) -> List[str]:
+    """List the s3 uris of every document stored under a users prefix."""
+    if not prefix.startswith(f"{user_id}/"):
+        raise ValueError(f"Prefix {prefix} does not belong to user {user_id}")
+
+    uris = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=prefix):
+        for s3_object in page.get("Contents", []):
+            if not s3_object["Key"].endswith("/"):
+                uris.append(f"s3://{S3_BUCKET_NAME}/{s3_object['Key']}")
+    return uris
+
+
+async def get_status(job_id: str) -> Dict[str, Any] | None:
+    async with redis.client() as redis_conn:
+        status = await redis_conn.get(STATUS_KEY.format(job_id))
+    return json.loads(status) if status else None
+
+
+class JobNotFound(Exception):
+    """Raised when a job id belongs to another user."""
+
+
+class BatchAnalysis:
+    """
+    Analyze many documents for a single user. Each stage of the pipeline has its
+    own concurrency limit so a backfill cannot overwhelm the LLM, relational db
+    or vector db. The state of every document is checkpointed, so running a job
+    again with the same job id only processes documents that did not finish.
+
+    Parameters
+    ----------
+    user_id : int
+        The user the documents belong to
+    job_id : str | None
+        The id of a previous job to resume, a new id is created if not provided
+    llm_concurrency : int
+        Number of documents analyzed by the LLM at once
+    db_concurrency : int
+        Number of documents written to the relational db at once, each slot
+        holds its own connection
+    vector_concurrency : int
+        Number of documents written to the vector db at once
+    """
+
+    def __init__(
+        self,
+        user_id: int,
+        job_id: str | None = None,
+        llm_concurrency: int = BATCH_LLM_CONCURRENCY,
+        db_concurrency: int = BATCH_DB_CONCURRENCY,
+        vector_concurrency: int = BATCH_VECTOR_CONCURRENCY,
+    ):
+        self.user_id = user_id
+        self.job_id = job_id or str(uuid4())
+        self.llm_concurrency = llm_concurrency
+        self.db_concurrency = db_concurrency
+        self.vector_concurrency = vector_concurrency
+        self.status: Dict[str, Any] = {}
+
+    async def collect(
+        self, data_locations: List[str], prefix: str | None = None
+    ) -> List[str]:
+        """
+        Gather the documents for this job from explicit uris, an s3 prefix and
+        the checkpoint of a previous run with the same job id. Raises
+        JobNotFound if that job id was used by another user and ValueError for
+        documents outside the user's folder.
+        """
+        # the status records the owner of a job, a checkpoint without one
+        # can't be attributed to anyone and isn't resumed either
+        status = await get_status(self.job_id)
+        checkpoint = await self._load_checkpoint()
+        if (status or checkpoint) and (status or {}).get("user_id") != self.user_id:
+            raise JobNotFound(f"Batch job {self.job_id} not found.")
+
+        user_root = f"s3://{S3_BUCKET_NAME}/{self.user_id}/"
+        for uri in data_locations:
+            if not uri.startswith(user_root):
+                raise ValueError(f"{uri} does not belong to user {self.user_id}")
+
+        documents = list(data_locations)
+        if prefix:
+            documents += await asyncio.to_thread(list_documents, self.user_id, prefix)
+        documents += list(checkpoint)
+        return list(dict.fromkeys(documents))
+
+    async def run(self, data_locations: List[str]) -> Dict[str, Any]:
+        """Analyze every document that has not been completed by a previous run."""
+        checkpoint = await self._load_checkpoint()
+        remaining = [uri for uri in data_locations if checkpoint.get(uri) != DONE]
+        await self._checkpoint(
+            {uri: PENDING for uri in remaining if uri not in checkpoint}
+        )
+
+        self.status = {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "state": "running",
+            "total": len(data_locations),
+            "done": len(data_locations) - len(remaining),
+            "failed": 0,
+            "docs_per_minute": 0.0,
+        }
+        self._started = time.monotonic()
+        self._processed = 0
+        await self._report()
+
+        self._llm = asyncio.Semaphore(self.llm_concurrency)
+        self._vector = asyncio.Semaphore(self.vector_concurrency)
+        # psycopg2 connections can't interleave transactions, so each db slot
+        # owns a connection rather than sharing the module level one
+        self._connections = asyncio.Queue()
+        for _ in range(self.db_concurrency):
+            self._connections.put_nowait(await asyncio.to_thread(create_connection))
+
+        queue = asyncio.Queue()
+        for uri in remaining:
+            queue.put_nowait(uri)
+
+        # enough workers that every stage can be busy at the same time
+        n_workers = self.llm_concurrency + self.db_concurrency + self.vector_concurrency
+        try:
+            await asyncio.gather(*[self._worker(queue) for _ in range(n_workers)])
+        finally:
+            while not self._connections.empty():
+                self._connections.get_nowait().close()
+
+        self.status["state"] = "completed"
+        await self._report()
+        logger.info(
+            f"Batch {self.job_id} finished: {self.status['done']} done, "
+            f"{self.status['failed']} failed, "
+            f"{self.status['docs_per_minute']:.2f} documents per minute"
+        )
+        return self.status
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while not queue.empty():
+            uri = queue.get_nowait()
+            try:
+                await self._process(uri)
+            except Exception as e:
+                logger.error(f"Failed to analyze {uri} with error {str(e)}")
+                await self._checkpoint({uri: f"failed: {str(e)}"})
+                self.status["failed"] += 1
+            else:
+                await self._checkpoint({uri: DONE})
+                self.status["done"] += 1
+
+            self._processed += 1
+            await self._report()
+
+    async def _process(self, uri: str) -> None:
+        context = await load_context(uri)
+        async with self._llm:
+            # backfills have no one waiting on them, so no deadline
+            info = await get_appointment_info(
+                context, uri, self.user_id, Priority.BATCH, deadline=None
+            )
+        if info.get("missing"):
+            raise RuntimeError(f"Analysis incomplete, missing {info['missing']}")
+
+        conn = await self._connections.get()
+        try:
+            provider_info, provider_exists = await resolve_provider(info)
+            if not provider_exists:
+                await asyncio.to_thread(
+                    upsert_provider, provider_collection, provider_info
+                )
+            params = build_params(self.user_id, uri, info, provider_info)
+            await asyncio.to_thread(insert_db, conn, params)
+            await refresh_timeline(conn, provider_collection, self.user_id)
+        finally:
+            self._connections.put_nowait(conn)
+
+        async with self._vector:
+            await asyncio.to_thread(insert_vector_db, context, params)
+
+    async def _load_checkpoint(self) -> Dict[str, str]:
+        async with redis.client() as redis_conn:
+            checkpoint = await redis_conn.hgetall(CHECKPOINT_KEY.format(self.job_id))
+        return {k.decode(): v.decode() for k, v in checkpoint.items()}
+
+    async def _checkpoint(self, states: Dict[str, str]) -> None:
+        if not states:
+            return
+        key = CHECKPOINT_KEY.format(self.job_id)
+        async with redis.client() as redis_conn:
+            await redis_conn.hset(key, mapping=states)
+            await redis_conn.expire(key, BATCH_EXPIRE)
+
+    async def _report(self) -> None:
+        elapsed = time.monotonic() - self._started
+        if elapsed > 0:
+            self.status["docs_per_minute"] = self._processed / elapsed * 60
+        async with redis.client() as redis_conn:
+            await redis_conn.set(
+                STATUS_KEY.format(self.job_id),
+                json.dumps(self.status),
+                ex=BATCH_EXPIRE,
+            )
+
+
+router = APIRouter()
+
+
+@router.post("/")
+async def batch_analyze(
+    batch_rqt: BatchRqt,
+    background_tasks: BackgroundTasks,
+    user: Annotated[dict, Depends(get_current_user)],
+):
+    # documents are only ever analyzed for the user the token belongs to
+    job = BatchAnalysis(user["id"], batch_rqt.job_id)
+    try:
+        data_locations = await job.collect(batch_rqt.data_locations, batch_rqt.prefix)
+    except JobNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if not data_locations:
+        raise HTTPException(status_code=400, detail="No documents found to analyze.")
+
+    background_tasks.add_task(in_background(job.run, "batch"), data_locations)
+    return {"job_id": job.job_id, "documents": len(data_locations)}
+
+
+@router.get("/{job_id}")
+async def batch_status(job_id: str, user: Annotated[dict, Depends(get_current_user)]):
+    status = await get_status(job_id)
+    # other users' jobs are reported as missing so their ids can't be probed
+    if not status or status.get("user_id") != user["id"]:
+        raise HTTPException(status_code=404, detail=f"Batch job {job_id} not found.")
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Analyze a backlog of uploaded documents for a user."
+    )
+    parser.add_argument("--user-id", type=int, required=True)
+    parser.add_argument("--prefix", help="s3 key prefix e.g. 1/pdf/")
+    parser.add_argument("--uris", nargs="*", default=[], help="s3 uris to analyze")
+    parser.add_argument("--job-id", help="id of a previous job to resume")
+    parser.add_argument("--llm-concurrency", type=int, default=BATCH_LLM_CONCURRENCY)
+    parser.add_argument("--db-concurrency", type=int, default=BATCH_DB_CONCURRENCY)
+    parser.add_argument(
+        "--vector-concurrency", type=int, default=BATCH_VECTOR_CONCURRENCY
+    )
+    args = parser.parse_args()
+
+    async def main():
+        job = BatchAnalysis(
+            args.user_id,
+            args.job_id,
+            llm_concurrency=args.llm_concurrency,
+            db_concurrency=args.db_concurrency,
+            vector_concurrency=args.vector_concurrency,
+        )
+        data_locations = await job.collect(args.uris, args.prefix)
+        logger.info(f"Starting batch {job.job_id} with {len(data_locations)} documents")
+        status = await job.run(data_locations)
+        print(json.dumps(status, indent=2))
+
+    asyncio.run(main())
@@ -1,60 +1,143 @@
-import io
+import asyncio
 import logging
+import os
+from datetime import date, datetime, time
 
-import chromadb
-from fastapi import APIRouter, File, Header, HTTPException, UploadFile
-from openai import AsyncOpenAI
+from fastapi import APIRouter, BackgroundTasks, File, Header, HTTPException, UploadFile
 from pydantic import BaseModel, Field
-from PyPDF2 import PdfReader
 
 from ...db.vector_db import (
-    COLLECTION,
-    DB_PATH,
-    EMBED_MODEL,
+    CONTEXT_CHUNKS,
+    answer_cache,
     get_context,
     structure_context,
 )
 from ...deps import get_current_user
-from ...models.open_ai.utils import OAIRequest, a_send_rqt
+from ...models.open_ai.scheduler import scheduler
+from ...models.open_ai.utils import OAIRequest, create_client
+from ...services.pdf_extraction import PDFTimeoutError, PDFTooLargeError, pdf_extractor
+from ...services.timeline import get_timeline
+from ...utils.metrics import timer
+from ...utils.tracing import in_background
+from .appointments import conn, provider_collection
 
 logger = logging.getLogger(__name__)
 
+# the timeline answers questions about visits, medications and follow ups, so
+# fewer chunks of note text are used next to it. Without a timeline all
+# CONTEXT_CHUNKS are.
+TIMELINE_CONTEXT_CHUNKS = int(os.getenv("TIMELINE_CONTEXT_CHUNKS", 4))
+
 CHAT_W_DATA_SYS_MSG = """You are a word class medical physician who is also an expert in Q&A and you will assist in analyzing this patient's medical records
 and responding to their questions to the best of your ability. For each query, you will be provided with the most relevant context
 from the patients medical records. Additionally, piece of context will have information about the date of the appointment and the provider's name.
 Please do not start talking about the users appointment data unless they ask questions about it or require the 
 context of their appointments."""
 
-CHAT_W_DATA_USER_MSG = """Based on the following context, please answer the 
+CHAT_W_DATA_USER_MSG = """Based on the following timeline and context, please answer the 
 query to the best of your ability. 
+The timeline lists the patient's visits, providers, active prescriptions and follow ups, prefer it for questions about those.
 Please note that the context will contain metadata about the date of the appointment and the provider's name.
 If the provider name and date are the same, you can assume it is from the same appointment. 
 Query: {}
+Timeline:
+{}
 Context: {}
 """
 
 
 class QueryRqt(BaseModel):
     query: str = Field(..., description="Query to be executed on the data")
+    provider_name: str | None = Field(
+        None, description="Only use records from this provider"
+    )
+    date_from: date | None = Field(
+        None, description="Only use appointments on or after this date"
+    )
+    date_to: date | None = Field(
+        None, description="Only use appointments on or before this date"
+    )
 
 
 # TODO: add back in auth when we figure out auth in the front end.
 router = APIRouter()
-client = AsyncOpenAI()
-db = chromadb.PersistentClient(path=DB_PATH)
-collection = db.get_or_create_collection(COLLECTION, embedding_function=EMBED_MODEL)
+client = create_client()
+
+
+def _timestamp(day: date | None, at: time) -> int | None:
+    return int(datetime.combine(day, at).timestamp()) if day else None
+
+
+async def load_timeline(user_id: int) -> str:
+    """The timeline of a user, empty if it can't be loaded."""
+    try:
+        with timer("timeline"):
+            return await get_timeline(conn, provider_collection, user_id)
+    except Exception as e:
+        logger.warning(f"Failed to load the timeline of user {user_id}: {e}")
+        return ""
 
 
 @router.post("/{user_id}")
-async def query_data(user_id: int, query_rqt: QueryRqt):
+async def query_data(
+    user_id: int, query_rqt: QueryRqt, background_tasks: BackgroundTasks
+):
     logger.info(f"Querying data for user {user_id} with query: {query_rqt.query}")
-    context = get_context(query_rqt.query, user_id, collection)
-    structured_context = structure_context(context)
+    filters = query_rqt.model_dump(exclude={"query"})
+    embedding = None
+    if answer_cache is not None:
+        try:
+            with timer("answer_cache"):
+                # the embedding is cached, retrieval below doesn't embed again
+                embedding = await asyncio.to_thread(answer_cache.embed, query_rqt.query)
+                cached = await asyncio.to_thread(
+                    answer_cache.get, query_rqt.query, embedding, user_id, filters
+                )
+            if cached is not None:
+                return cached
+        except Exception as e:
+            logger.warning(f"Answer cache lookup failed, answering anyway: {e}")
+
+    retrieved_at = datetime.now().timestamp()
+    timeline = asyncio.create_task(load_timeline(user_id))
+    with timer("vector_query"):
+        # embedding the query and the chroma query are both blocking calls.
+        # retrieval runs alongside loading the timeline, so enough chunks are
+        # fetched for a missing timeline and cut down once it has loaded
+        context = await asyncio.to_thread(
+            get_context,
+            query_rqt.query,
+            user_id,
+            n_results=max(CONTEXT_CHUNKS, TIMELINE_CONTEXT_CHUNKS),
+            provider_name=query_rqt.provider_name,
+            date_from=_timestamp(query_rqt.date_from, time.min),
+            date_to=_timestamp(query_rqt.date_to, time.max),
+        )
+    timeline = await timeline
+    if timeline:
+        context = {
+            key: [values[0][:TIMELINE_CONTEXT_CHUNKS]]
+            for key, values in context.items()
+        }
+    with timer("context_assembly"):
+        structured_context = structure_context(context)
     rqt = OAIRequest(
         system_msg=CHAT_W_DATA_SYS_MSG,
-        user_msg=CHAT_W_DATA_USER_MSG.format(query_rqt.query, structured_context),
+        user_msg=CHAT_W_DATA_USER_MSG.format(
+            query_rqt.query, timeline or "Not available", structured_context
+        ),
     )
-    response = await a_send_rqt(client, rqt, response_json=False)
+    response = await scheduler.send(client, rqt, user_id=user_id, response_json=False)
+    if embedding is not None and response:
+        background_tasks.add_task(
+            in_background(answer_cache.put, "answer_cache_put"),
+            query_rqt.query,
+            embedding,
+            user_id,
+            filters,
+            response,
+            retrieved_at,
+        )
     return response
 
 
@@ -64,11 +147,15 @@ async def upload_pdf(file: UploadFile = File(...), x_user_id: str = Header(...))
         raise HTTPException(
             status_code=400, detail="Invalid file type. Please upload a PDF."
         )
-    content = await file.read()
-    file_ = io.BytesIO(content)
-    pdf_reader = PdfReader(file_)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-
-    return {"filename": file.filename, "user_id": x_user_id}
+    try:
+        pdf_extractor.check_size(file.size)
+        content = await file.read()
+        n_pages = 0
+        async for _ in pdf_extractor.iter_pages(content):
+            n_pages += 1
+    except PDFTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except PDFTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+    return {"filename": file.filename, "user_id": x_user_id, "pages": n_pages}
@@ -13,13 +13,15 @@ from pymongo.collection import Collection
 
 from ...db.nosql_db import get_relevant_providers
 from ...deps import get_current_user
-from ...models.open_ai.utils import OAIRequest, a_send_rqt
+from ...models.open_ai.scheduler import scheduler
+from ...models.open_ai.utils import OAIRequest, create_client
 from ...pydantic_models.pyd_models import FollowUpRqt, TaskSpecialty, specialties
 from .appointments import FollowUps
 
 logger = logging.getLogger(__name__)
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+FOLLOWUP_DEADLINE = float(os.getenv("FOLLOWUP_DEADLINE", 20))
 
 SYSTEM_MSG = """
 You are an expert medical assistant and are helping us match physician follow up tasks
@@ -50,6 +52,7 @@ async def get_followup_suggestions(
     collection: Collection,
     patient_info: Dict[str, Any],
     tasks: FollowUps,
+    deadline: float | None = FOLLOWUP_DEADLINE,
 ) -> list[Any]:
     """
     Get follow up suggestions for the patient based on the tasks assigned
@@ -64,17 +67,23 @@ async def get_followup_suggestions(
     patient_info : Dict[str, Any]
         The information about the patient including the location and insurance_id
         of the user
+    deadline : float | None
+        Seconds to wait for suggestions. Tasks without a suggestion by then are
+        returned without a provider and marked as missing
     """
-    followup_suggestions = []
-    for task in tasks:
+
+    async def get_suggestion(task) -> dict[str, Any]:
         logger.info(f"Receiving query for follow up task: {task}")
         rqt = OAIRequest(
             system_msg=SYSTEM_MSG.format(TaskSpecialty.model_json_schema()),
             user_msg=USER_MSG.format(task, ", ".join(specialties.keys())),
             response_schema=TaskSpecialty,
+            deadline=deadline,
         )
 
-        response = await a_send_rqt(client, rqt)
+        response = await scheduler.send(
+            client, rqt, user_id=patient_info.get("user_id")
+        )
         logger.info(f"Task: {task}, Response: {response}")
         result = get_relevant_providers(
             collection, patient_info, response.specialty.value
@@ -86,13 +95,31 @@ async def get_followup_suggestions(
             del result[0]["_id"]
 
         logger.info(f"Result: {pprint(result)}\n")
-        followup_suggestions.append({"provider": result, "task": task})
+        return {"provider": result, "task": task, "missing": False}
+
+    suggestions = [asyncio.create_task(get_suggestion(task)) for task in tasks]
+    if suggestions:
+        await asyncio.wait(suggestions, timeout=deadline)
+
+    followup_suggestions = []
+    for task, suggestion in zip(tasks, suggestions):
+        if suggestion.done() and not suggestion.cancelled():
+            if suggestion.exception() is None:
+                followup_suggestions.append(suggestion.result())
+                continue
+            logger.warning(
+                f"Failed to get suggestion for {task}: {suggestion.exception()!r}"
+            )
+        else:
+            logger.warning(f"No suggestion for {task} within {deadline}s")
+            suggestion.cancel()
+        followup_suggestions.append({"provider": None, "task": task, "missing": True})
 
     return followup_suggestions
 
 
 router = APIRouter(dependencies=[Depends(get_current_user)])
-client = AsyncOpenAI()
+client = create_client()
 mongo_db_client = MongoClient(MONGODB_URL)
 db = mongo_db_client["wilson_ai"]
 provider_collection = db.providers
@@ -109,7 +136,7 @@ async def get_follow_ups(followup_rqt: FollowUpRqt):
 
 
 if __name__ == "__main__":
-    client = AsyncOpenAI()
+    client = create_client()
     client_db = MongoClient(MONGODB_URL)
     db = client_db["wilson_ai"]
     collection = db.providers
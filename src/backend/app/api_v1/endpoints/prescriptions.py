@@ -1,9 +1,10 @@
+import asyncio
 import logging
 import os
 from pprint import pprint
 from typing import List
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, BackgroundTasks, Depends
 from fastapi.responses import JSONResponse
 from psycopg2.extensions import connection
 from pymongo import MongoClient
@@ -12,10 +13,14 @@ from pymongo.collection import Collection
 from ...db.nosql_db import get_provider_by_npi
 from ...db.relational_db import (
     create_connection,
+    get_prescription_user_id,
     get_prescriptions_by_id,
     set_prescription_status,
 )
+from ...db.vector_db import answer_cache
 from ...pydantic_models.pyd_models import PrescriptionRequest, PrescriptionResponse
+from ...services.timeline import refresh_timeline
+from ...utils.tracing import in_background
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +33,9 @@ def get_prescriptions(
     prescriptions = get_prescriptions_by_id(conn, user_id)
     prescription_models = []
     for prescription in prescriptions:
-        provider_info = get_provider_by_npi(collection, prescription["provider_id"])
+        provider_info = get_provider_by_npi(
+            collection, str(prescription["provider_id"])
+        )
         return_provider_info = {
             "first_name": provider_info["first_name"],
             "last_name": provider_info["last_name"],
@@ -49,6 +56,14 @@ conn = create_connection()
 provider_collection = db.providers
 
 
+async def refresh_user_records(user_id: int) -> None:
+    """Rebuild the timeline and drop the cached chat answers of a user."""
+    # the active prescriptions are part of the timeline chat answers are based on
+    await refresh_timeline(conn, provider_collection, user_id)
+    if answer_cache is not None:
+        await asyncio.to_thread(answer_cache.invalidate, user_id)
+
+
 @router.get("/{user_id}")
 async def prescriptions(user_id: int):
     prescriptions = get_prescriptions(user_id, conn, provider_collection)
@@ -56,8 +71,16 @@ async def prescriptions(user_id: int):
 
 
 @router.put("/status/{prescription_id}")
-async def set_status(prescription_id: int, rqt: PrescriptionRequest):
-    set_prescription_status(conn, prescription_id, rqt.active_flag)
+async def set_status(
+    prescription_id: int, rqt: PrescriptionRequest, background_tasks: BackgroundTasks
+):
+    # psycopg2 is blocking
+    await asyncio.to_thread(
+        set_prescription_status, conn, prescription_id, rqt.active_flag
+    )
+    user_id = await asyncio.to_thread(get_prescription_user_id, conn, prescription_id)
+    if user_id is not None:
+        background_tasks.add_task(in_background(refresh_user_records), user_id)
     return JSONResponse(
         status_code=200, content={"message": "Prescription status updated"}
     )
@@ -1,8 +1,19 @@
 from fastapi import APIRouter, Depends, FastAPI
 
-from .endpoints import appointments, chat_w_data, follow_ups, login, prescriptions
+from .endpoints import (
+    admin,
+    appointments,
+    batch_analysis,
+    chat_w_data,
+    follow_ups,
+    login,
+    prescriptions,
+)
 
 api_router = APIRouter()
+api_router.include_router(
+    batch_analysis.router, prefix="/appointments/batch", tags=["appointments"]
+)
 api_router.include_router(
     appointments.router, prefix="/appointments", tags=["appointments"]
 )
@@ -11,6 +22,7 @@ api_router.include_router(
     chat_w_data.router, prefix="/chat_w_data", tags=["chat with data"]
 )
 api_router.include_router(login.router, prefix="/auth", tags=["login"])
+api_router.include_router(admin.router, prefix="/admin", tags=["admin"])
 api_router.include_router(
     prescriptions.router, prefix="/prescriptions", tags=["prescriptions"]
 )
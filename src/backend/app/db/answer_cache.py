@@ -0,0 +1,257 @@
+"""
+Semantic cache of chat answers. Patients ask the same few questions over and
+over in different words, so the answer to a query is stored with its embedding
+and served again for any later query of the same user, with the same filters,
+whose embedding is close enough, skipping retrieval and the LLM call.
+
+Similar embeddings don't mean the same question: "Lisinopril 10 mg" and "20 mg",
+or two dates, embed almost identically. The numbers, dates and drug or
+provider names of a query are stored with it and must match exactly as well.
+
+Entries live in a chroma collection next to the chunks, so every worker shares
+them. When documents are ingested for a user their entries are dropped, and the
+time of the ingest is recorded so an answer built from context retrieved
+before it is not stored afterwards. Expired entries are deleted as new ones are
+stored.
+"""
+
+import calendar
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List
+
+import chromadb
+from chromadb import Collection
+from chromadb.api.types import EmbeddingFunction
+
+from ..utils.metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+# seconds an answer is served for, 0 to turn the cache off
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 60 * 60 * 24))
+# cosine similarity from which two queries get the same answer
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.95))
+# seconds between deletes of expired answers by one process
+PRUNE_INTERVAL = 60
+
+NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+WORD_RE = re.compile(r"[A-Za-z][A-Za-z'-]*")
+MONTHS = {
+    name.lower(): i
+    for names in (calendar.month_name, calendar.month_abbr)
+    for i, name in enumerate(names)
+    if name
+}
+DATE_WORDS = {
+    "today",
+    "yesterday",
+    "tomorrow",
+    "last",
+    "next",
+    "previous",
+    "upcoming",
+    "recent",
+    "latest",
+    "first",
+    "week",
+    "month",
+    "year",
+    *(day.lower() for day in calendar.day_name),
+}
+# abbreviations before names, their period doesn't end a sentence
+TITLES = {"dr", "mr", "mrs", "ms", "prof"}
+# common endings of generic drug names, brand names are caught by capitals
+DRUG_STEM_RE = re.compile(
+    r"(pril|sartan|olol|statin|dipine|prazole|tidine|cillin|mycin|cycline|"
+    r"floxacin|azole|vir|mab|nib|formin|gliptin|glutide|oxetine|azepam|zolam|"
+    r"sone|lone|profen|triptan|parin|xaban|thiazide|semide)$"
+)
+
+
+class AnswerCache:
+    """
+    Answers of a user's earlier queries, looked up by embedding similarity.
+
+    Parameters
+    ----------
+    client : Callable[[], chromadb.ClientAPI]
+        Returns the chroma client of the process, called on every use so the
+        cache follows the vector store when it reconnects
+    embedding_function : EmbeddingFunction
+        Embeds the queries, the one chat retrieval uses so a query is only
+        embedded once
+    collection : str
+        Collection of the answers, the ingest times go in "<collection>_ingests"
+    ttl : int
+        Seconds an answer is served for
+    similarity : float
+        Cosine similarity from which a cached answer is served
+    """
+
+    def __init__(
+        self,
+        client: Callable[[], "chromadb.ClientAPI"],
+        embedding_function: EmbeddingFunction,
+        collection: str,
+        ttl: int = ANSWER_CACHE_TTL,
+        similarity: float = ANSWER_CACHE_SIMILARITY,
+    ):
+        self._client = client
+        self.embedding_function = embedding_function
+        self.collection = collection
+        self.ttl = ttl
+        self.similarity = similarity
+        self._opened: Dict[str, Collection] = {}
+        self._opened_for: Any = None
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+
+    def embed(self, query: str) -> List[float]:
+        return list(self.embedding_function([query])[0])
+
+    def get(
+        self, query: str, embedding: List[float], user_id: int, filters: Dict[str, Any]
+    ) -> str | None:
+        """
+        The cached answer to the closest earlier query with the same exact
+        terms, None on a miss.
+        """
+        answers = self._open(self.collection, {"hnsw:space": "cosine"})
+        result = answers.query(
+            query_embeddings=[embedding],
+            n_results=1,
+            where={
+                "$and": [
+                    {"user_id": user_id},
+                    {"filters": _filters_key(filters)},
+                    {"terms": exact_terms(query)},
+                    {"created_at": {"$gte": time.time() - self.ttl}},
+                ]
+            },
+            include=["metadatas", "distances"],
+        )
+        hit = bool(result["ids"][0]) and 1 - result["distances"][0][0] >= (
+            self.similarity
+        )
+        record_cache("answers", hit)
+        return result["metadatas"][0][0]["answer"] if hit else None
+
+    def put(
+        self,
+        query: str,
+        embedding: List[float],
+        user_id: int,
+        filters: Dict[str, Any],
+        answer: str,
+        retrieved_at: float,
+    ) -> None:
+        """
+        Store the answer to a query, unless documents of the user were ingested
+        after its context was retrieved at retrieved_at.
+        """
+        ingests = self._open(f"{self.collection}_ingests")
+        ingest = ingests.get(ids=[str(user_id)], include=["metadatas"])
+        if ingest["ids"] and ingest["metadatas"][0]["ingested_at"] >= retrieved_at:
+            logger.debug(f"Not caching a stale answer for user {user_id}")
+            return
+
+        answers = self._open(self.collection, {"hnsw:space": "cosine"})
+        answers.add(
+            ids=[str(uuid.uuid4())],
+            embeddings=[embedding],
+            documents=[query],
+            metadatas=[
+                {
+                    "user_id": user_id,
+                    "filters": _filters_key(filters),
+                    "terms": exact_terms(query),
+                    "created_at": time.time(),
+                    "answer": answer,
+                }
+            ],
+        )
+        self._prune(answers)
+
+    def invalidate(self, user_id: int) -> None:
+        """Drop the answers of a user, called when their documents change."""
+        # a dummy vector, the collection only keeps the time of the last ingest
+        self._open(f"{self.collection}_ingests").upsert(
+            ids=[str(user_id)],
+            embeddings=[[0.0]],
+            metadatas=[{"ingested_at": time.time()}],
+        )
+        answers = self._open(self.collection, {"hnsw:space": "cosine"})
+        answers.delete(where={"user_id": user_id})
+        logger.info(f"Invalidated cached answers of user {user_id}")
+        self._prune(answers)
+
+    def _prune(self, answers: Collection) -> None:
+        """Delete expired answers, at most once every PRUNE_INTERVAL seconds."""
+        now = time.time()
+        with self._lock:
+            if now - self._pruned_at < PRUNE_INTERVAL:
+                return
+            self._pruned_at = now
+        answers.delete(where={"created_at": {"$lt": now - self.ttl}})
+
+    def _open(self, name: str, metadata: Dict[str, Any] | None = None) -> Collection:
+        client = self._client()
+        with self._lock:
+            if client is not self._opened_for:
+                self._opened, self._opened_for = {}, client
+            if name not in self._opened:
+                # embeddings are always passed in, the function is never called
+                self._opened[name] = client.get_or_create_collection(
+                    name,
+                    metadata=metadata,
+                    embedding_function=self.embedding_function,
+                )
+            return self._opened[name]
+
+
+def exact_terms(query: str) -> str:
+    """
+    The terms of a query that must match for an answer to be reused: numbers in
+    the order they appear, then month, date and drug words and capitalized
+    names, e.g. "Is my Lisinopril 10 mg dose from March ok?" gives
+    "10 lisinopril month:3".
+    """
+    numbers = []
+    for number in NUMBER_RE.findall(query):
+        # 10 and 10.0 are the same dose
+        number = number.replace(",", "")
+        if "." in number:
+            number = number.rstrip("0").rstrip(".")
+        numbers.append(number.lstrip("0") or "0")
+
+    words, previous = set(), ""
+    for match in WORD_RE.finditer(query):
+        word = match.group().lower()
+        before = query[: match.start()].rstrip()[-1:]
+        sentence_start = before in ("", "?", "!") or (
+            before == "." and previous not in TITLES
+        )
+        if word in MONTHS:
+            words.add(f"month:{MONTHS[word]}")
+        elif word in DATE_WORDS or DRUG_STEM_RE.search(word):
+            words.add(word)
+        elif (
+            match.group()[0].isupper()
+            and word not in TITLES
+            and len(word) > 1
+            and not sentence_start
+        ):
+            words.add(word)
+        previous = word
+    return " ".join(numbers + sorted(words))
+
+
+def _filters_key(filters: Dict[str, Any]) -> str:
+    # chroma can't match None, answers with different filters never mix
+    return json.dumps(filters, sort_keys=True, default=str)
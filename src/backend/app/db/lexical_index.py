@@ -0,0 +1,110 @@
+"""
+Lexical index over the document chunks, for the exact terms embeddings are
+weakest at: medication names, dosages and dates. Chunks are added at ingest
+into a sqlite FTS5 table next to the vector store and searched with BM25,
+scoped to one user and optionally a provider and date range.
+"""
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Sequence
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "./lexical_index.sqlite3")
+
+TERM_RE = re.compile(r"\w+(?:[./]\w+)*")
+
+
+class LexicalIndex:
+    """
+    BM25 search over chunks with sqlite FTS5.
+
+    Parameters
+    ----------
+    path : str
+        sqlite database file, ":memory:" for a per process index
+    """
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+                text,
+                id UNINDEXED,
+                user_id UNINDEXED,
+                provider_name UNINDEXED,
+                appointment_ts UNINDEXED,
+                metadata UNINDEXED,
+                tokenize = 'porter unicode61'
+            )"""
+        )
+        self._lock = threading.Lock()
+
+    def add(
+        self, ids: Sequence[str], texts: Sequence[str], metadatas: Sequence[Dict]
+    ) -> None:
+        """Add chunks, replacing those with the same id."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "DELETE FROM chunks WHERE id = ?", [(id_,) for id_ in ids]
+            )
+            self._conn.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        text,
+                        id_,
+                        metadata.get("user_id"),
+                        metadata.get("provider_name"),
+                        metadata.get("appointment_ts"),
+                        json.dumps(metadata),
+                    )
+                    for id_, text, metadata in zip(ids, texts, metadatas)
+                ],
+            )
+
+    def search(
+        self,
+        query: str,
+        user_id: int,
+        limit: int = 20,
+        provider_name: str | None = None,
+        date_from: int | None = None,
+        date_to: int | None = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Chunks of the user matching any term of the query, best BM25 score first.
+        Dates are unix timestamps of the appointment, both ends inclusive.
+        """
+        terms = TERM_RE.findall(query)
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        sql = (
+            "SELECT id, text, metadata FROM chunks WHERE chunks MATCH ? AND user_id = ?"
+        )
+        params: List[Any] = [match, user_id]
+        if provider_name is not None:
+            sql += " AND provider_name = ?"
+            params.append(provider_name)
+        if date_from is not None:
+            sql += " AND appointment_ts >= ?"
+            params.append(date_from)
+        if date_to is not None:
+            sql += " AND appointment_ts <= ?"
+            params.append(date_to)
+        sql += " ORDER BY bm25(chunks) LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            {"id": id_, "document": text, "metadata": json.loads(metadata)}
+            for id_, text, metadata in rows
+        ]
@@ -1,16 +1,18 @@
 import logging
+import os
 import pprint
-from typing import Any, Dict
+from typing import Any, Dict, List
 
 import requests
 from bson.objectid import ObjectId
 from pymongo import MongoClient
 from pymongo.collection import Collection, UpdateResult
 
+from ..utils.metrics import external_call
 from .relational_db import geocode_address
 
 SUGGESTION_MAX_DISTANCE = 10000  # distance in meters
-NPI_URL = "https://npiregistry.cms.hhs.gov/api/?version=2.1"
+NPI_URL = os.getenv("NPI_URL", "https://npiregistry.cms.hhs.gov/api/?version=2.1")
 
 logger = logging.getLogger(__name__)
 
@@ -48,7 +50,8 @@ def get_npi(provider_info: Dict[str, any]) -> str:
         },
     ]
     for params in params_list:
-        response = requests.get(NPI_URL, params=params)
+        with external_call("npi_registry", "search"):
+            response = requests.get(NPI_URL, params=params)
         if response.json()["results"]:
             # TODO figure out how we want to handle multiple results
             return response.json()["results"][0]["number"]
@@ -60,6 +63,17 @@ def get_provider_by_npi(collection: Collection, npi: str) -> Dict[str, Any]:
     return collection.find_one({"npi": npi})
 
 
+def get_providers_by_npi(
+    collection: Collection, npis: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    """Name and specialties of several providers in one query, keyed by NPI."""
+    providers = collection.find(
+        {"npi": {"$in": npis}},
+        {"npi": 1, "first_name": 1, "last_name": 1, "specialties": 1, "_id": 0},
+    )
+    return {provider["npi"]: provider for provider in providers}
+
+
 def upsert_provider(
     collection: Collection, provider_info: Dict[str, Any]
 ) -> UpdateResult:
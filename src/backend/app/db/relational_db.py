@@ -11,8 +11,11 @@ import requests
 from psycopg2.extensions import connection
 
 from ..security.auth import verify_password
+from ..utils.metrics import external_call
 
-GOOGE_MAPS_API = "https://maps.googleapis.com/maps/api/geocode/json"
+GOOGE_MAPS_API = os.getenv(
+    "GOOGLE_MAPS_API_URL", "https://maps.googleapis.com/maps/api/geocode/json"
+)
 
 logger = logging.getLogger(__name__)
 api_key = os.getenv("GOOGLE_MAPS_API_KEY")
@@ -26,10 +29,11 @@ pg_host = os.getenv("POSTGRES_HOST", "localhost")
 def geocode_address(street, city, state, zip_code):
     country = "US"  # assume this is true for now...
     address = f"{street}, {city}, {state}, {zip_code}, {country}"
-    response = requests.get(
-        GOOGE_MAPS_API,
-        params={"address": address, "key": api_key},
-    )
+    with external_call("google_maps", "geocode"):
+        response = requests.get(
+            GOOGE_MAPS_API,
+            params={"address": address, "key": api_key},
+        )
     response.raise_for_status()
     results = response.json()["results"]
     if results:
@@ -266,17 +270,18 @@ async_pg_params = {
 }
 
 
+# ordered so every table is created after the tables it references
 CREATE_QUERIES = [
-    CREATE_APPT_TABLE_QUERY,
     CREATE_COVERAGE_TYPE_QUERY,
     CREATE_INSURANCE_QUERY,
+    CREATE_SPECIALTIES_QUERY,
+    CREATE_LOCATION_QUERY,
     CREATE_USER_QUERY,
     CREATE_PROVIDER_QUERY,
+    CREATE_APPT_TABLE_QUERY,
     CREATE_PRESCRIPTION_QUERY,
     CREATE_PROVIDER_TO_INSURANCE_QUERY,
     CREATE_USER_TO_INSURANCE_QUERY,
-    CREATE_SPECIALTIES_QUERY,
-    CREATE_LOCATION_QUERY,
 ]
 
 
@@ -510,6 +515,38 @@ def get_user_appointments(conn: connection, user_id: int) -> List[Dict[str, Any]
     return results
 
 
+SELECT_TIMELINE_APPOINTMENTS_QUERY = """
+SELECT id, provider_id, appointment_datetime, summary, follow_ups
+FROM appointment
+WHERE user_id = %(user_id)s
+ORDER BY appointment_datetime
+"""
+
+SELECT_ACTIVE_PRESCRIPTIONS_QUERY = """
+SELECT p.brand_name, p.technical_name, p.instructions, p.provider_id, a.appointment_datetime
+FROM prescriptions p
+JOIN appointment a ON a.id = p.appointment_id
+WHERE p.user_id = %(user_id)s AND p.active_flag
+ORDER BY a.appointment_datetime
+"""
+
+
+def get_timeline_appointments(conn: connection, user_id: int) -> List[Dict[str, Any]]:
+    """Appointments of a user, earliest first."""
+    return query_db(conn, SELECT_TIMELINE_APPOINTMENTS_QUERY, {"user_id": user_id})
+
+
+def get_active_prescriptions(conn: connection, user_id: int) -> List[Dict[str, Any]]:
+    """Active prescriptions of a user with the date they were prescribed."""
+    return query_db(conn, SELECT_ACTIVE_PRESCRIPTIONS_QUERY, {"user_id": user_id})
+
+
+def get_prescription_user_id(conn: connection, prescription_id: int) -> int | None:
+    query = "SELECT user_id FROM prescriptions WHERE id = %(id)s"
+    results = query_db(conn, query, {"id": prescription_id})
+    return results[0]["user_id"] if results else None
+
+
 def get_user_by_email(conn: connection, email: str) -> Dict[str, str]:
     query = f"SELECT * FROM users WHERE email = '{email}'"
     results = query_db(conn, query)
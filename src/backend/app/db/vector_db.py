@@ -2,30 +2,68 @@
 
 import logging
 import os
+import re
+import threading
+import time
+import zlib
 from collections import defaultdict
+from datetime import datetime
 from pprint import pprint
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
+from urllib.parse import urlparse
 
 import chromadb
 import chromadb.utils.embedding_functions as embedding_functions
-import pandas as pd
 from chromadb import Collection
+from chromadb.api.types import EmbeddingFunction
 from llama_index.core import SimpleDirectoryReader, VectorStoreIndex
 from llama_index.core.base.response.schema import Response
 from llama_index.core.indices.vector_store.base import VectorStoreIndex
 from llama_index.core.schema import Document
 from llama_index.core.vector_stores import MetadataFilter, MetadataFilters
 
-from ..utils.utils import create_hash_id
+from ..models.open_ai.prompt_budget import count_tokens
+from ..models.open_ai.utils import OPENAI_BASE_URL, create_client
+from ..services.chunking import chunk_documents
+from ..services.embeddings import (
+    EMBEDDING_CACHE_PATH,
+    EmbeddingCache,
+    EmbeddingService,
+)
+from .answer_cache import ANSWER_CACHE_TTL, AnswerCache
+from .lexical_index import LEXICAL_INDEX_PATH, LexicalIndex
 
 _logger = logging.getLogger(__name__)
 
+CONTEXT_CHUNKS = int(os.getenv("CONTEXT_CHUNKS", 8))
+# candidates taken from each retriever before fusing
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", 20))
+RRF_K = 60
+# prompt tokens of context handed to the LLM and the share of word 3-grams from
+# which two chunks count as the same
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+DEDUPE_SIMILARITY = 0.8
+
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 
 DB_PATH = os.getenv("CHROMADB_PATH", "./chroma_db")
-COLLECTION = "appointment_oai"
+CHROMADB_URL = os.getenv("CHROMADB_URL")
+# embedded opens the sqlite backed store at DB_PATH in process, http talks to
+# a chroma server at CHROMADB_URL, which several workers can share safely
+CHROMADB_MODE = os.getenv("CHROMADB_MODE", "http" if CHROMADB_URL else "embedded")
+OAI_EMBED_MODEL = "text-embedding-3-small"
 HF_EMBED_MODEL = "BAAI/bge-base-en-v1.5"
+# openai embeds with OAI_EMBED_MODEL through the API, onnx runs ONNX_EMBED_MODEL
+# on the local CPU
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+ONNX_EMBED_MODEL = os.getenv("ONNX_EMBED_MODEL", HF_EMBED_MODEL)
+# vectors of different models can't share a collection
+COLLECTION = (
+    "appointment_oai"
+    if EMBEDDING_BACKEND == "openai"
+    else f"appointment_{ONNX_EMBED_MODEL.split('/')[-1]}"
+)
 
 CHAT_W_DATA_SYS_MSG = """You are a word class medical physician who is also an expert in Q&A and you will assist in analyzing this patient's medical records
 and responding to their questions to the best of your ability. For each query, you will be provided with the most relevant context
@@ -39,66 +77,475 @@ Query: {}
 Context: {}
 """
 
-embed_model_oai = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=os.environ["OPENAI_API_KEY"],
-    model_name="text-embedding-3-small",
+
+def create_embedding_backend(
+    backend: str = EMBEDDING_BACKEND,
+) -> Tuple[EmbeddingFunction, str]:
+    """The embedding function of a backend and the name of its model."""
+    if backend == "openai":
+        embed_model_oai = embedding_functions.OpenAIEmbeddingFunction(
+            api_key=os.environ["OPENAI_API_KEY"],
+            model_name=OAI_EMBED_MODEL,
+            api_base=OPENAI_BASE_URL,
+        )
+        return embed_model_oai, OAI_EMBED_MODEL
+    if backend == "onnx":
+        # onnxruntime and the model are only loaded when the backend is used
+        from ..services.onnx_embeddings import OnnxEmbeddingFunction
+
+        return OnnxEmbeddingFunction(ONNX_EMBED_MODEL), ONNX_EMBED_MODEL
+    raise ValueError(f"Unknown embedding backend {backend}")
+
+
+_embedding_functions: Dict[str, EmbeddingService] = {}
+_embedding_lock = threading.Lock()
+
+
+def embedding_function_for(backend: str = EMBEDDING_BACKEND) -> EmbeddingService:
+    """The cached, batched embedding function of a backend, one per process."""
+    with _embedding_lock:
+        if backend not in _embedding_functions:
+            function, model = create_embedding_backend(backend)
+            _embedding_functions[backend] = EmbeddingService(
+                function,
+                model=model,
+                cache=EmbeddingCache() if EMBEDDING_CACHE_PATH else None,
+            )
+        return _embedding_functions[backend]
+
+
+EMBED_MODEL = embedding_function_for()
+
+# collection whose metadata maps each alias to the collection it points at,
+# and "<alias>:next" to the collection a re-index is filling
+ALIASES_COLLECTION = "collection_aliases"
+ALIAS = "appointments"
+ALIAS_REFRESH_SECONDS = float(os.getenv("ALIAS_REFRESH_SECONDS", 5))
+# new collection versions are split into this many shards by a hash of the user
+# id, so each HNSW index only spans the chunks of a slice of the users. The
+# shards of an existing version are recorded as "<collection>:shards" in the
+# aliases, versions without the key are a single collection.
+VECTOR_SHARDS = int(os.getenv("VECTOR_SHARDS", 1))
+
+
+def shard_of(user_id: Any, n_shards: int) -> int:
+    """The shard holding the chunks of a user, stable across processes."""
+    return zlib.crc32(str(user_id).encode()) % n_shards
+
+
+def shard_name(collection: str, shard: int, n_shards: int) -> str:
+    return collection if n_shards == 1 else f"{collection}_s{shard}"
+
+
+class VectorStore:
+    """
+    The chroma client and collections of this process. Connected once when the
+    app starts, or on first use in scripts, and shared by every request, instead
+    of opening a client per call.
+
+    Reads go to the collection the alias points at. While a re-index fills a
+    new version of the collection, writes go to both, and once it is done the
+    alias is flipped to the new version. Every worker picks up the flip within
+    ALIAS_REFRESH_SECONDS.
+
+    A collection version may be split into shards, each a chroma collection
+    holding the chunks of the users that hash to it. Reads and writes for a
+    user are routed to their shard with collection_for and
+    write_collections_for.
+
+    Parameters
+    ----------
+    mode : str
+        "embedded" for a PersistentClient at path, "http" for a chroma server
+    path : str
+        Directory of the embedded store
+    url : str | None
+        URL of the chroma server, e.g. http://localhost:8000
+    collection : str
+        Collection read from while the alias has never been set
+    alias : str
+        Name of the alias in the aliases collection
+    """
+
+    def __init__(
+        self,
+        mode: str = CHROMADB_MODE,
+        path: str = DB_PATH,
+        url: str | None = CHROMADB_URL,
+        collection: str = COLLECTION,
+        alias: str = ALIAS,
+    ):
+        if mode not in ("embedded", "http"):
+            raise ValueError(f"Unknown chroma mode {mode}")
+        if mode == "http" and not url:
+            raise ValueError("CHROMADB_URL has to be set to use chroma over http")
+        self.mode = mode
+        self.path = path
+        self.url = url
+        self.default_collection = collection
+        self.alias = alias
+        self._client: chromadb.ClientAPI | None = None
+        self._collections: Dict[str, Collection] = {}
+        self._read: str | None = None
+        self._next: str | None = None
+        self._shards: Dict[str, int] = {}
+        self._resolved_at = 0.0
+        self._lock = threading.Lock()
+
+    def connect(self) -> None:
+        with self._lock:
+            if self._client is None:
+                if self.mode == "http":
+                    url = urlparse(self.url)
+                    self._client = chromadb.HttpClient(
+                        host=url.hostname,
+                        port=url.port or (443 if url.scheme == "https" else 8000),
+                        ssl=url.scheme == "https",
+                    )
+                else:
+                    self._client = chromadb.PersistentClient(path=self.path)
+                self._resolved_at = 0.0
+                _logger.info(f"Connected to {self.mode} chroma")
+            self._resolve()
+
+    def close(self) -> None:
+        with self._lock:
+            self._collections = {}
+            self._client = None
+
+    @property
+    def client(self) -> "chromadb.ClientAPI":
+        self.connect()
+        return self._client
+
+    @property
+    def collection_name(self) -> str:
+        """The collection to read from, sharded or not."""
+        self.connect()
+        return self._read
+
+    def shards(self, name: str | None = None) -> int:
+        """Number of shards of a collection, the one read from by default."""
+        self.connect()
+        with self._lock:
+            name = name or self._read
+            if name in self._shards:
+                return self._shards[name]
+        return int(self.aliases().get(f"{name}:shards", 1))
+
+    def collections(self, name: str | None = None) -> List[Collection]:
+        """Every shard of a collection in order, the one read from by default."""
+        name = name or self.collection_name
+        n_shards = self.shards(name)
+        with self._lock:
+            return [
+                self._open(shard_name(name, shard, n_shards))
+                for shard in range(n_shards)
+            ]
+
+    def collection_for(self, user_id: Any) -> Collection:
+        """The shard of the collection read from with the chunks of a user."""
+        self.connect()
+        with self._lock:
+            return self._open(self._shard_for(self._read, user_id))
+
+    def write_collections_for(self, user_id: Any) -> List[Collection]:
+        """
+        The shards to write the chunks of a user to, one per collection written
+        to, i.e. two while a re-index is running.
+        """
+        self.connect()
+        with self._lock:
+            return [
+                self._open(self._shard_for(name, user_id))
+                for name in (self._read, self._next)
+                if name is not None
+            ]
+
+    def aliases(self) -> Dict[str, Any]:
+        registry = self.client.get_or_create_collection(ALIASES_COLLECTION)
+        return dict(registry.metadata or {})
+
+    def set_alias(self, collection: str, next: str | None = None) -> None:
+        """
+        Point the alias at a collection and optionally start writing to a second
+        one as well. A single metadata update, so readers never see a mix.
+        """
+        registry = self.client.get_or_create_collection(ALIASES_COLLECTION)
+        aliases = dict(registry.metadata or {})
+        aliases[self.alias] = collection
+        aliases.pop(f"{self.alias}:next", None)
+        if next is not None:
+            aliases[f"{self.alias}:next"] = next
+        registry.modify(metadata=aliases)
+        _logger.info(f"Alias {self.alias} set to {collection}, next {next}")
+        with self._lock:
+            self._resolved_at = 0.0
+
+    def create_version(
+        self, backend: str = EMBEDDING_BACKEND, shards: int = VECTOR_SHARDS
+    ) -> str:
+        """
+        Create the next version of the collection, embedded with backend and
+        split into shards.
+        """
+        version_re = re.compile(rf"{re.escape(self.alias)}_v(\d+)(?:_s\d+)?")
+        versions = [
+            int(match.group(1))
+            for match in (
+                version_re.fullmatch(c.name) for c in self.client.list_collections()
+            )
+            if match
+        ]
+        name = f"{self.alias}_v{max(versions, default=0) + 1}"
+        for shard in range(shards):
+            self.client.create_collection(
+                shard_name(name, shard, shards),
+                metadata={"embedding_backend": backend},
+                embedding_function=embedding_function_for(backend),
+            )
+        if shards > 1:
+            registry = self.client.get_or_create_collection(ALIASES_COLLECTION)
+            registry.modify(
+                metadata={**(registry.metadata or {}), f"{name}:shards": shards}
+            )
+        return name
+
+    def _resolve(self) -> None:
+        # called with the lock held
+        if time.monotonic() - self._resolved_at < ALIAS_REFRESH_SECONDS:
+            return
+        registry = self._client.get_or_create_collection(ALIASES_COLLECTION)
+        aliases = registry.metadata or {}
+        read = aliases.get(self.alias, self.default_collection)
+        if read != self._read:
+            _logger.info(f"Reading from collection {read}")
+        self._read, self._next = read, aliases.get(f"{self.alias}:next")
+        self._shards = {
+            name: int(aliases.get(f"{name}:shards", 1))
+            for name in (self._read, self._next)
+            if name is not None
+        }
+        self._resolved_at = time.monotonic()
+
+    def _shard_for(self, name: str, user_id: Any) -> str:
+        # called with the lock held
+        n_shards = self._shards[name]
+        return shard_name(name, shard_of(user_id, n_shards), n_shards)
+
+    def _open(self, name: str) -> Collection:
+        # called with the lock held
+        if name not in self._collections:
+            collection = self._client.get_or_create_collection(
+                name, embedding_function=EMBED_MODEL
+            )
+            backend = (collection.metadata or {}).get("embedding_backend")
+            if backend and backend != EMBEDDING_BACKEND:
+                collection = self._client.get_collection(
+                    name, embedding_function=embedding_function_for(backend)
+                )
+            self._collections[name] = collection
+        return self._collections[name]
+
+
+vector_store = VectorStore()
+
+
+lexical_index = LexicalIndex() if LEXICAL_INDEX_PATH else None
+
+answer_cache = (
+    AnswerCache(lambda: vector_store.client, EMBED_MODEL, f"{COLLECTION}_answers")
+    if ANSWER_CACHE_TTL
+    else None
 )
 
-EMBED_MODEL = embed_model_oai
+
+def appointment_timestamp(value: Any) -> int | None:
+    """Unix timestamp of an appointment datetime, for range filters on chunks."""
+    try:
+        return int(datetime.fromisoformat(str(value)).timestamp())
+    except ValueError:
+        return None
 
 
 def load_documents(documents: List[Document], metadata: Dict[Any, Any]) -> None:
-    """Load documents from a directory into the vector database."""
-    client = chromadb.PersistentClient(path=DB_PATH)
-    collection = client.get_or_create_collection(
-        name=COLLECTION, embedding_function=EMBED_MODEL
-    )
+    """
+    Chunk documents and load the chunks into the vector database and lexical
+    index. Chunk ids are derived from their text and metadata, so chunks stored
+    by an earlier run are skipped rather than embedded again. If any chunk is
+    new, the cached chat answers of the user are invalidated.
+    """
+    metadata = {
+        **metadata,
+        "appointment_ts": appointment_timestamp(metadata.get("appointment_datetime")),
+    }
+    chunks = chunk_documents(documents, metadata)
+    if not chunks:
+        # chroma rejects a get by an empty list of ids
+        _logger.info("No text to load, the documents are empty")
+        return
+    loaded = False
+    for collection in vector_store.write_collections_for(metadata.get("user_id")):
+        existing = set(
+            collection.get(ids=[chunk.id for chunk in chunks], include=[])["ids"]
+        )
+        new_chunks = [chunk for chunk in chunks if chunk.id not in existing]
+        if not new_chunks:
+            continue
+
+        collection.upsert(
+            documents=[chunk.text for chunk in new_chunks],
+            metadatas=[chunk.metadata for chunk in new_chunks],
+            ids=[chunk.id for chunk in new_chunks],
+        )
+        loaded = True
+        _logger.info(
+            f"Loaded {len(new_chunks)} chunks into {collection.name}, "
+            f"{len(existing)} already stored"
+        )
+
+    if lexical_index is not None:
+        lexical_index.add(
+            [chunk.id for chunk in chunks],
+            [chunk.text for chunk in chunks],
+            [chunk.metadata for chunk in chunks],
+        )
+    if loaded and answer_cache is not None and "user_id" in metadata:
+        answer_cache.invalidate(metadata["user_id"])
 
-    collection.upsert(
-        documents=[document.text for document in documents],
-        metadatas=[metadata for _ in documents],
-        ids=[create_hash_id(document.text, metadata) for document in documents],
-    )
-    return
 
+def build_where(
+    user_id: int,
+    provider_name: str | None = None,
+    date_from: int | None = None,
+    date_to: int | None = None,
+) -> Dict[str, Any]:
+    """Chroma metadata filter for the chunks of a user."""
+    conditions: List[Dict[str, Any]] = [{"user_id": user_id}]
+    if provider_name is not None:
+        conditions.append({"provider_name": provider_name})
+    if date_from is not None:
+        conditions.append({"appointment_ts": {"$gte": date_from}})
+    if date_to is not None:
+        conditions.append({"appointment_ts": {"$lte": date_to}})
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
 
-def get_context(query: str, user_id: int, collection: Collection) -> Dict[str, Any]:
-    """Get context for the query."""
+
+def reciprocal_rank_fusion(
+    rankings: List[List[Dict[str, Any]]], k: int = RRF_K
+) -> List[Dict[str, Any]]:
+    """
+    Merge ranked lists of chunks by the sum of 1 / (k + rank) over the lists a
+    chunk appears in, so chunks both retrievers agree on come first.
+    """
+    scores: Dict[str, float] = defaultdict(float)
+    chunks: Dict[str, Dict[str, Any]] = {}
+    for ranking in rankings:
+        for rank, chunk in enumerate(ranking, start=1):
+            scores[chunk["id"]] += 1 / (k + rank)
+            chunks.setdefault(chunk["id"], chunk)
+    return [chunks[id_] for id_ in sorted(scores, key=scores.get, reverse=True)]
+
+
+def get_context(
+    query: str,
+    user_id: int,
+    collection: Collection | None = None,
+    n_results: int = CONTEXT_CHUNKS,
+    provider_name: str | None = None,
+    date_from: int | None = None,
+    date_to: int | None = None,
+) -> Dict[str, Any]:
+    """
+    Get context for the query. Chunks found by embedding similarity and by BM25
+    are fused with reciprocal rank fusion, and the best n_results returned in
+    the shape of a chroma query result. Dates are unix timestamps. Queries the
+    user's shard of the collection read from unless given a collection.
+    """
+    if collection is None:
+        collection = vector_store.collection_for(user_id)
     result = collection.query(
-        query_texts=query,
-        include=["documents", "metadatas", "distances"],
-        where={"user_id": user_id},
+        query_texts=[query],
+        n_results=RETRIEVAL_CANDIDATES,
+        include=["documents", "metadatas"],
+        where=build_where(user_id, provider_name, date_from, date_to),
     )
-    return result
+    ranked = [
+        {"id": id_, "document": document, "metadata": metadata}
+        for id_, document, metadata in zip(
+            result["ids"][0], result["documents"][0], result["metadatas"][0]
+        )
+    ]
+    if lexical_index is not None:
+        lexical = lexical_index.search(
+            query, user_id, RETRIEVAL_CANDIDATES, provider_name, date_from, date_to
+        )
+        ranked = reciprocal_rank_fusion([ranked, lexical])
+
+    ranked = ranked[:n_results]
+    return {
+        "ids": [[chunk["id"] for chunk in ranked]],
+        "documents": [[chunk["document"] for chunk in ranked]],
+        "metadatas": [[chunk["metadata"] for chunk in ranked]],
+    }
+
 
+def _shingles(text: str, n: int = 3) -> set:
+    words = text.lower().split()
+    return {tuple(words[i : i + n]) for i in range(max(1, len(words) - n + 1))}
 
-def structure_context(context: Dict[str, Any]) -> str:
+
+def _appointment_date(metadata: Dict[str, Any]) -> datetime | str:
+    raw = str(metadata.get("appointment_datetime", ""))
+    try:
+        return datetime.fromisoformat(raw)
+    except ValueError:
+        return raw
+
+
+def structure_context(
+    context: Dict[str, Any], token_budget: int = CONTEXT_TOKEN_BUDGET
+) -> str:
     """
     From a chroma db response, organize the information such that context
     from the same provider / appointment is grouped together and sorted by date
-    (latest to earliest). This will provide an organized way of presenting
-    the information to the LLM in the prompt.
+    (earliest to latest). Chunks that are near duplicates of a more relevant
+    chunk are dropped, and chunks are taken in order of relevance until the
+    token budget is used up.
     """
-    result_dict = defaultdict(list)
-    for i, doc in enumerate(context["documents"][0]):
-        metadata = context["metadatas"][0][i]
-        result_dict["provider_name"].append(metadata["provider_name"])
-        result_dict["appointment_date"].append(metadata["appointment_datetime"])
-        result_dict["context"].append(doc)
-
-    df = pd.DataFrame(result_dict)
-    df = (
-        df.assign(appointment_date=pd.to_datetime(df["appointment_date"]))
-        .groupby(["provider_name", "appointment_date"])["context"]
-        .agg(" ".join)
-        .reset_index()
-        .sort_values(by=["appointment_date"])
-    )
-    df["formatted_row"] = df.apply(
-        lambda x: f"{x['provider_name']}, {x['appointment_date']}:\n{x['context']}",
-        axis=1,
-    )
-    return "\n".join(df["formatted_row"].to_list())
+    seen: List[set] = []
+    groups: Dict[Tuple[str, datetime | str], List[Tuple[int, int, str]]] = {}
+    n_tokens = 0
+    for doc, metadata in zip(context["documents"][0], context["metadatas"][0]):
+        shingles = _shingles(doc)
+        if any(
+            len(shingles & other) / len(shingles | other) >= DEDUPE_SIMILARITY
+            for other in seen
+        ):
+            continue
+
+        key = (
+            metadata.get("provider_name", "Unknown provider"),
+            _appointment_date(metadata),
+        )
+        cost = count_tokens(doc)
+        if key not in groups:
+            cost += count_tokens(f"{key[0]}, {key[1]}:")
+        if n_tokens + cost > token_budget:
+            break
+        n_tokens += cost
+        seen.append(shingles)
+        groups.setdefault(key, []).append(
+            (metadata.get("page", 0), metadata.get("offset", 0), doc)
+        )
+
+    sections = []
+    # str of a datetime sorts by date, dates that could not be parsed go last
+    for key in sorted(groups, key=lambda k: (isinstance(k[1], str), str(k[1]))):
+        # chunks of one appointment in reading order
+        text = " ".join(doc for _, _, doc in sorted(groups[key]))
+        sections.append(f"{key[0]}, {key[1]}:\n{text}")
+    return "\n".join(sections)
 
 
 def query_documents(query: str, user_id: int, index: VectorStoreIndex) -> Response:
@@ -120,9 +567,7 @@ def query_documents(query: str, user_id: int, index: VectorStoreIndex) -> Respon
 
 
 if __name__ == "__main__":
-    from openai import AsyncOpenAI
-
-    client = AsyncOpenAI()
+    client = create_client()
     _logger.info("Loading documents...")
     context = SimpleDirectoryReader("./data").load_data()
 
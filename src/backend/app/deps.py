@@ -1,3 +1,4 @@
+import os
 from typing import Annotated
 
 from fastapi import Depends, HTTPException, status
@@ -7,6 +8,13 @@ from pydantic import BaseModel
 from .db.relational_db import create_connection, get_db, get_user_by_email
 from .security.auth import verify_token
 
+# comma separated emails of the users allowed on the admin endpoints
+ADMIN_EMAILS = {
+    email.strip().lower()
+    for email in os.getenv("ADMIN_EMAILS", "").split(",")
+    if email.strip()
+}
+
 reusable_oauth2 = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/token")
 
 
@@ -33,3 +41,13 @@ async def get_current_user(token: Annotated[str, Depends(reusable_oauth2)]):
     if user is None:
         raise credentials_exception
     return user
+
+
+async def get_admin_user(user: Annotated[dict, Depends(get_current_user)]):
+    # no allowlist means no admins, the admin endpoints are never open to all
+    if user["email"].lower() not in ADMIN_EMAILS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required",
+        )
+    return user
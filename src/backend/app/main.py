@@ -1,12 +1,18 @@
+import itertools
 import logging
 import os
+import time
+from contextlib import asynccontextmanager
 
 import yaml
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 
-from .api_v1.router import api_router
+from .utils import metrics
+from .utils.loop_monitor import LOOP_BLOCK_FAIL_MS, current_request, monitor
+from .utils.tracing import instrument_app, setup_tracing
 
 load_dotenv()
 
@@ -22,7 +28,25 @@ logging.config.dictConfig(logging_config)
 
 logger = logging.getLogger(__name__)
 
+# tracing has to be set up before the routers open their db connections
+setup_tracing()
+from .api_v1.router import api_router  # noqa: E402
+from .db.vector_db import vector_store  # noqa: E402
+from .services.pdf_extraction import pdf_extractor  # noqa: E402
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    monitor.start()
+    vector_store.connect()
+    yield
+    vector_store.close()
+    pdf_extractor.shutdown()
+    await monitor.stop()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Wilson AI API",
     description="""A FastAPI application to extract information from patient
     medical documents""",
@@ -41,3 +65,80 @@ app.add_middleware(
 )
 
 app.include_router(api_router, prefix="/api/v1")
+instrument_app(app)
+
+
+request_ids = itertools.count()
+
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """Record the latency of every request and the stages it spent time in."""
+    stages = metrics.start_request_timing()
+    # the endpoint runs in a child task, which inherits the id and is tagged
+    # with it by the loop monitor
+    request_id = next(request_ids)
+    token = current_request.set(request_id)
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        current_request.reset(token)
+        elapsed = time.perf_counter() - start
+        metrics.HTTP_REQUESTS_IN_FLIGHT.dec()
+        # label by route template, not the raw path, to keep the series bounded
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            elapsed,
+            method=request.method,
+            route=route.path if route else "unmatched",
+            status=status,
+        )
+
+    if LOOP_BLOCK_FAIL_MS:
+        stalls = [
+            stall
+            for stall in monitor.stalls_between(start, start + elapsed)
+            if stall.seconds * 1000 > LOOP_BLOCK_FAIL_MS
+        ]
+        # only the request that blocked the loop fails, the others it held up
+        # are logged so the report points at the endpoint to fix
+        blocked = [stall for stall in stalls if stall.request == request_id]
+        for stall in stalls:
+            if stall.request == request_id:
+                continue
+            culprit = "outside a request"
+            if stall.request is not None:
+                culprit = f"request {stall.request}"
+            logger.warning(
+                f"{request.method} {request.url.path} was held up for "
+                f"{stall.seconds * 1000:.0f}ms by an event loop stall in {culprit}"
+            )
+        if blocked:
+            worst = max(blocked, key=lambda stall: stall.seconds)
+            logger.error(
+                f"{request.method} {request.url.path} (request {request_id}) "
+                f"blocked the event loop for {worst.seconds * 1000:.0f}ms"
+            )
+            return JSONResponse(
+                status_code=500,
+                content={
+                    "detail": f"Event loop blocked for {worst.seconds * 1000:.0f}ms"
+                    f", over LOOP_BLOCK_FAIL_MS={LOOP_BLOCK_FAIL_MS:.0f}",
+                    "stack": worst.stack,
+                },
+            )
+
+    stages["total"] = elapsed
+    response.headers["Server-Timing"] = metrics.server_timing(stages)
+    return response
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
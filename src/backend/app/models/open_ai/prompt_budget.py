@@ -0,0 +1,133 @@
+"""
+Assemble document text for extraction prompts within a token budget. Pages are
+cleaned of boilerplate that repeats on every page of a record, then packed in
+order until the budget of the extractor is used up.
+"""
+
+import logging
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import List
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# document tokens allowed in the prompt of each extractor, keyed by the name of
+# the response schema. metadata is almost always in the header of the note.
+EXTRACTOR_TOKEN_BUDGETS = {
+    "Perscriptions": int(os.getenv("PERSCRIPTION_TOKEN_BUDGET", 6000)),
+    "AppointmentMeta": int(os.getenv("METADATA_TOKEN_BUDGET", 2000)),
+    "FollowUps": int(os.getenv("FOLLOWUP_TOKEN_BUDGET", 6000)),
+    "Summary": int(os.getenv("SUMMARY_TOKEN_BUDGET", 8000)),
+}
+DEFAULT_TOKEN_BUDGET = 6000
+FALLBACK_ENCODING = "o200k_base"
+
+PAGE_NUMBER_RE = re.compile(r"^(page\s*)?\d+(\s*(of|/)\s*\d+)?$", re.IGNORECASE)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def _normalize(line: str) -> str:
+    return " ".join(line.split()).lower()
+
+
+def strip_boilerplate(pages: List[str]) -> List[str]:
+    """
+    Remove page numbers, blank lines and runs of whitespace from each page. For
+    records of three or more pages, lines found on more than half of the pages
+    (letterheads, fax banners, confidentiality footers) are removed as well,
+    except for their first occurrence since the letterhead on the first page
+    is often the only place the provider is named.
+    """
+    repeated = set()
+    if len(pages) >= 3:
+        line_counts = Counter(
+            line
+            for page in pages
+            for line in {_normalize(line) for line in page.splitlines()}
+        )
+        repeated = {line for line, n in line_counts.items() if n > len(pages) / 2}
+
+    cleaned = []
+    seen = set()
+    for page in pages:
+        lines = []
+        for line in page.splitlines():
+            normalized = _normalize(line)
+            if not normalized or PAGE_NUMBER_RE.match(normalized):
+                continue
+            if normalized in repeated:
+                if normalized in seen:
+                    continue
+                seen.add(normalized)
+            lines.append(" ".join(line.split()))
+        cleaned.append("\n".join(lines))
+    return cleaned
+
+
+def pack_context(pages: List[str], budget: int, model: str = "gpt-4o") -> str:
+    """
+    Join pages in order until the token budget is used. The page that crosses
+    the budget is cut at the token boundary and the rest are dropped.
+    """
+    encoding = get_encoding(model)
+    packed, used = [], 0
+    for i, page in enumerate(pages):
+        tokens = encoding.encode(page, disallowed_special=())
+        if used + len(tokens) > budget:
+            if remaining := budget - used:
+                packed.append(encoding.decode(tokens[:remaining]))
+            logger.debug(
+                f"Context truncated to {budget} tokens, dropped {len(pages) - i - 1} "
+                f"of {len(pages)} pages"
+            )
+            break
+        packed.append(page)
+        used += len(tokens)
+
+    return "\n\n".join(packed)
+
+
+def split_into_chunks(
+    pages: List[str], max_tokens: int, model: str = "gpt-4o"
+) -> List[str]:
+    """
+    Group consecutive pages into chunks of at most max_tokens. Pages that are
+    larger than a chunk on their own are split at token boundaries.
+    """
+    encoding = get_encoding(model)
+    pieces = []
+    for page in pages:
+        tokens = encoding.encode(page, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            pieces.append((page, len(tokens)))
+            continue
+        for start in range(0, len(tokens), max_tokens):
+            piece = tokens[start : start + max_tokens]
+            pieces.append((encoding.decode(piece), len(piece)))
+
+    chunks, current, used = [], [], 0
+    for text, n_tokens in pieces:
+        if current and used + n_tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, used = [], 0
+        current.append(text)
+        used += n_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+
+    return chunks
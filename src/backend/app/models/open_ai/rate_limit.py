@@ -0,0 +1,327 @@
+"""
+Rate limiting and retries for the OpenAI API. Requests per minute and tokens per
+minute are tracked in token buckets stored in redis, so every worker process
+draws from the same provider limit. On top of that an AIMD limiter adapts the
+number of concurrent requests, backing off when the provider starts throttling.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, Callable
+
+import aioredis
+import openai
+from openai import AsyncOpenAI
+
+from ...utils.metrics import external_call
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", 30000))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", 1))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 48))
+# above the scheduler's class budgets combined (16 interactive + 4 batch), so
+# the limit only holds requests back once the provider has throttled
+OPENAI_INITIAL_CONCURRENCY = int(os.getenv("OPENAI_INITIAL_CONCURRENCY", 24))
+# most of the limit batch requests may hold, the rest is kept for interactive
+OPENAI_BATCH_SHARE = float(os.getenv("OPENAI_BATCH_SHARE", 0.5))
+
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 30.0  # seconds
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+REQUEST_BUCKET_KEY = "openai:bucket:requests"
+TOKEN_BUCKET_KEY = "openai:bucket:tokens"
+
+# Refill both buckets for the time elapsed since they were last touched, then
+# take the requested amounts only if both can cover them. Returns how many ms
+# to wait before trying again, 0 if the request was admitted. Negative amounts
+# hand back tokens that were reserved but not used.
+TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) * 1000 + math.floor(tonumber(now_parts[2]) / 1000)
+local rpm, tpm = tonumber(ARGV[1]), tonumber(ARGV[2])
+local requests, tokens = tonumber(ARGV[3]), math.min(tonumber(ARGV[4]), tpm)
+
+local function refill(key, capacity)
+    local state = redis.call('HMGET', key, 'level', 'ts')
+    local level = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    return math.min(capacity, level + (now - ts) * capacity / 60000)
+end
+
+local request_level = refill(KEYS[1], rpm)
+local token_level = refill(KEYS[2], tpm)
+local wait = 0
+if request_level >= requests and token_level >= tokens then
+    request_level = math.min(rpm, request_level - requests)
+    token_level = math.min(tpm, token_level - tokens)
+else
+    wait = math.max(
+        (requests - request_level) * 60000 / rpm,
+        (tokens - token_level) * 60000 / tpm
+    )
+end
+
+redis.call('HSET', KEYS[1], 'level', request_level, 'ts', now)
+redis.call('HSET', KEYS[2], 'level', token_level, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], 120000)
+redis.call('PEXPIRE', KEYS[2], 120000)
+return math.ceil(wait)
+"""
+
+
+class RedisTokenBucket:
+    """
+    Requests per minute and tokens per minute buckets shared across processes.
+    If redis can't be reached requests are let through rather than failing.
+    """
+
+    def __init__(
+        self,
+        redis_url: str = REDIS_URL,
+        requests_per_minute: int = OPENAI_RPM,
+        tokens_per_minute: int = OPENAI_TPM,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._redis = aioredis.from_url(redis_url)
+        self._script = self._redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def acquire(self, tokens: int) -> None:
+        """Wait until both buckets can cover one request of the given size."""
+        while True:
+            wait_ms = await self._call(requests=1, tokens=tokens)
+            if wait_ms <= 0:
+                return
+            # jitter so waiting processes don't retry in lockstep
+            await asyncio.sleep(wait_ms / 1000 * random.uniform(1.0, 1.2))
+
+    async def refund(self, tokens: int) -> None:
+        """Return tokens that were reserved for a request but not used."""
+        if tokens > 0:
+            await self._call(requests=0, tokens=-tokens)
+
+    async def _call(self, requests: int, tokens: int) -> int:
+        try:
+            with external_call("redis", "token_bucket"):
+                wait_ms = await self._script(
+                    keys=[REQUEST_BUCKET_KEY, TOKEN_BUCKET_KEY],
+                    args=[
+                        self.requests_per_minute,
+                        self.tokens_per_minute,
+                        requests,
+                        tokens,
+                    ],
+                )
+            return int(wait_ms)
+        except aioredis.RedisError as e:
+            logger.warning(f"Rate limiter unavailable, skipping with error {str(e)}")
+            return 0
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit. Every successful request raises the limit by about
+    one per round trip of the whole window, every throttled request cuts it by
+    a constant factor (at most once per cooldown so a burst of 429s from the
+    same window only counts once).
+
+    The limit is shared with the scheduler's priority order: batch requests
+    only take a slot when no interactive request is waiting for one, and never
+    more than batch_share of the limit, so a backfill can't hold every slot
+    when throttling shrinks the limit.
+    """
+
+    def __init__(
+        self,
+        initial: int = OPENAI_INITIAL_CONCURRENCY,
+        min_limit: int = OPENAI_MIN_CONCURRENCY,
+        max_limit: int = OPENAI_MAX_CONCURRENCY,
+        decrease_factor: float = 0.5,
+        cooldown: float = 1.0,
+        batch_share: float = OPENAI_BATCH_SHARE,
+    ):
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.batch_share = batch_share
+        self.in_flight = 0
+        self.batch_in_flight = 0
+        self.interactive_waiting = 0
+        self._last_decrease = 0.0
+        self._condition: asyncio.Condition | None = None
+
+    def _admits(self, batch: bool) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        if not batch:
+            return True
+        batch_limit = max(1, int(self.limit * self.batch_share))
+        return self.interactive_waiting == 0 and self.batch_in_flight < batch_limit
+
+    @asynccontextmanager
+    async def slot(self, batch: bool = False):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if not batch:
+                self.interactive_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self._admits(batch))
+            finally:
+                if not batch:
+                    self.interactive_waiting -= 1
+                    # batch requests held back by this one may go now
+                    self._condition.notify_all()
+            self.in_flight += 1
+            self.batch_in_flight += batch
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self.batch_in_flight -= batch
+                self._condition.notify_all()
+
+    def on_success(self) -> None:
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_throttle(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease >= self.cooldown:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self._last_decrease = now
+            logger.info(f"OpenAI throttled, concurrency limit now {int(self.limit)}")
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.APIConnectionError):  # includes timeouts
+        return True
+    return (
+        isinstance(error, openai.APIStatusError)
+        and error.status_code in RETRYABLE_STATUS
+    )
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Seconds to wait before the next attempt. Uses full jitter exponential
+    backoff, but never retries sooner than the provider asked us to.
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+    response = getattr(error, "response", None)
+    if response is None:
+        return delay
+
+    retry_after = None
+    if retry_after_ms := response.headers.get("retry-after-ms"):
+        retry_after = float(retry_after_ms) / 1000
+    elif retry_after_s := response.headers.get("retry-after"):
+        try:
+            retry_after = float(retry_after_s)
+        except ValueError:
+            pass  # http dates are not sent by openai
+
+    return max(delay, retry_after or 0.0)
+
+
+class RateLimitedClient:
+    """
+    Wraps an AsyncOpenAI client so every chat completion goes through the
+    shared token buckets and adaptive concurrency limit, and is retried on
+    throttling and server errors.
+    """
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        bucket: RedisTokenBucket,
+        concurrency: AdaptiveConcurrency,
+        max_retries: int = OPENAI_MAX_RETRIES,
+    ):
+        # retries are handled here so the client must not retry on its own
+        self._client = client.with_options(max_retries=0)
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+    async def create_chat_completion(
+        self,
+        estimated_tokens: int,
+        on_send: Callable[[], None] | None = None,
+        on_done: Callable[[], None] | None = None,
+        batch: bool = False,
+        **kwargs: Any,
+    ):
+        """
+        Create a chat completion. on_send and on_done are called around every
+        HTTP attempt, so callers can time the API without the waits on the
+        token buckets, the concurrency limit and backoff. Batch requests yield
+        the concurrency limit to interactive ones.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire(estimated_tokens)
+            try:
+                async with self.concurrency.slot(batch):
+                    if on_send:
+                        on_send()
+                    try:
+                        with external_call("openai", "chat.completions"):
+                            response = await self._client.chat.completions.create(
+                                **kwargs
+                            )
+                    finally:
+                        if on_done:
+                            on_done()
+            except Exception as e:
+                await self.bucket.refund(estimated_tokens)
+                if getattr(e, "status_code", None) == 429:
+                    self.concurrency.on_throttle()
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = retry_delay(e, attempt)
+                logger.warning(
+                    f"OpenAI request failed with {type(e).__name__}, "
+                    f"retrying in {delay:.2f}s (attempt {attempt + 1})"
+                )
+                await asyncio.sleep(delay)
+                continue
+
+            self.concurrency.on_success()
+            if response.usage:
+                await self.bucket.refund(estimated_tokens - response.usage.total_tokens)
+            return response
+
+
+def call_with_retries(
+    fn: Callable[..., Any], max_retries: int = OPENAI_MAX_RETRIES, **kwargs: Any
+) -> Any:
+    """Blocking counterpart of RateLimitedClient for the synchronous client."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(**kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt == max_retries:
+                raise
+            time.sleep(retry_delay(e, attempt))
+
+
+bucket = RedisTokenBucket()
+concurrency = AdaptiveConcurrency()
+
+
+@lru_cache(maxsize=None)
+def rate_limited(client: AsyncOpenAI) -> RateLimitedClient:
+    """Wrap a client with the limits shared by every request from this process."""
+    return RateLimitedClient(client, bucket, concurrency)
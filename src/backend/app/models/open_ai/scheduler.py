@@ -0,0 +1,206 @@
+"""
+A scheduler in front of the OpenAI API so interactive requests are not starved
+by batch work. Every priority class has its own concurrency budget and within a
+class requests are dispatched with start time fair queuing across users, so one
+user with a large backlog can't monopolize the class either.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Dict, Hashable, Type
+
+from openai import AsyncOpenAI
+from pydantic import BaseModel
+
+from ...utils.metrics import LLM_QUEUE_WAIT_SECONDS
+from .utils import OAIRequest, a_send_rqt
+
+
+class Priority(str, Enum):
+    INTERACTIVE = "interactive"
+    BATCH = "batch"
+
+
+DEFAULT_CONCURRENCY = {
+    Priority.INTERACTIVE: int(os.getenv("LLM_INTERACTIVE_CONCURRENCY", 16)),
+    Priority.BATCH: int(os.getenv("LLM_BATCH_CONCURRENCY", 4)),
+}
+WAIT_SAMPLES = 1000
+MAX_TRACKED_USERS = 10000
+
+
+@dataclass(order=True)
+class _Waiter:
+    start_tag: float
+    seq: int
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+
+
+@dataclass
+class _PriorityClass:
+    priority: Priority
+    concurrency: int
+    in_flight: int = 0
+    virtual_time: float = 0.0
+    queue: list = field(default_factory=list)
+    finish_tags: Dict[Hashable, float] = field(default_factory=dict)
+    waits: deque = field(default_factory=lambda: deque(maxlen=WAIT_SAMPLES))
+    requests: int = 0
+
+
+class LLMScheduler:
+    """
+    Schedule requests to the OpenAI API by priority class and user.
+
+    Parameters
+    ----------
+    concurrency : Dict[Priority, int]
+        Number of requests each priority class may have in flight at once
+    """
+
+    def __init__(self, concurrency: Dict[Priority, int] | None = None):
+        concurrency = concurrency or DEFAULT_CONCURRENCY
+        self._classes = {
+            priority: _PriorityClass(priority=priority, concurrency=limit)
+            for priority, limit in concurrency.items()
+        }
+        self._seq = itertools.count()
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        priority: Priority = Priority.INTERACTIVE,
+        user_id: Hashable | None = None,
+        weight: float = 1.0,
+        cost: float = 1.0,
+    ):
+        """
+        Wait for a slot in the given priority class. A users requests are
+        spaced out by cost / weight in virtual time, so users with a higher
+        weight get a proportionally larger share of the class when it is busy.
+        """
+        priority_class = self._classes[priority]
+        await self._acquire(priority_class, user_id, weight, cost)
+        try:
+            yield
+        finally:
+            self._release(priority_class)
+
+    async def send(
+        self,
+        client: AsyncOpenAI,
+        rqt: OAIRequest,
+        priority: Priority = Priority.INTERACTIVE,
+        user_id: Hashable | None = None,
+        weight: float = 1.0,
+        **kwargs: Any,
+    ) -> Type[BaseModel] | str:
+        """
+        Send a request to the OpenAI API once the scheduler grants a slot. Batch
+        requests are never hedged, nobody waits on them and a hedge would take
+        rate limit budget from interactive requests, and they give way to
+        interactive requests for the adaptive concurrency limit below too.
+        """
+        if priority == Priority.BATCH:
+            rqt = rqt.model_copy(update={"hedge": False, "batch": True})
+        async with self.slot(priority, user_id, weight):
+            return await a_send_rqt(client, rqt, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Queue depth, in flight requests and queue wait times per class."""
+        stats = {}
+        for priority, priority_class in self._classes.items():
+            waits = sorted(priority_class.waits)
+            stats[priority.value] = {
+                "concurrency": priority_class.concurrency,
+                "in_flight": priority_class.in_flight,
+                "queued": len(priority_class.queue),
+                "requests": priority_class.requests,
+                "wait_p50_ms": _percentile(waits, 0.5) * 1000,
+                "wait_p95_ms": _percentile(waits, 0.95) * 1000,
+                "wait_max_ms": (waits[-1] if waits else 0.0) * 1000,
+            }
+        return stats
+
+    async def _acquire(
+        self,
+        priority_class: _PriorityClass,
+        user_id: Hashable | None,
+        weight: float,
+        cost: float,
+    ) -> None:
+        # start time fair queuing: a request starts no earlier than the current
+        # virtual time or the finish of the same users previous request
+        start_tag = max(
+            priority_class.virtual_time, priority_class.finish_tags.get(user_id, 0.0)
+        )
+        priority_class.finish_tags[user_id] = start_tag + cost / weight
+        priority_class.requests += 1
+        enqueued_at = time.monotonic()
+
+        if (
+            priority_class.in_flight < priority_class.concurrency
+            and not priority_class.queue
+        ):
+            priority_class.in_flight += 1
+            priority_class.virtual_time = start_tag
+            self._record_wait(priority_class, 0.0)
+            return
+
+        waiter = _Waiter(
+            start_tag=start_tag,
+            seq=next(self._seq),
+            future=asyncio.get_running_loop().create_future(),
+            enqueued_at=enqueued_at,
+        )
+        heapq.heappush(priority_class.queue, waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # the slot may have been granted right before we were cancelled
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(priority_class)
+            raise
+
+    @staticmethod
+    def _record_wait(priority_class: _PriorityClass, wait: float) -> None:
+        priority_class.waits.append(wait)
+        LLM_QUEUE_WAIT_SECONDS.observe(wait, priority=priority_class.priority.value)
+
+    def _release(self, priority_class: _PriorityClass) -> None:
+        priority_class.in_flight -= 1
+        while priority_class.queue and (
+            priority_class.in_flight < priority_class.concurrency
+        ):
+            waiter = heapq.heappop(priority_class.queue)
+            if waiter.future.done():
+                continue  # the caller was cancelled while queued
+            priority_class.in_flight += 1
+            priority_class.virtual_time = waiter.start_tag
+            self._record_wait(priority_class, time.monotonic() - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+        if len(priority_class.finish_tags) > MAX_TRACKED_USERS:
+            # users whose last request finished in virtual time no longer matter
+            priority_class.finish_tags = {
+                user_id: finish_tag
+                for user_id, finish_tag in priority_class.finish_tags.items()
+                if finish_tag > priority_class.virtual_time
+            }
+
+
+def _percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+scheduler = LLMScheduler()
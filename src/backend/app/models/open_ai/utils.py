@@ -1,12 +1,25 @@
+import asyncio
 import logging
+import os
 import sys
+import time
+from collections import defaultdict, deque
 from typing import Any, Dict, Type
 
 from openai import AsyncOpenAI, OpenAI
 from pydantic import BaseModel, Field
 
+from ...utils.metrics import LLM_TOKENS, PROMPT_TOKENS
+from .rate_limit import call_with_retries, rate_limited
+
 logger = logging.getLogger(__name__)
 
+# point at a local stand in for the API, e.g. benchmarks/openai_stub.py
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 0.95))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+LATENCY_SAMPLES = 500
+
 
 class OAIRequest(BaseModel):
     """A model to represent a given request to the OpenAI API."""
@@ -34,10 +47,82 @@ class OAIRequest(BaseModel):
         default=None, description="Parameter to force tool choices."
     )
 
+    # latency controls
+    deadline: float | None = Field(
+        default=None, description="Seconds to wait for a response before giving up."
+    )
+    hedge: bool = Field(
+        default=True,
+        description="Send a second request if the first is slower than usual.",
+    )
+    hedge_model: str | None = Field(
+        default=None,
+        description="Model to use for the hedge request, e.g. gpt-4o-mini.",
+    )
+    batch: bool = Field(
+        default=False,
+        description="Background work that yields the concurrency limit to users.",
+    )
+
+
+class LatencyTracker:
+    """Recent response latencies per model, used to decide when to hedge."""
+
+    def __init__(self, max_samples: int = LATENCY_SAMPLES):
+        self._latencies = defaultdict(lambda: deque(maxlen=max_samples))
+
+    def record(self, model: str, latency: float) -> None:
+        self._latencies[model].append(latency)
+
+    def percentile(self, model: str, q: float) -> float | None:
+        """The q-th latency percentile of a model, None until we have enough data."""
+        latencies = self._latencies[model]
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(latencies)
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+
+latency_tracker = LatencyTracker()
+
+
+class AttemptClock:
+    """
+    Start of the HTTP attempt a request is waiting on, None while it waits on
+    the rate limiter or backs off before a retry.
+    """
+
+    def __init__(self):
+        self.started: float | None = None
+        self.changed = asyncio.Event()
+
+    def start(self) -> None:
+        self.started = time.monotonic()
+        self.changed.set()
+
+    def stop(self) -> float:
+        """End the current attempt and return how long it took."""
+        latency = time.monotonic() - self.started
+        self.started = None
+        self.changed.set()
+        return latency
+
+
+def create_client() -> AsyncOpenAI:
+    """Create an async OpenAI client, using OPENAI_BASE_URL if it is set."""
+    return AsyncOpenAI(base_url=OPENAI_BASE_URL)
+
+
+def estimate_tokens(rqt: OAIRequest) -> int:
+    """Rough upper bound on the tokens a request uses, ~4 characters per token."""
+    prompt_chars = len(rqt.system_msg) + len(rqt.user_msg) + len(rqt.assistant_msg)
+    return prompt_chars // 4 + rqt.max_tokens
+
 
 def send_rqt(client: OpenAI, rqt: OAIRequest) -> Type[BaseModel]:
     """Extracts information from a given document using the OpenAI API."""
-    response = client.chat.completions.create(
+    response = call_with_retries(
+        client.with_options(max_retries=0).chat.completions.create,
         model=rqt.model,
         max_tokens=rqt.max_tokens,
         temperature=rqt.temperature,
@@ -60,9 +145,91 @@ def send_rqt(client: OpenAI, rqt: OAIRequest) -> Type[BaseModel]:
 async def a_send_rqt(
     client: AsyncOpenAI, rqt: OAIRequest, response_json: bool = True
 ) -> Type[BaseModel]:
-    """Extracts information from a given document using the OpenAI API."""
-    response = await client.chat.completions.create(
-        model=rqt.model,
+    """
+    Extracts information from a given document using the OpenAI API. If the
+    request takes longer than the usual tail latency of the model, a hedge
+    request is sent and whichever response arrives first is used. Raises
+    asyncio.TimeoutError if no response arrives within the request deadline.
+    """
+    response = _a_send_hedged(client, rqt, response_json)
+    if rqt.deadline is None:
+        return await response
+    return await asyncio.wait_for(response, rqt.deadline)
+
+
+async def _a_send_hedged(
+    client: AsyncOpenAI, rqt: OAIRequest, response_json: bool
+) -> Type[BaseModel]:
+    clock = AttemptClock()
+    primary = asyncio.create_task(_a_send(client, rqt, rqt.model, response_json, clock))
+    hedge = None
+    try:
+        hedge_after = latency_tracker.percentile(rqt.model, HEDGE_PERCENTILE)
+        if not rqt.hedge or hedge_after is None:
+            return await primary
+
+        # only hedge once a single attempt has been in flight for longer than
+        # usual, a request throttled by the rate limiter would just be
+        # throttled again and use up more of the budget
+        while True:
+            clock.changed.clear()
+            timeout = None
+            if clock.started is not None:
+                timeout = max(0.0, clock.started + hedge_after - time.monotonic())
+            changed = asyncio.create_task(clock.changed.wait())
+            done, _ = await asyncio.wait(
+                {primary, changed}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            changed.cancel()
+            if primary in done:
+                return primary.result()
+            if not done:
+                break
+
+        hedge_model = rqt.hedge_model or rqt.model
+        logger.info(
+            f"No response from {rqt.model} after {hedge_after:.2f}s, "
+            f"sending hedge request to {hedge_model}"
+        )
+        hedge = asyncio.create_task(_a_send(client, rqt, hedge_model, response_json))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+
+        # both requests failed, surface the error of the original request
+        return primary.result()
+
+    finally:
+        for task in (primary, hedge):
+            if task is not None:
+                task.cancel()
+
+
+async def _a_send(
+    client: AsyncOpenAI,
+    rqt: OAIRequest,
+    model: str,
+    response_json: bool,
+    clock: AttemptClock | None = None,
+) -> Type[BaseModel]:
+    clock = clock or AttemptClock()
+
+    def record() -> None:
+        # cancelled attempts are recorded too, otherwise the tracker would only
+        # ever see the requests that won a hedge and underestimate the tail
+        latency_tracker.record(model, clock.stop())
+
+    response = await rate_limited(client).create_chat_completion(
+        estimate_tokens(rqt),
+        on_send=clock.start,
+        on_done=record,
+        batch=rqt.batch,
+        model=model,
         max_tokens=rqt.max_tokens,
         temperature=rqt.temperature,
         stop=rqt.stop,
@@ -74,6 +241,20 @@ async def a_send_rqt(
         tools=rqt.tools,
         response_format={"type": "json_object"} if response_json else None,
     )
+    if response.usage:
+        request = rqt.response_schema.__name__ if rqt.response_schema else "text"
+        PROMPT_TOKENS.observe(
+            response.usage.prompt_tokens, model=model, request=request
+        )
+        LLM_TOKENS.inc(
+            response.usage.prompt_tokens, model=model, request=request, kind="prompt"
+        )
+        LLM_TOKENS.inc(
+            response.usage.completion_tokens,
+            model=model,
+            request=request,
+            kind="completion",
+        )
 
     if not rqt.response_schema:
         return response.choices[0].message.content
@@ -209,6 +209,21 @@ class ApptRqt(BaseModel):
     )
 
 
+class BatchRqt(BaseModel):
+    """The patient is the user the request is authenticated as."""
+
+    data_locations: List[str] = Field(
+        default=[], description="The s3 uris of the documents to analyze."
+    )
+    prefix: str | None = Field(
+        default=None,
+        description="An s3 key prefix to analyze every document under e.g. 1/pdf/",
+    )
+    job_id: str | None = Field(
+        default=None, description="The id of a previous job to resume."
+    )
+
+
 #### FOLLOW UP MODELS ####
 class TaskSpecialty(BaseModel):
     """A model to represent the correct specialty to book with given an associated follow up tasks"""
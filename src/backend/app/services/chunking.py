@@ -0,0 +1,130 @@
+"""
+Split document pages into chunks for the vector store. Chunks are built from
+whole sentences, or lines for the list-like parts of a note, up to a token
+budget and overlap by a few sentences so a fact that straddles a boundary is
+still retrievable. Every chunk records the page and character offset it starts
+at, so ids derived from text and metadata stay the same across re-ingestion.
+"""
+
+import logging
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Tuple
+
+from llama_index.core.schema import Document
+
+from ..models.open_ai.prompt_budget import count_tokens, get_encoding
+from ..utils.utils import create_hash_id
+
+logger = logging.getLogger(__name__)
+
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 256))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 32))
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])")
+
+
+@dataclass
+class Chunk:
+    text: str
+    metadata: Dict[str, Any]
+
+    @property
+    def id(self) -> str:
+        return create_hash_id(self.text, self.metadata)
+
+
+def _sentences(text: str) -> Iterator[Tuple[int, str]]:
+    """Sentences of a page with their character offset, a line is never merged."""
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        start = 0
+        for match in SENTENCE_END_RE.finditer(line):
+            yield offset + start, line[start : match.start()]
+            start = match.end()
+        yield offset + start, line[start:]
+        offset += len(line)
+
+
+def _split_long(
+    offset: int, sentence: str, max_tokens: int
+) -> Iterator[Tuple[int, str]]:
+    """Cut a sentence that alone is over the budget at token boundaries."""
+    encoding = get_encoding(EMBEDDING_MODEL)
+    tokens = encoding.encode(sentence, disallowed_special=())
+    for i in range(0, len(tokens), max_tokens):
+        piece = encoding.decode(tokens[i : i + max_tokens])
+        yield offset, piece
+        offset += len(piece)
+
+
+def chunk_text(
+    text: str, max_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS
+) -> List[Tuple[int, str]]:
+    """
+    Pack the sentences of a page into chunks of at most max_tokens, each
+    starting with up to overlap tokens of sentences from the end of the last one.
+
+    Returns
+    -------
+    List[Tuple[int, str]]
+        Character offset of each chunk in the page and its text
+    """
+    units: List[Tuple[int, str, int]] = []
+    for offset, sentence in _sentences(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        n_tokens = count_tokens(sentence, EMBEDDING_MODEL)
+        if n_tokens <= max_tokens:
+            units.append((offset, sentence, n_tokens))
+            continue
+        for piece_offset, piece in _split_long(offset, sentence, max_tokens):
+            units.append((piece_offset, piece, count_tokens(piece, EMBEDDING_MODEL)))
+
+    chunks: List[Tuple[int, str]] = []
+    current: List[Tuple[int, str, int]] = []
+    n_tokens = 0
+    for unit in units:
+        if current and n_tokens + unit[2] > max_tokens:
+            chunks.append((current[0][0], " ".join(u[1] for u in current)))
+            carried: List[Tuple[int, str, int]] = []
+            carried_tokens = 0
+            for previous in reversed(current):
+                if carried_tokens + previous[2] > overlap:
+                    break
+                carried.insert(0, previous)
+                carried_tokens += previous[2]
+            # the overlap and the next unit have to fit in one chunk
+            while carried and carried_tokens + unit[2] > max_tokens:
+                carried_tokens -= carried.pop(0)[2]
+            current, n_tokens = carried, carried_tokens
+        current.append(unit)
+        n_tokens += unit[2]
+    if current:
+        chunks.append((current[0][0], " ".join(u[1] for u in current)))
+    return chunks
+
+
+def chunk_documents(
+    documents: List[Document],
+    metadata: Dict[str, Any],
+    max_tokens: int = CHUNK_TOKENS,
+    overlap: int = CHUNK_OVERLAP_TOKENS,
+) -> List[Chunk]:
+    """
+    Chunk the pages of a document. Each chunk carries the metadata of the
+    document, e.g. user_id, provider_name and appointment_datetime, plus the page
+    and character offset it starts at.
+    """
+    # chroma only stores str, int, float and bool metadata
+    metadata = {k: v for k, v in metadata.items() if v is not None}
+    chunks = []
+    for i, document in enumerate(documents):
+        page = int(document.metadata.get("page_label", i + 1))
+        for offset, text in chunk_text(document.text, max_tokens, overlap):
+            chunks.append(Chunk(text, {**metadata, "page": page, "offset": offset}))
+    logger.debug(f"Split {len(documents)} pages into {len(chunks)} chunks")
+    return chunks
@@ -0,0 +1,189 @@
+"""
+Embedding service used by the vector store for both ingestion and queries.
+
+Texts are looked up in a cache keyed by a hash of the model and the text, so a
+chunk or query that was embedded before is never sent to the API again. Texts
+that miss are merged with those of other callers that arrive within a few
+milliseconds and sent in as few API requests as the batch size allows, so many
+concurrent chat queries or background ingests share round trips.
+"""
+
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Sequence
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from ..utils.metrics import CACHE_REQUESTS, Histogram, external_call
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache.sqlite3")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4))
+
+EMBEDDING_BATCH_TEXTS = Histogram(
+    "embedding_batch_texts",
+    "Texts sent per embeddings API request",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048),
+)
+
+
+class EmbeddingCache:
+    """
+    Embeddings on local disk in sqlite, shared by the workers on a host.
+
+    Parameters
+    ----------
+    path : str
+        sqlite database file, ":memory:" for a per process cache. Set
+        EMBEDDING_CACHE_PATH to an empty string to turn the cache off.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)"
+        )
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        found = {}
+        with self._lock:
+            # stay under sqlite's limit on query parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                rows = self._conn.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                )
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, vectors: Dict[str, List[float]]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                [
+                    (key, array("f", vector).tobytes())
+                    for key, vector in vectors.items()
+                ],
+            )
+
+
+@dataclass
+class _Request:
+    texts: List[str]
+    future: Future = field(default_factory=Future)
+
+
+class EmbeddingService(EmbeddingFunction[Documents]):
+    """
+    Cached, batched embeddings in front of another chroma embedding function.
+
+    Parameters
+    ----------
+    backend : EmbeddingFunction
+        Computes the embeddings of the texts that are not cached
+    model : str
+        Name of the backend model, part of the cache key
+    cache : EmbeddingCache | None
+        Where embeddings are kept, nothing is cached if None
+    batch_size : int
+        Most texts sent to the backend in one call
+    window : float
+        Seconds to wait for other callers before sending a batch
+    concurrency : int
+        Batches sent to the backend at the same time
+    """
+
+    def __init__(
+        self,
+        backend: EmbeddingFunction,
+        model: str,
+        cache: EmbeddingCache | None = None,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        window: float = EMBEDDING_BATCH_WINDOW_MS / 1000,
+        concurrency: int = EMBEDDING_CONCURRENCY,
+    ):
+        self.backend = backend
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size
+        self.window = window
+        self._queue: queue.Queue[_Request] = queue.Queue()
+        self._pool = ThreadPoolExecutor(concurrency, thread_name_prefix="embeddings")
+        self._dispatcher: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        keys = [self._key(text) for text in input]
+        vectors = self.cache.get_many(list(set(keys))) if self.cache else {}
+        hits = sum(key in vectors for key in keys)
+        CACHE_REQUESTS.inc(hits, cache="embeddings", result="hit")
+        CACHE_REQUESTS.inc(len(keys) - hits, cache="embeddings", result="miss")
+
+        missing = {key: text for key, text in zip(keys, input) if key not in vectors}
+        if missing:
+            request = _Request(list(missing.values()))
+            self._submit(request)
+            computed = dict(zip(missing, request.future.result()))
+            if self.cache:
+                self.cache.put_many(computed)
+            vectors.update(computed)
+        return [vectors[key] for key in keys]
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode()).hexdigest()
+
+    def _submit(self, request: _Request) -> None:
+        with self._lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(
+                    target=self._dispatch, name="embedding-batcher", daemon=True
+                )
+                self._dispatcher.start()
+        self._queue.put(request)
+
+    def _dispatch(self) -> None:
+        """Collect the requests that arrive within the window into one batch."""
+        while True:
+            requests = [self._queue.get()]
+            n_texts = len(requests[0].texts)
+            deadline = time.monotonic() + self.window
+            while n_texts < self.batch_size:
+                try:
+                    request = self._queue.get(timeout=deadline - time.monotonic())
+                except (queue.Empty, ValueError):
+                    break
+                requests.append(request)
+                n_texts += len(request.texts)
+            self._pool.submit(self._embed, requests)
+
+    def _embed(self, requests: List[_Request]) -> None:
+        texts = list(dict.fromkeys(text for r in requests for text in r.texts))
+        try:
+            vectors = {}
+            for i in range(0, len(texts), self.batch_size):
+                batch = texts[i : i + self.batch_size]
+                EMBEDDING_BATCH_TEXTS.observe(len(batch))
+                with external_call("embeddings", self.model):
+                    vectors.update(zip(batch, self.backend(batch)))
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        for request in requests:
+            request.future.set_result([vectors[text] for text in request.texts])
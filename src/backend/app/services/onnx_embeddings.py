@@ -0,0 +1,110 @@
+"""
+Local embedding backend running a BGE model with ONNX Runtime on CPU, so
+queries are embedded in process instead of paying a round trip to the
+embeddings API before retrieval starts.
+
+The model and tokenizer are downloaded from the Hugging Face hub on first use,
+or read from EMBEDDING_ONNX_PATH. Texts are sorted by length and padded per
+batch only to the longest text in it, and batches run on a thread pool since
+ONNX Runtime releases the GIL.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import onnxruntime as ort
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from huggingface_hub import snapshot_download
+from tokenizers import Tokenizer
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH")
+ONNX_BATCH_SIZE = int(os.getenv("ONNX_BATCH_SIZE", 32))
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", 2))
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", 2))
+MAX_LENGTH = 512
+
+
+class OnnxEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Embed texts with a BGE model exported to ONNX.
+
+    Parameters
+    ----------
+    model_name : str
+        Hugging Face repo of the model, e.g. BAAI/bge-small-en-v1.5
+    path : str | None
+        Directory with onnx/model.onnx and tokenizer.json, downloaded if None
+    batch_size : int
+        Texts run through the model at once
+    threads : int
+        Batches run at the same time
+    intra_op_threads : int
+        Threads ONNX Runtime uses within one batch
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        path: str | None = EMBEDDING_ONNX_PATH,
+        batch_size: int = ONNX_BATCH_SIZE,
+        threads: int = ONNX_THREADS,
+        intra_op_threads: int = ONNX_INTRA_OP_THREADS,
+    ):
+        if path is None:
+            path = snapshot_download(
+                model_name,
+                allow_patterns=["onnx/model.onnx", "tokenizer.json"],
+                token=os.getenv("HUGGINGFACE_API_KEY"),
+            )
+        model_dir = Path(path)
+
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(MAX_LENGTH)
+        self.tokenizer.enable_padding()
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            str(model_dir / "onnx" / "model.onnx"),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.batch_size = batch_size
+        self._pool = ThreadPoolExecutor(threads, thread_name_prefix="onnx")
+        logger.info(f"Loaded {model_name} for local embeddings from {model_dir}")
+
+    def __call__(self, input: Documents) -> Embeddings:
+        # similar lengths in a batch keep the padding short
+        order = sorted(range(len(input)), key=lambda i: len(input[i]))
+        batches = [
+            [input[i] for i in order[start : start + self.batch_size]]
+            for start in range(0, len(order), self.batch_size)
+        ]
+        vectors = np.concatenate(list(self._pool.map(self._embed, batches)))
+        result: List[List[float]] = [[]] * len(input)
+        for position, i in enumerate(order):
+            result[i] = vectors[position].tolist()
+        return result
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array(
+                [e.attention_mask for e in encodings], dtype=np.int64
+            ),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        inputs = {k: v for k, v in inputs.items() if k in self.input_names}
+        hidden = self.session.run(None, inputs)[0]
+        # BGE uses the CLS token as the sentence embedding
+        cls = hidden[:, 0]
+        return cls / np.linalg.norm(cls, axis=1, keepdims=True)
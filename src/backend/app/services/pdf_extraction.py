@@ -0,0 +1,277 @@
+"""
+Service to extract text from PDFs outside of the event loop. Parsing is CPU
+bound, so pages are split into ranges and parsed in parallel in a process pool.
+Results are handed back page by page so callers never need to hold an entire
+record as a single string.
+
+Workers are spawned rather than forked, so they start without the memory and
+the threads of the app process. A document is written to a temporary file once
+and each worker opens it from there, instead of every page range pickling the
+whole document over to its worker.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, AsyncIterator, Callable, List, Tuple
+
+from PyPDF2 import PdfReader
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+PDF_MAX_BYTES = int(os.getenv("PDF_MAX_BYTES", 25 * 1024 * 1024))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", 500))
+PDF_MAX_PAGE_CHARS = int(os.getenv("PDF_MAX_PAGE_CHARS", 100_000))
+PDF_WORKER_MEMORY_MB = int(os.getenv("PDF_WORKER_MEMORY_MB", 1024))
+PDF_TIMEOUT = float(os.getenv("PDF_TIMEOUT", 60))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", 8))
+# where documents are staged for the workers, e.g. /dev/shm to keep them in memory
+PDF_TMP_DIR = os.getenv("PDF_TMP_DIR")
+
+
+class PDFTooLargeError(ValueError):
+    """Raised when a document exceeds the configured size or page limits."""
+
+
+class PDFTimeoutError(TimeoutError):
+    """Raised when a document is not parsed within the configured timeout."""
+
+
+def _address_space() -> int:
+    """Bytes of address space the current process has mapped, 0 if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _limit_worker_memory(max_memory_mb: int) -> None:
+    """
+    Cap the address space a worker can add on top of what it started with, so a
+    malformed pdf cannot exhaust memory.
+    """
+    if resource is None or not max_memory_mb:
+        return
+    max_bytes = _address_space() + max_memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+# the reader of the document a worker parsed last, so the ranges of one
+# document that land on the same worker don't parse its structure again
+_reader: Tuple[str, PdfReader] | None = None
+
+
+def _open(path: str) -> PdfReader:
+    global _reader
+    if _reader is None or _reader[0] != path:
+        _reader = (path, PdfReader(path))
+    return _reader[1]
+
+
+def count_pages(path: str) -> int:
+    """Return the number of pages in a PDF. Runs in a worker process."""
+    return len(_open(path).pages)
+
+
+def extract_page_range(
+    path: str, start: int, end: int, max_chars: int
+) -> List[Tuple[int, str]]:
+    """
+    Extract the text of pages [start, end) of a PDF. Runs in a worker process.
+    Text beyond max_chars on a single page is dropped.
+    """
+    reader = _open(path)
+    return [
+        (page_number, (reader.pages[page_number].extract_text() or "")[:max_chars])
+        for page_number in range(start, end)
+    ]
+
+
+def _stage(content: bytes, directory: str | None) -> str:
+    with tempfile.NamedTemporaryFile(suffix=".pdf", dir=directory, delete=False) as f:
+        f.write(content)
+    return f.name
+
+
+class PDFExtractor:
+    """
+    Extract text from PDFs in a process pool.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes used for parsing
+    max_bytes : int
+        Largest document accepted, in bytes
+    max_pages : int
+        Largest number of pages accepted for a single document
+    max_page_chars : int
+        Text beyond this many characters on a single page is truncated
+    worker_memory_mb : int
+        Address space each worker process may add to what it starts with, in
+        megabytes
+    timeout : float
+        Seconds allowed to parse a single document
+    pages_per_task : int
+        Number of pages handed to a worker at a time
+    tmp_dir : str | None
+        Directory documents are staged in for the workers
+    """
+
+    def __init__(
+        self,
+        workers: int = PDF_WORKERS,
+        max_bytes: int = PDF_MAX_BYTES,
+        max_pages: int = PDF_MAX_PAGES,
+        max_page_chars: int = PDF_MAX_PAGE_CHARS,
+        worker_memory_mb: int = PDF_WORKER_MEMORY_MB,
+        timeout: float = PDF_TIMEOUT,
+        pages_per_task: int = PDF_PAGES_PER_TASK,
+        tmp_dir: str | None = PDF_TMP_DIR,
+    ):
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.max_page_chars = max_page_chars
+        self.worker_memory_mb = worker_memory_mb
+        self.timeout = timeout
+        self.pages_per_task = pages_per_task
+        self.tmp_dir = tmp_dir
+        self._pool: ProcessPoolExecutor | None = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                # forking would copy the address space and threads of the app
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_limit_worker_memory,
+                initargs=(self.worker_memory_mb,),
+            )
+        return self._pool
+
+    def check_size(self, size: int | None) -> None:
+        """Reject documents over the byte limit before they are read or parsed."""
+        if size is not None and size > self.max_bytes:
+            raise PDFTooLargeError(
+                f"Document is {size} bytes, the limit is {self.max_bytes} bytes"
+            )
+
+    async def iter_pages(self, content: bytes) -> AsyncIterator[Tuple[int, str]]:
+        """
+        Yield (page_number, text) for each page of the document in order.
+        Page ranges are parsed concurrently, with at most one range per worker
+        in flight ahead of the page currently being consumed.
+        """
+        self.check_size(len(content))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        path = await asyncio.to_thread(_stage, content, self.tmp_dir)
+        pending: List[asyncio.Task] = []
+        try:
+            n_pages = await self._run(deadline, count_pages, path)
+            if n_pages > self.max_pages:
+                raise PDFTooLargeError(
+                    f"Document has {n_pages} pages, the limit is {self.max_pages} pages"
+                )
+
+            ranges = [
+                (start, min(start + self.pages_per_task, n_pages))
+                for start in range(0, n_pages, self.pages_per_task)
+            ]
+            for i in range(len(ranges)):
+                # keep the pool busy without buffering the whole document
+                while len(pending) < self.workers and i + len(pending) < len(ranges):
+                    start, end = ranges[i + len(pending)]
+                    pending.append(
+                        asyncio.ensure_future(
+                            self._run(
+                                deadline,
+                                extract_page_range,
+                                path,
+                                start,
+                                end,
+                                self.max_page_chars,
+                            )
+                        )
+                    )
+                for page in await pending.pop(0):
+                    yield page
+        finally:
+            for task in pending:
+                task.cancel()
+            # ranges still running only fail to open the file
+            os.unlink(path)
+
+    async def extract_pages(self, content: bytes) -> List[str]:
+        """Extract the text of each page of a document."""
+        return [text async for _, text in self.iter_pages(content)]
+
+    async def _run(self, deadline: float, fn: Callable, *args: Any) -> Any:
+        """
+        Run fn in the pool before the deadline. If the pool was recycled because
+        of another document, the call is submitted again to the new pool.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            pool = self.pool
+            remaining = deadline - loop.time()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(pool, fn, *args), max(remaining, 0)
+                )
+            except BrokenProcessPool:
+                if pool is self._pool:
+                    # a worker died on this document, e.g. over its memory limit
+                    self._recycle(pool)
+                    raise
+                logger.info("Pdf worker pool was recycled, resubmitting")
+            except asyncio.TimeoutError:
+                logger.warning("Timed out parsing pdf, recycling the worker pool")
+                self._recycle(pool)
+                raise PDFTimeoutError(f"Document was not parsed within {self.timeout}s")
+
+    def _recycle(self, pool: ProcessPoolExecutor) -> None:
+        """
+        Kill the workers of a pool, so one stuck on a document doesn't keep
+        spinning, and start a fresh pool on next use. Work of other documents
+        queued on the old pool fails with BrokenProcessPool and is resubmitted.
+        """
+        if pool is not self._pool:
+            return
+        self._pool = None
+        _terminate_workers(pool)
+        pool.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        """Stop the workers, called when the app shuts down or reloads."""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            # a worker stuck on a document would otherwise outlive the app.
+            # before shutdown, which drops the executor's list of workers
+            _terminate_workers(pool)
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _terminate_workers(pool: ProcessPoolExecutor) -> None:
+    # the executor has no public way to stop a running call. _processes, a dict
+    # of pid to process, is private to CPython's ProcessPoolExecutor (3.8 to
+    # 3.13), if it is gone the workers are left to finish on their own
+    processes = getattr(pool, "_processes", None) or {}
+    for process in list(processes.values()):
+        process.terminate()
+
+
+pdf_extractor = PDFExtractor()
@@ -0,0 +1,302 @@
+"""
+Re-index the vector store into a new version of the collection without
+downtime. The job creates the next version, e.g. embedded with another backend
+or split into a different number of shards, and points the alias's "next" collection at it so load_documents writes every
+new document to both. It then copies the existing chunks over at a throttled
+rate, re-embedding them with the new model, while the old version keeps
+serving queries. Once everything is copied the alias is flipped in one update
+and get_context reads from the new version.
+
+Only one re-index runs at a time across all workers. The lock and the status of
+the last job are kept in redis, so any worker can report on a job another one
+started.
+
+The copied chunks are added to the lexical index too, which backfills it for
+chunks ingested before it existed.
+
+This is also how a store is migrated from a single collection to collections
+sharded by user, e.g.
+    python -m app.services.reindex --shards 16
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List
+
+import aioredis
+
+from ..db.lexical_index import LexicalIndex
+from ..db.vector_db import (
+    ALIAS_REFRESH_SECONDS,
+    EMBEDDING_BACKEND,
+    VECTOR_SHARDS,
+    VectorStore,
+    lexical_index,
+    shard_of,
+    vector_store,
+)
+from ..utils.metrics import external_call
+
+logger = logging.getLogger(__name__)
+
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", 100))
+REINDEX_RATE = float(os.getenv("REINDEX_RATE", 50))  # chunks per second
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+# the lock is refreshed while the job runs, so it outlives a crashed worker by
+# at most this long
+REINDEX_LOCK_EXPIRE = 60
+REINDEX_REPORT_SECONDS = 2
+REINDEX_STATUS_EXPIRE = 60 * 60 * 24 * 7
+
+REINDEX_LOCK_KEY = "reindex:lock"
+REINDEX_STATUS_KEY = "reindex:status"
+
+# delete the lock only if this job still holds it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+redis = aioredis.from_url(REDIS_URL)
+
+
+class ReindexRunning(Exception):
+    """Raised when a re-index is started while another one is running."""
+
+
+class ReindexJob:
+    """
+    Copy the chunks of the collection the alias points at into a new version.
+
+    Parameters
+    ----------
+    store : VectorStore
+        Store whose alias is re-indexed
+    backend : str
+        Embedding backend of the new version
+    shards : int
+        Shards the new version is split into, chunks are routed by user id
+    rate : float
+        Most chunks copied per second, to leave embedding and chroma capacity
+        for live traffic
+    batch_size : int
+        Chunks read and written at a time
+    flip : bool
+        Whether to point the alias at the new version when the copy is done
+    lexical : LexicalIndex | None
+        Lexical index the copied chunks are added to, None to leave it as is
+    """
+
+    def __init__(
+        self,
+        store: VectorStore = vector_store,
+        backend: str = EMBEDDING_BACKEND,
+        shards: int = VECTOR_SHARDS,
+        rate: float = REINDEX_RATE,
+        batch_size: int = REINDEX_BATCH_SIZE,
+        flip: bool = True,
+        lexical: LexicalIndex | None = lexical_index,
+    ):
+        self.store = store
+        self.backend = backend
+        self.shards = shards
+        self.rate = rate
+        self.batch_size = batch_size
+        self.flip = flip
+        self.lexical = lexical
+        self.job_id = str(uuid.uuid4())
+        self.state = "pending"
+        self.source: str | None = None
+        self.target: str | None = None
+        self.copied = 0
+        self.total = 0
+        self.error: str | None = None
+        self.started_at: float | None = None
+        self._locked = False
+
+    def status(self) -> Dict[str, Any]:
+        elapsed = time.time() - self.started_at if self.started_at else 0.0
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "backend": self.backend,
+            "shards": self.shards,
+            "source": self.source,
+            "target": self.target,
+            "copied": self.copied,
+            "total": self.total,
+            "elapsed_s": round(elapsed, 1),
+            "error": self.error,
+        }
+
+    async def acquire(self) -> None:
+        """Take the re-index lock, raises ReindexRunning if another job holds it."""
+        with external_call("redis", "set"):
+            async with redis.client() as redis_conn:
+                acquired = await redis_conn.set(
+                    REINDEX_LOCK_KEY, self.job_id, nx=True, ex=REINDEX_LOCK_EXPIRE
+                )
+        if not acquired:
+            raise ReindexRunning("A re-index is already running")
+        self._locked = True
+        await self._report()
+
+    async def run(self) -> None:
+        """
+        Run the job, taking the lock first unless acquire was called. The copy
+        runs on a thread, chroma's client is blocking, while the status is
+        written to redis every REINDEX_REPORT_SECONDS.
+        """
+        if not self._locked:
+            await self.acquire()
+        try:
+            self.started_at = time.time()
+            self.state = "running"
+            copy = asyncio.create_task(asyncio.to_thread(self._run))
+            while True:
+                done, _ = await asyncio.wait({copy}, timeout=REINDEX_REPORT_SECONDS)
+                if done:
+                    break
+                await self._report()
+            copy.result()
+            self.state = "done"
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            logger.exception(f"Re-index into {self.target} failed")
+            # stop the dual writes, the alias still points at the source
+            if self.source is not None:
+                await asyncio.to_thread(self.store.set_alias, self.source)
+        finally:
+            await self._report()
+            with external_call("redis", "eval"):
+                async with redis.client() as redis_conn:
+                    await redis_conn.eval(
+                        RELEASE_SCRIPT, 1, REINDEX_LOCK_KEY, self.job_id
+                    )
+            self._locked = False
+
+    async def _report(self) -> None:
+        with external_call("redis", "set"):
+            async with redis.client() as redis_conn:
+                await redis_conn.set(
+                    REINDEX_STATUS_KEY,
+                    json.dumps(self.status()),
+                    ex=REINDEX_STATUS_EXPIRE,
+                )
+                if self.state in ("pending", "running"):
+                    await redis_conn.expire(REINDEX_LOCK_KEY, REINDEX_LOCK_EXPIRE)
+
+    def _run(self) -> None:
+        self.source = self.store.collection_name
+        sources = self.store.collections(self.source)
+        self.target = self.store.create_version(self.backend, self.shards)
+        # from here on new documents are written to both collections
+        self.store.set_alias(self.source, next=self.target)
+        # wait for every worker to see the new alias, so no write that lands in
+        # the source after it has been copied misses the target
+        time.sleep(ALIAS_REFRESH_SECONDS)
+        targets = self.store.collections(self.target)
+        self.total = sum(source.count() for source in sources)
+        logger.info(
+            f"Re-indexing {self.total} chunks from {self.source} in {len(sources)} "
+            f"shards to {self.target} in {len(targets)}"
+        )
+
+        start = time.monotonic()
+        for source in sources:
+            offset = 0
+            while True:
+                batch = source.get(
+                    limit=self.batch_size,
+                    offset=offset,
+                    include=["documents", "metadatas"],
+                )
+                if not batch["ids"]:
+                    break
+                routed: Dict[int, List[int]] = defaultdict(list)
+                for i, metadata in enumerate(batch["metadatas"]):
+                    routed[shard_of(metadata.get("user_id"), len(targets))].append(i)
+                # upsert, chunks written by the dual writes meanwhile are the same
+                for shard, rows in routed.items():
+                    targets[shard].upsert(
+                        ids=[batch["ids"][i] for i in rows],
+                        documents=[batch["documents"][i] for i in rows],
+                        metadatas=[batch["metadatas"][i] for i in rows],
+                    )
+                if self.lexical is not None:
+                    self.lexical.add(
+                        batch["ids"], batch["documents"], batch["metadatas"]
+                    )
+                offset += len(batch["ids"])
+                self.copied += len(batch["ids"])
+                # throttle to the configured rate
+                ahead = self.copied / self.rate - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        n_source = sum(source.count() for source in sources)
+        n_target = sum(target.count() for target in targets)
+        if n_target < n_source:
+            raise RuntimeError(
+                f"{self.target} has {n_target} chunks, {self.source} has {n_source}"
+            )
+        if self.flip:
+            self.store.set_alias(self.target)
+            logger.info(f"Alias {self.store.alias} flipped to {self.target}")
+        else:
+            logger.info(f"Re-index into {self.target} done, writes still go to both")
+
+
+async def get_status() -> Dict[str, Any] | None:
+    """
+    Status of the last re-index started by any worker, None if there was none.
+    A job whose lock expired before it finished was stopped with its worker.
+    """
+    with external_call("redis", "mget"):
+        async with redis.client() as redis_conn:
+            status, lock = await redis_conn.mget(REINDEX_STATUS_KEY, REINDEX_LOCK_KEY)
+    if status is None:
+        return None
+    status = json.loads(status)
+    if status["state"] in ("pending", "running") and (
+        lock is None or lock.decode() != status["job_id"]
+    ):
+        status["state"] = "failed"
+        status["error"] = "The worker running the re-index stopped"
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-index the vector store into a new collection version."
+    )
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND)
+    parser.add_argument("--shards", type=int, default=VECTOR_SHARDS)
+    parser.add_argument("--rate", type=float, default=REINDEX_RATE)
+    parser.add_argument("--batch-size", type=int, default=REINDEX_BATCH_SIZE)
+    parser.add_argument(
+        "--no-flip", action="store_true", help="keep reading from the old version"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    job = ReindexJob(
+        backend=args.backend,
+        shards=args.shards,
+        rate=args.rate,
+        batch_size=args.batch_size,
+        flip=not args.no_flip,
+    )
+    asyncio.run(job.run())
+    print(json.dumps(job.status(), indent=2))
+    if job.state != "done":
+        raise SystemExit(1)
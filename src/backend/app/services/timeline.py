@@ -0,0 +1,157 @@
+"""
+Compact per-user medical timeline for grounding chat answers. Questions about
+current medications, the last visit with a doctor or pending follow-ups are
+answered from structured facts the analysis pipeline already stored in the
+appointment and prescriptions tables, instead of from retrieved note text.
+
+The timeline is materialized when a document is ingested or a prescription
+changes status and cached in redis, so chat reads one key per query. Users
+ingested before the timeline existed get theirs built on first read.
+"""
+
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List
+
+import aioredis
+from psycopg2.extensions import connection
+from pymongo.collection import Collection
+
+from ..db.nosql_db import get_providers_by_npi
+from ..db.relational_db import get_active_prescriptions, get_timeline_appointments
+from ..utils.metrics import external_call, record_cache, timer
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+# rebuilt on every ingest, the expiry only clears timelines of inactive users
+TIMELINE_EXPIRE = 60 * 60 * 24 * 30
+# most recent visits listed with their summary and follow ups
+TIMELINE_VISITS = int(os.getenv("TIMELINE_VISITS", 10))
+SUMMARY_CHARS = 200
+
+TIMELINE_KEY = "timeline:{}"
+
+redis = aioredis.from_url(REDIS_URL)
+
+
+def _date(value: datetime | None) -> str:
+    return f"{value:%Y-%m-%d}" if value else "unknown date"
+
+
+def format_timeline(
+    appointments: List[Dict[str, Any]],
+    prescriptions: List[Dict[str, Any]],
+    providers: Dict[str, Dict[str, Any]],
+    max_visits: int = TIMELINE_VISITS,
+) -> str:
+    """
+    Format the appointments, earliest first, and active prescriptions of a user
+    as a few short sections of text for the chat prompt.
+    """
+    if not appointments and not prescriptions:
+        return ""
+
+    def provider(npi: Any) -> str:
+        info = providers.get(str(npi))
+        if not info:
+            return f"provider {npi}"
+        name = f"{info['first_name']} {info['last_name']}"
+        specialties = info.get("specialties") or []
+        return f"{name} ({specialties[0]})" if specialties else name
+
+    visits = appointments[-max_visits:]
+    lines = [f"Visits ({len(visits)} most recent of {len(appointments)}):"]
+    for appt in visits:
+        summary = (appt["summary"] or "").strip()
+        if len(summary) > SUMMARY_CHARS:
+            summary = summary[:SUMMARY_CHARS].rsplit(" ", 1)[0] + "..."
+        line = f"- {_date(appt['appointment_datetime'])} with {provider(appt['provider_id'])}"
+        lines.append(f"{line}: {summary}" if summary else line)
+
+    # every provider seen, with the visit count and the last visit
+    seen: Dict[str, List[datetime | None]] = defaultdict(list)
+    for appt in appointments:
+        seen[str(appt["provider_id"])].append(appt["appointment_datetime"])
+    lines.append("Providers:")
+    for npi, dates in seen.items():
+        lines.append(
+            f"- {provider(npi)}: {len(dates)} visit{'s' if len(dates) > 1 else ''}, "
+            f"last on {_date(max(filter(None, dates), default=None))}"
+        )
+
+    lines.append("Active prescriptions:")
+    for drug in prescriptions:
+        lines.append(
+            f"- {drug['brand_name']} ({drug['technical_name']}): "
+            f"{drug['instructions'] or 'no instructions'}, prescribed "
+            f"{_date(drug['appointment_datetime'])} by {provider(drug['provider_id'])}"
+        )
+    if not prescriptions:
+        lines.append("- none")
+
+    lines.append("Follow ups from recent visits:")
+    n_follow_ups = len(lines)
+    for appt in visits:
+        for task in (appt["follow_ups"] or {}).get("tasks", []):
+            lines.append(
+                f"- {task['task']} (from {_date(appt['appointment_datetime'])} "
+                f"with {provider(appt['provider_id'])})"
+            )
+    if len(lines) == n_follow_ups:
+        lines.append("- none")
+    return "\n".join(lines)
+
+
+def build_timeline(conn: connection, collection: Collection, user_id: int) -> str:
+    """Read the timeline of a user from postgres and the providers in mongo."""
+    appointments = get_timeline_appointments(conn, user_id)
+    prescriptions = get_active_prescriptions(conn, user_id)
+    npis = {str(row["provider_id"]) for row in appointments + prescriptions}
+    with external_call("mongo", "find_providers"):
+        providers = get_providers_by_npi(collection, list(npis))
+    return format_timeline(appointments, prescriptions, providers)
+
+
+async def materialize_timeline(
+    conn: connection, collection: Collection, user_id: int
+) -> str:
+    """Build the timeline of a user and cache it."""
+    with timer("timeline_build"):
+        # psycopg2 and pymongo are blocking
+        timeline = await asyncio.to_thread(build_timeline, conn, collection, user_id)
+    with external_call("redis", "set"):
+        async with redis.client() as redis_conn:
+            await redis_conn.set(
+                TIMELINE_KEY.format(user_id), timeline, ex=TIMELINE_EXPIRE
+            )
+    return timeline
+
+
+async def refresh_timeline(
+    conn: connection, collection: Collection, user_id: int
+) -> None:
+    """Rebuild the cached timeline after the user's records changed."""
+    try:
+        # a stale timeline is never served, if the rebuild fails chat builds it
+        # on the next read
+        with external_call("redis", "delete"):
+            async with redis.client() as redis_conn:
+                await redis_conn.delete(TIMELINE_KEY.format(user_id))
+        await materialize_timeline(conn, collection, user_id)
+    except Exception as e:
+        logger.warning(f"Failed to refresh the timeline of user {user_id}: {e}")
+
+
+async def get_timeline(conn: connection, collection: Collection, user_id: int) -> str:
+    """The cached timeline of a user, built and cached on a miss."""
+    with external_call("redis", "get"):
+        async with redis.client() as redis_conn:
+            cached = await redis_conn.get(TIMELINE_KEY.format(user_id))
+    record_cache("timeline", cached is not None)
+    if cached is not None:
+        return cached.decode()
+    return await materialize_timeline(conn, collection, user_id)
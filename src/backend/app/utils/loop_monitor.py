@@ -0,0 +1,205 @@
+"""
+Event loop lag monitor. A heartbeat task sleeps for a fixed interval and
+measures how late it wakes up, which is how long the loop was kept from running
+callbacks, e.g. by a sync psycopg2, pymongo, boto3 or bcrypt call made straight
+from an async endpoint. The lag is exported as a metric.
+
+A watchdog thread notices when the heartbeat is overdue by more than the
+threshold and samples the stack of the loop thread while it is still blocked,
+so the log points at the line in the coroutine that holds up the loop rather
+than at whatever runs after it.
+
+Every task is tagged with the request it was created for, so a stall is
+attributed to the request whose code blocked the loop. With LOOP_BLOCK_FAIL_MS
+set, that request fails with a 500 naming the blocking stack, while requests
+that were only held up by it are logged. Use it when running the load test or
+exercising endpoints locally to keep new blocking calls out.
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Coroutine, Deque, List
+from weakref import WeakKeyDictionary
+
+from .metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_INTERVAL_MS = float(os.getenv("LOOP_LAG_INTERVAL_MS", 50))
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", 100))
+LOOP_BLOCK_FAIL_MS = float(os.getenv("LOOP_BLOCK_FAIL_MS", 0))
+
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds", "How late the event loop heartbeat last woke up"
+)
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_distribution_seconds",
+    "Distribution of event loop heartbeat lag",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+EVENT_LOOP_BLOCKS = Counter(
+    "event_loop_blocks_total", "Times the event loop was blocked past the threshold"
+)
+
+# id of the request being handled, set by the timing middleware. Tasks copy it
+# when they are created, so the tasks a request spawns carry its id too.
+current_request: contextvars.ContextVar[int | None] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+@dataclass
+class Stall:
+    start: float
+    end: float
+    stack: str = ""
+    # the request whose task was running when the stack was sampled
+    request: int | None = None
+
+    @property
+    def seconds(self) -> float:
+        return self.end - self.start
+
+
+class LoopMonitor:
+    """
+    Measure event loop lag and sample the stack of callbacks that block it.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds the heartbeat sleeps between measurements
+    threshold : float
+        Lag in seconds past which the loop counts as blocked
+    history : int
+        Number of recent stalls kept to check requests against
+    """
+
+    def __init__(
+        self,
+        interval: float = LOOP_LAG_INTERVAL_MS / 1000,
+        threshold: float = LOOP_LAG_THRESHOLD_MS / 1000,
+        history: int = 1000,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: Deque[Stall] = deque(maxlen=history)
+        self._last_tick = time.perf_counter()
+        self._sample: tuple[float, str, int | None] | None = None
+        # the request each task was created for, read by the watchdog thread,
+        # which can't see the context of another thread's task
+        self._task_requests: WeakKeyDictionary = WeakKeyDictionary()
+        self._previous_factory: Any = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._last_tick = time.perf_counter()
+        self._stop.clear()
+        self._previous_factory = self._loop.get_task_factory()
+        self._loop.set_task_factory(self._task_factory)
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-monitor")
+        threading.Thread(
+            target=self._watchdog, name="loop-watchdog", daemon=True
+        ).start()
+        logger.info(
+            f"Monitoring event loop lag every {self.interval * 1000:.0f}ms, "
+            f"blocking threshold {self.threshold * 1000:.0f}ms"
+        )
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._loop is not None:
+            self._loop.set_task_factory(self._previous_factory)
+
+    def _task_factory(
+        self, loop: asyncio.AbstractEventLoop, coro: Coroutine, **kwargs: Any
+    ) -> asyncio.Task:
+        if self._previous_factory is not None:
+            task = self._previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        request = context.get(current_request) if context else current_request.get()
+        if request is not None:
+            self._task_requests[task] = request
+        return task
+
+    async def _heartbeat(self) -> None:
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            self._last_tick = now
+            lag = max(0.0, now - before - self.interval)
+            EVENT_LOOP_LAG.set(lag)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            if lag <= self.threshold:
+                continue
+
+            EVENT_LOOP_BLOCKS.inc()
+            sample, self._sample = self._sample, None
+            if sample and sample[0] >= before:
+                self.stalls.append(Stall(now - lag, now, *sample[1:]))
+            else:
+                # blocked and released in between two watchdog checks
+                self.stalls.append(Stall(now - lag, now))
+                logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms")
+
+    def _watchdog(self) -> None:
+        """Runs in its own thread, the loop can't report on itself while blocked."""
+        sampled_tick = None
+        while not self._stop.wait(self.threshold / 2):
+            tick = self._last_tick
+            overdue = time.perf_counter() - tick - self.interval
+            if overdue <= self.threshold or tick == sampled_tick:
+                continue
+            sampled_tick = tick
+            task = asyncio.current_task(self._loop)
+            stack = self._stack(task)
+            self._sample = (time.perf_counter(), stack, self._task_requests.get(task))
+            logger.warning(
+                f"Event loop blocked for over {overdue * 1000:.0f}ms in\n{stack}"
+            )
+
+    def _stack(self, task: asyncio.Task | None) -> str:
+        frame = sys._current_frames().get(self._thread_id)
+        if frame is None:
+            return ""
+        frames = traceback.extract_stack(frame)
+        # drop the event loop machinery above the callback that is running
+        for i in range(len(frames) - 1, -1, -1):
+            if frames[i].filename == asyncio.events.__file__:
+                frames = frames[i + 1 :]
+                break
+        header = f"task {task.get_name()} {task.get_coro()!r}\n" if task else ""
+        return header + "".join(traceback.format_list(frames))
+
+    def stalls_between(self, start: float, end: float) -> List[Stall]:
+        """Stalls that overlapped the window from start to end, in perf_counter time."""
+        stalls = [s for s in self.stalls if s.start < end and s.end > start]
+        # the heartbeat may not have run yet after a block that just ended
+        pending = Stall(self._last_tick + self.interval, time.perf_counter())
+        if pending.seconds > self.threshold and pending.start < end:
+            if self._sample:
+                pending.stack, pending.request = self._sample[1:]
+            stalls.append(pending)
+        return stalls
+
+
+monitor = LoopMonitor()
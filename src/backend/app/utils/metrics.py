@@ -0,0 +1,273 @@
+"""
+Lightweight in-process metrics. Metrics are registered once at import time
+and updated from anywhere in the app with a set of label values, then served
+in the Prometheus text format from /metrics. Values are per process, so each
+worker is scraped on its own.
+
+Internal stages are timed with the timer context manager or timed decorator,
+calls to other services with external_call. Each of these also opens a tracing
+span. Stages timed while handling a request are collected for that request and
+returned to the client in a Server-Timing header.
+"""
+
+import bisect
+import functools
+import inspect
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from opentelemetry import trace
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+
+class Metric:
+    """Base class for metrics with a fixed set of label names."""
+
+    kind = ""
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. number of requests."""
+
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        with self._lock:
+            self.values[self._key(labels)] += amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. requests in flight."""
+
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        with self._lock:
+            self.values[self._key(labels)] += amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. latencies, in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: Dict[Tuple[str, ...], List[int]] = defaultdict(
+            lambda: [0] * (len(self.buckets) + 1)
+        )
+        self.sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self.counts[key][bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] += value
+
+
+REGISTRY: List[Metric] = []
+
+PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens",
+    "Prompt tokens sent per OpenAI call",
+    ("model", "request"),
+    buckets=TOKEN_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens used by OpenAI calls",
+    ("model", "request", "kind"),
+)
+LLM_QUEUE_WAIT_SECONDS = Histogram(
+    "llm_queue_wait_seconds",
+    "Time an OpenAI request waited for a slot in the LLM scheduler",
+    ("priority",),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to respond to an HTTP request",
+    ("method", "route", "status"),
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests currently being handled"
+)
+STAGE_SECONDS = Histogram(
+    "stage_duration_seconds",
+    "Time spent in an internal stage of request handling",
+    ("stage",),
+)
+EXTERNAL_CALL_SECONDS = Histogram(
+    "external_call_duration_seconds",
+    "Latency of calls to other services",
+    ("service", "operation", "outcome"),
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by result, the hit ratio is hit / (hit + miss)",
+    ("cache", "result"),
+)
+
+tracer = trace.get_tracer(__name__)
+
+# stage durations of the request being handled, shared with the tasks and
+# threads it starts since they copy the context
+_request_stages: ContextVar[Dict[str, float] | None] = ContextVar(
+    "request_stages", default=None
+)
+
+
+def start_request_timing() -> Dict[str, float]:
+    """Collect the stages timed from here on in the current context."""
+    stages: Dict[str, float] = defaultdict(float)
+    _request_stages.set(stages)
+    return stages
+
+
+def _add_request_stage(stage: str, seconds: float) -> None:
+    if (stages := _request_stages.get()) is not None:
+        stages[stage] += seconds
+
+
+@contextmanager
+def timer(stage: str) -> Iterator[None]:
+    """Time a block of code as an internal stage, e.g. with timer("db_write")."""
+    start = time.perf_counter()
+    try:
+        with tracer.start_as_current_span(stage):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        _add_request_stage(stage, elapsed)
+
+
+@contextmanager
+def external_call(service: str, operation: str = "") -> Iterator[None]:
+    """Time a call to another service, recording whether it failed."""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        with tracer.start_as_current_span(
+            f"{service} {operation}".strip(),
+            kind=trace.SpanKind.CLIENT,
+            attributes={"peer.service": service},
+        ):
+            yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        EXTERNAL_CALL_SECONDS.observe(
+            elapsed, service=service, operation=operation, outcome=outcome
+        )
+        _add_request_stage(service, elapsed)
+
+
+def timed(stage: str) -> Callable:
+    """Decorator form of timer, for both plain and async functions."""
+
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def server_timing(stages: Dict[str, float]) -> str:
+    """Format stage durations as a Server-Timing header value."""
+    return ", ".join(
+        f"{re.sub(r'[^A-Za-z0-9_-]', '_', stage)};dur={seconds * 1000:.1f}"
+        for stage, seconds in stages.items()
+    )
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        with metric._lock:
+            if isinstance(metric, Histogram):
+                for key, counts in metric.counts.items():
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                        cumulative += count
+                        labels = _labels(metric.labelnames, key, le=_format(bound))
+                        lines.append(f"{metric.name}_bucket{labels} {cumulative}")
+                    labels = _labels(metric.labelnames, key)
+                    lines.append(
+                        f"{metric.name}_sum{labels} {_format(metric.sums[key])}"
+                    )
+                    lines.append(f"{metric.name}_count{labels} {cumulative}")
+            else:
+                for key, value in metric.values.items():
+                    labels = _labels(metric.labelnames, key)
+                    lines.append(f"{metric.name}{labels} {_format(value)}")
+    return "\n".join(lines) + "\n"
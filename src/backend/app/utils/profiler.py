@@ -0,0 +1,196 @@
+"""
+Sampling profiler for a live worker. A background thread snapshots the stack of
+every thread at a fixed interval, and the await chain of every asyncio task,
+which is where a coroutine like analyze_appointment spends its time while it is
+suspended waiting on OpenAI or a database. Samples are aggregated into collapsed
+stacks for flamegraph.pl / speedscope, or written as speedscope JSON.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+
+Frame = Tuple[str, str, int]  # function, file, line
+Stack = Tuple[Frame, ...]  # root first
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+def _frame(frame: FrameType) -> Frame:
+    code = frame.f_code
+    return (code.co_name, code.co_filename, frame.f_lineno)
+
+
+def _thread_stack(frame: FrameType | None) -> Stack:
+    frames = []
+    while frame is not None:
+        frames.append(_frame(frame))
+        frame = frame.f_back
+    return tuple(reversed(frames))
+
+
+def _task_stack(task: asyncio.Task) -> Stack:
+    """The await chain of a task, from its outermost coroutine down."""
+    frames = []
+    coro: Any = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(_frame(frame))
+        awaiting = getattr(coro, "cr_await", None) or getattr(
+            coro, "gi_yieldfrom", None
+        )
+        if awaiting is not None and not (
+            hasattr(awaiting, "cr_frame") or hasattr(awaiting, "gi_frame")
+        ):
+            # a future or other awaitable, the task is waiting on it
+            frames.append((f"<{type(awaiting).__name__}>", "", 0))
+            break
+        coro = awaiting
+    return tuple(frames)
+
+
+class Profile:
+    """
+    Samples collected by the profiler, grouped by thread or "asyncio tasks".
+
+    Parameters
+    ----------
+    interval : float
+        Seconds between samples, each sample is weighted by it
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.duration = 0.0
+        self.samples: Dict[str, Counter] = {}
+
+    def add(self, group: str, stack: Stack) -> None:
+        if stack:
+            self.samples.setdefault(group, Counter())[stack] += 1
+
+    def collapsed(self) -> str:
+        """One "group;frame;frame count" line per distinct stack."""
+        lines = []
+        for group, stacks in self.samples.items():
+            for stack, count in stacks.most_common():
+                names = [group] + [_name(frame) for frame in stack]
+                names = [name.replace(";", ",") for name in names]
+                lines.append(f"{';'.join(names)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str = "wilson") -> Dict[str, Any]:
+        """The profile in the speedscope file format, one sampled profile per group."""
+        frames: List[Dict[str, Any]] = []
+        index: Dict[Frame, int] = {}
+        profiles = []
+        for group, stacks in self.samples.items():
+            samples, weights = [], []
+            for stack, count in stacks.most_common():
+                for frame in stack:
+                    if frame not in index:
+                        index[frame] = len(frames)
+                        frames.append(
+                            {"name": frame[0], "file": frame[1], "line": frame[2]}
+                        )
+                samples.append([index[frame] for frame in stack])
+                weights.append(count * self.interval)
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": group,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+            "name": name,
+            "exporter": "wilson",
+        }
+
+
+def _name(frame: Frame) -> str:
+    function, filename, line = frame
+    if not filename:
+        return function
+    return f"{function} ({os.path.basename(filename)}:{line})"
+
+
+_lock = threading.Lock()
+
+
+def sample(
+    seconds: float,
+    interval: float = 0.005,
+    loop: asyncio.AbstractEventLoop | None = None,
+) -> Profile:
+    """
+    Sample this process for the given number of seconds, blocking the caller.
+    Run it in a thread, e.g. with asyncio.to_thread, so the loop being profiled
+    keeps serving requests.
+
+    Parameters
+    ----------
+    seconds : float
+        How long to sample for
+    interval : float
+        Seconds between samples
+    loop : asyncio.AbstractEventLoop | None
+        Loop whose tasks are sampled as well, threads only if None
+    """
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already being taken")
+    try:
+        profile = Profile(interval)
+        me = threading.get_ident()
+        names: Dict[int, str] = {}
+        start = time.perf_counter()
+        deadline = start + seconds
+        while (now := time.perf_counter()) < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                if thread_id not in names:
+                    names.update(
+                        (thread.ident, f"thread {thread.name}")
+                        for thread in threading.enumerate()
+                    )
+                    names.setdefault(thread_id, f"thread {thread_id}")
+                profile.add(names[thread_id], _thread_stack(frame))
+            if loop is not None:
+                for task in _tasks(loop):
+                    profile.add("asyncio tasks", _task_stack(task))
+            time.sleep(max(0.0, interval - (time.perf_counter() - now)))
+        profile.duration = time.perf_counter() - start
+        return profile
+    finally:
+        _lock.release()
+
+
+def _tasks(loop: asyncio.AbstractEventLoop) -> List[asyncio.Task]:
+    # the task set can change under us while the loop runs in another thread
+    for _ in range(10):
+        try:
+            return [task for task in asyncio.all_tasks(loop) if not task.done()]
+        except RuntimeError:
+            continue
+    return []
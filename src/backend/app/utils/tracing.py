@@ -0,0 +1,116 @@
+"""
+OpenTelemetry tracing. Requests, database drivers, s3 and outgoing HTTP calls
+are traced by the OpenTelemetry instrumentations, and every stage timed with
+utils.metrics.timer or external_call gets its own span, so one trace covers
+the whole critical path of an upload. Work handed to BackgroundTasks is wrapped
+with in_background so it is traced as part of the request that scheduled it.
+
+Tracing is off unless TRACING_EXPORTER is set:
+    TRACING_EXPORTER=otlp   spans go to OTEL_EXPORTER_OTLP_ENDPOINT
+    TRACING_EXPORTER=file   spans are appended as json lines to TRACING_FILE
+"""
+
+import functools
+import inspect
+import logging
+import os
+from typing import Callable
+
+from dotenv import load_dotenv
+from fastapi import FastAPI
+from opentelemetry import context, trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.instrumentation.asyncpg import AsyncPGInstrumentor
+from opentelemetry.instrumentation.botocore import BotocoreInstrumentor
+from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
+from opentelemetry.instrumentation.pymongo import PymongoInstrumentor
+from opentelemetry.instrumentation.requests import RequestsInstrumentor
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none")
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+SERVICE = os.getenv("OTEL_SERVICE_NAME", "wilson-backend")
+
+tracer = trace.get_tracer(__name__)
+
+
+def setup_tracing() -> bool:
+    """
+    Configure the exporter and instrument the client libraries. Must run before
+    the endpoint modules are imported, they open their db connections and
+    clients at import and only those created afterwards are traced.
+    """
+    if TRACING_EXPORTER == "none":
+        return False
+
+    if TRACING_EXPORTER == "otlp":
+        exporter = OTLPSpanExporter()
+    elif TRACING_EXPORTER == "file":
+        exporter = ConsoleSpanExporter(
+            out=open(TRACING_FILE, "a"),
+            formatter=lambda span: span.to_json(indent=None) + os.linesep,
+        )
+    else:
+        raise ValueError(f"Unknown TRACING_EXPORTER {TRACING_EXPORTER}")
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: SERVICE}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+    Psycopg2Instrumentor().instrument(enable_commenter=False)
+    AsyncPGInstrumentor().instrument()
+    PymongoInstrumentor().instrument()
+    BotocoreInstrumentor().instrument()
+    RequestsInstrumentor().instrument()
+    HTTPXClientInstrumentor().instrument()  # OpenAI and chroma embedding calls
+    logger.info(f"Tracing enabled, exporting spans with {TRACING_EXPORTER}")
+    return True
+
+
+def instrument_app(app: FastAPI) -> None:
+    """Start a server span for every request, continuing incoming trace headers."""
+    if TRACING_EXPORTER != "none":
+        FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics")
+
+
+def in_background(fn: Callable, name: str | None = None) -> Callable:
+    """
+    Wrap a function passed to BackgroundTasks so it runs in a span that is a
+    child of the request which scheduled it. Background tasks run after the
+    response is sent, so without this slow writes would not show up in the
+    trace of the request that caused them.
+    """
+    parent = context.get_current()
+    span_name = f"background {name or fn.__name__}"
+
+    if inspect.iscoroutinefunction(fn):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            token = context.attach(parent)
+            try:
+                with tracer.start_as_current_span(span_name):
+                    return await fn(*args, **kwargs)
+            finally:
+                context.detach(token)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = context.attach(parent)
+        try:
+            with tracer.start_as_current_span(span_name):
+                return fn(*args, **kwargs)
+        finally:
+            context.detach(token)
+
+    return wrapper
@@ -0,0 +1,126 @@
+"""
+Microbenchmark of chat context assembly: structure_context against the pandas
+implementation it replaced, on synthetic query results of chroma's shape, plus
+the cost of importing pandas that the app no longer pays at startup.
+
+Run with e.g.
+    python -m benchmarks.context_assembly --chunks 10 --repeat 2000
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import timeit
+from collections import defaultdict
+from typing import Any, Dict
+
+import pandas as pd
+
+from app.db.vector_db import structure_context
+from app.models.open_ai.prompt_budget import count_tokens
+
+from .documents import synthetic_provider, synthetic_visit
+
+
+def legacy_structure_context(context: Dict[str, Any]) -> str:
+    """structure_context as it was before, built on a DataFrame."""
+    result_dict = defaultdict(list)
+    for i, doc in enumerate(context["documents"][0]):
+        metadata = context["metadatas"][0][i]
+        result_dict["provider_name"].append(metadata["provider_name"])
+        result_dict["appointment_date"].append(metadata["appointment_datetime"])
+        result_dict["context"].append(doc)
+
+    df = pd.DataFrame(result_dict)
+    df = (
+        df.assign(appointment_date=pd.to_datetime(df["appointment_date"]))
+        .groupby(["provider_name", "appointment_date"])["context"]
+        .agg(" ".join)
+        .reset_index()
+        .sort_values(by=["appointment_date"])
+    )
+    df["formatted_row"] = df.apply(
+        lambda x: f"{x['provider_name']}, {x['appointment_date']}:\n{x['context']}",
+        axis=1,
+    )
+    return "\n".join(df["formatted_row"].to_list())
+
+
+def synthetic_context(n_chunks: int, n_visits: int, seed: int = 0) -> Dict[str, Any]:
+    """
+    A query result with n_chunks chunks spread over n_visits appointments,
+    every third one a duplicate of the chunk before it.
+    """
+    rng = random.Random(seed)
+    visits = []
+    for i in range(n_visits):
+        provider = synthetic_provider(rng, 1000000001 + i, "Cardiology")
+        visit = synthetic_visit(rng, provider, 3)
+        visits.append((provider, visit))
+
+    documents, metadatas = [], []
+    for i in range(n_chunks):
+        provider, visit = rng.choice(visits)
+        lines = [line for line in visit["text"].splitlines() if line]
+        if documents and i % 3 == 2:
+            # the same passage ingested twice, e.g. from a re-uploaded file
+            documents.append(documents[-1])
+        else:
+            documents.append(" ".join(rng.sample(lines, min(4, len(lines)))))
+        metadatas.append(
+            {
+                "provider_name": f"{provider['first_name']} {provider['last_name']}",
+                "appointment_datetime": f"{visit['appointment_datetime']:%Y-%m-%d %H:%M}",
+                "page": 1,
+                "offset": i * 100,
+            }
+        )
+    return {"documents": [documents], "metadatas": [metadatas]}
+
+
+def import_seconds(module: str) -> float:
+    """Wall time of a fresh interpreter importing module, minus a bare one."""
+    timings = {}
+    for statement in (f"import {module}", "pass"):
+        timings[statement] = min(
+            timeit.repeat(
+                lambda: subprocess.run([sys.executable, "-c", statement], check=True),
+                number=1,
+                repeat=3,
+            )
+        )
+    return timings[f"import {module}"] - timings["pass"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark context assembly.")
+    parser.add_argument("--chunks", type=int, default=10)
+    parser.add_argument("--visits", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--output", help="write the results as json")
+    args = parser.parse_args()
+
+    context = synthetic_context(args.chunks, args.visits)
+    results = {}
+    for name, function in (
+        ("pandas", legacy_structure_context),
+        ("structure_context", structure_context),
+    ):
+        seconds = min(timeit.repeat(lambda: function(context), number=args.repeat))
+        results[name] = {
+            "us_per_call": seconds / args.repeat * 1e6,
+            "tokens": count_tokens(function(context)),
+        }
+    import_ms = import_seconds("pandas") * 1000
+
+    print(f"{'assembler':<20}{'us/call':>10}{'tokens':>10}")
+    for name, result in results.items():
+        print(f"{name:<20}{result['us_per_call']:>10.1f}{result['tokens']:>10}")
+    print(f"import pandas: {import_ms:.0f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"assemblers": results, "import_pandas_ms": import_ms}, f, indent=2
+            )
@@ -0,0 +1,147 @@
+"""
+Synthetic visit notes and a minimal PDF writer, so seeding and load tests don't
+depend on real patient records.
+"""
+
+import random
+import textwrap
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+# the user every load test logs in as
+BENCH_EMAIL = "bench@wilson.ai"
+BENCH_PASSWORD = "bench-password"
+
+FIRST_NAMES = ["Maria", "James", "Wei", "Aisha", "Carlos", "Emily", "Raj", "Olga"]
+LAST_NAMES = ["Garcia", "Smith", "Chen", "Khan", "Lopez", "Brown", "Patel", "Ivanova"]
+CLINICS = ["Hudson Medical Group", "Eastside Health", "Riverside Physicians"]
+DRUGS = [
+    ("Fluticasone", "Flonase", "One spray in each nostril once daily."),
+    ("Amoxicillin", "Augmentin", "Take a 500-mg tablet twice daily for 10 days."),
+    ("Ibuprofen", "Advil", "Take 400 mg every 6 hours as needed for pain."),
+    ("Lisinopril", "Zestril", "Take 10 mg once daily in the morning."),
+    ("Atorvastatin", "Lipitor", "Take 20 mg once daily at bedtime."),
+    ("Sertraline", "Zoloft", "Take 50 mg once daily."),
+]
+FOLLOW_UPS = [
+    "Follow up with primary care in 3 months.",
+    "Referral to ENT for chronic sinusitis.",
+    "Referral to sports medicine for lower back pain.",
+    "Schedule a sleep study.",
+    "Repeat lipid panel in 6 weeks.",
+    "Consult orthopedics for knee evaluation.",
+]
+FINDINGS = [
+    "Patient reports intermittent headaches over the past two weeks.",
+    "Blood pressure elevated at 142/91, repeat reading 138/88.",
+    "Mild tenderness over the lumbar spine, full range of motion.",
+    "Nasal mucosa inflamed with clear discharge, no fever.",
+    "Lungs clear to auscultation bilaterally, heart regular rate and rhythm.",
+    "Patient sleeping five hours a night and reports daytime fatigue.",
+]
+LINES_PER_PAGE = 48
+
+
+def synthetic_provider(rng: random.Random, npi: int, specialty: str) -> Dict:
+    return {
+        "npi": str(npi),
+        "first_name": rng.choice(FIRST_NAMES),
+        "last_name": rng.choice(LAST_NAMES),
+        "degree": rng.choice(["MD", "DO", "NP"]),
+        "specialty": specialty,
+    }
+
+
+def synthetic_visit(
+    rng: random.Random, provider: Dict[str, Any], n_paragraphs: int = 6
+) -> Dict[str, Any]:
+    """A visit note with the facts the analysis pipeline extracts from it."""
+    visit_date = datetime(2023, 1, 2, 8) + timedelta(
+        days=rng.randrange(600), minutes=15 * rng.randrange(36)
+    )
+    drugs = rng.sample(DRUGS, rng.randint(1, 3))
+    follow_ups = rng.sample(FOLLOW_UPS, rng.randint(1, 2))
+    clinic = rng.choice(CLINICS)
+
+    lines = [
+        clinic,
+        "CONFIDENTIAL - contains protected health information",
+        f"Provider: {provider['first_name']} {provider['last_name']}, "
+        f"{provider['degree']}",
+        f"NPI: {provider['npi']}    Specialty: {provider['specialty']}",
+        f"Date of service: {visit_date:%Y-%m-%d %H:%M}",
+        "",
+        "History and examination",
+    ]
+    for _ in range(n_paragraphs):
+        lines.append(" ".join(rng.choices(FINDINGS, k=4)))
+    lines += ["", "Medications"]
+    lines += [
+        f"{brand} ({name}): {instructions}" for name, brand, instructions in drugs
+    ]
+    lines += ["", "Plan"] + follow_ups
+
+    return {
+        "text": "\n".join(lines),
+        "appointment_datetime": visit_date,
+        "drugs": [
+            {"technical_name": name, "brand_name": brand, "instructions": instructions}
+            for name, brand, instructions in drugs
+        ],
+        "follow_ups": [{"task": task} for task in follow_ups],
+        "summary": " ".join(lines[7:9])[:300],
+    }
+
+
+def paginate(text: str, width: int = 90) -> List[str]:
+    """Wrap text to the page width and split it into pages."""
+    lines = []
+    for line in text.splitlines():
+        lines += textwrap.wrap(line, width) or [""]
+    return [
+        "\n".join(lines[i : i + LINES_PER_PAGE])
+        for i in range(0, len(lines), LINES_PER_PAGE)
+    ]
+
+
+def _escape(line: str) -> str:
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: List[str]) -> bytes:
+    """A text only PDF with one page per string, readable by PyPDF2."""
+    # object 1 is the catalog, 2 the page tree, 3 the font, then a page and
+    # its content stream for every page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for page in pages:
+        shown = " ".join(f"({_escape(line)}) '" for line in page.splitlines())
+        stream = f"BT /F1 10 Tf 14 TL 50 780 Td {shown} ET".encode("latin-1", "ignore")
+        page_id, content_id = len(objects) + 1, len(objects) + 2
+        kids.append(f"{page_id} 0 R")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> "
+            f"/Contents {content_id} 0 R >>".encode()
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>"
+    objects[1] = objects[1].encode()
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (i, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    pdf += b"startxref\n%d\n%%%%EOF\n" % xref
+    return bytes(pdf)
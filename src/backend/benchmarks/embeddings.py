@@ -0,0 +1,89 @@
+"""
+Per query latency and ingest throughput of the embedding backends. Queries are
+embedded one at a time, the way get_context embeds a chat query, and document
+chunks in batches through the embedding service with its cache turned off, the
+way load_documents ingests them.
+
+Run with e.g.
+    python -m benchmarks.embeddings --backends openai,onnx --queries 200 --chunks 2000
+    ONNX_EMBED_MODEL=BAAI/bge-small-en-v1.5 python -m benchmarks.embeddings --backends onnx
+"""
+
+import argparse
+import json
+import logging
+import random
+import time
+from typing import Any, Dict, List
+
+from app.db.vector_db import create_embedding_backend
+from app.services.embeddings import EmbeddingService
+
+from .documents import FINDINGS
+from .load_test import PERCENTILES, percentile
+
+logger = logging.getLogger(__name__)
+
+QUESTIONS = [
+    "What medications am I on?",
+    "When is my next follow up?",
+    "What did my cardiologist say about my blood pressure?",
+    "When did I start Lisinopril 10 mg?",
+    "Do I need to get any labs done?",
+]
+
+
+def benchmark(backend: str, queries: List[str], chunks: List[str]) -> Dict[str, Any]:
+    function, model = create_embedding_backend(backend)
+    function(queries[:1])  # warm up, e.g. load the model or open the connection
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        function([query])
+        latencies.append(time.perf_counter() - start)
+
+    service = EmbeddingService(function, model, cache=None)
+    start = time.perf_counter()
+    service(chunks)
+    ingest_seconds = time.perf_counter() - start
+
+    result = {"model": model, "ingest_chunks_per_s": len(chunks) / ingest_seconds}
+    for q in PERCENTILES:
+        result[f"query_p{q}_ms"] = percentile(latencies, q) * 1000
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark embedding backends.")
+    parser.add_argument("--backends", default="openai,onnx")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--output", help="write the results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rng = random.Random(0)
+    # vary the texts so nothing is served from a cache along the way
+    queries = [f"{rng.choice(QUESTIONS)} ({i})" for i in range(args.queries)]
+    chunks = [
+        f"{i}. " + " ".join(rng.choices(FINDINGS, k=rng.randint(3, 12)))
+        for i in range(args.chunks)
+    ]
+
+    results = {}
+    for backend in args.backends.split(","):
+        logger.info(f"Benchmarking {backend} embeddings")
+        results[backend] = benchmark(backend, queries, chunks)
+
+    header = f"{'backend':<10}{'model':<28}{'ingest/s':>10}"
+    header += "".join(f"{f'p{q} ms':>10}" for q in PERCENTILES)
+    print(header)
+    for backend, result in results.items():
+        row = f"{backend:<10}{result['model']:<28}"
+        row += f"{result['ingest_chunks_per_s']:>10.1f}"
+        row += "".join(f"{result[f'query_p{q}_ms']:>10.1f}" for q in PERCENTILES)
+        print(row)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
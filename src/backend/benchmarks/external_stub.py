@@ -0,0 +1,65 @@
+"""
+Local stand ins for the NPI registry and the Google geocoding API, which the
+analysis pipeline calls when it meets a provider it hasn't seen before.
+Answers are derived from the request so repeated runs see the same providers.
+
+Point the app at the stub with
+    NPI_URL=http://localhost:8200/npi/?version=2.1
+    GOOGLE_MAPS_API_URL=http://localhost:8200/geocode/json
+then run
+    python -m benchmarks.external_stub
+"""
+
+import argparse
+import hashlib
+
+import uvicorn
+from fastapi import FastAPI
+
+# synthetic npis stay in the int range because postgres stores them as INT
+NPI_MIN = 1000000000
+NPI_MAX = 2147483647
+CENTER = (40.7197743, -73.9641896)  # lat, lng the seeded providers surround
+
+
+def _hash(*parts: str | None) -> int:
+    text = "|".join(str(part).lower() for part in parts)
+    return int(hashlib.sha256(text.encode()).hexdigest(), 16)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(title="External API stub")
+
+    @app.get("/npi/")
+    async def npi(
+        first_name: str | None = None,
+        last_name: str | None = None,
+        city: str | None = None,
+        state: str | None = None,
+    ):
+        if not (first_name and last_name):
+            return {"result_count": 0, "results": []}
+        number = NPI_MIN + _hash(first_name, last_name) % (NPI_MAX - NPI_MIN)
+        return {"result_count": 1, "results": [{"number": str(number)}]}
+
+    @app.get("/geocode/json")
+    async def geocode(address: str = "", key: str | None = None):
+        h = _hash(address)
+        # within about 5km of the center
+        lat = CENTER[0] + (h % 1000 - 500) / 10000
+        lng = CENTER[1] + (h // 1000 % 1000 - 500) / 10000
+        return {
+            "status": "OK",
+            "results": [{"geometry": {"location": {"lat": lat, "lng": lng}}}],
+        }
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NPI registry and geocoding stub.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8200)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,431 @@
+"""
+Generate synthetic data at production scale, to see how user appointment
+listing, provider search and vector retrieval behave with e.g. a million
+appointments, half a million providers and ten million document chunks.
+
+Everything is generated in one deterministic pass, so appointments only point at
+users and providers that exist, prescriptions at their appointment, and vector
+chunks carry the same provider and visit date as the appointment they came
+from. Loading uses the bulk path of each store: COPY for postgres, insert_many
+for mongo and batched upserts with precomputed embeddings for chroma.
+
+Run with e.g.
+    python -m benchmarks.generate --users 10000 --providers 500000 \\
+        --appointments 1000000 --chunks-per-appointment 10
+"""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Any, Dict, List
+
+import numpy as np
+from psycopg2.extensions import connection
+from pymongo import GEOSPHERE, MongoClient
+from pymongo.collection import Collection
+
+from app.db.relational_db import create_connection
+from app.db.vector_db import embedding_function_for, shard_of, vector_store
+from app.security.auth import get_password_hash
+from app.utils.utils import create_hash_id
+
+from .documents import synthetic_provider, synthetic_visit
+from .external_stub import CENTER, NPI_MIN
+from .seed import SPECIALTIES, seed_relational
+
+logger = logging.getLogger(__name__)
+
+MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+EMBEDDING_DIMENSIONS = 1536  # text-embedding-3-small
+TARGETS = ("postgres", "mongo", "chroma")
+
+USER_COLUMNS = (
+    "id",
+    "first_name",
+    "last_name",
+    "email",
+    "insurance_id",
+    "birthdate",
+    "location",
+    "hashed_pw",
+)
+APPOINTMENT_COLUMNS = (
+    "id",
+    "user_id",
+    "provider_id",
+    "filename",
+    "summary",
+    "appointment_datetime",
+    "follow_ups",
+    "perscriptions",
+)
+PRESCRIPTION_COLUMNS = (
+    "user_id",
+    "appointment_id",
+    "brand_name",
+    "technical_name",
+    "instructions",
+    "provider_id",
+)
+
+
+def copy_rows(conn: connection, table: str, columns: tuple, rows: List[tuple]) -> None:
+    """Load rows into a table with a single COPY."""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    with conn.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            buffer,
+        )
+    conn.commit()
+
+
+def next_id(conn: connection, table: str) -> int:
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}")
+        return cursor.fetchone()[0]
+
+
+def sync_sequence(conn: connection, table: str) -> None:
+    """Move the serial sequence past ids that were loaded explicitly."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"(SELECT MAX(id) FROM {table}))"
+        )
+    conn.commit()
+
+
+class Generator:
+    """
+    Parameters
+    ----------
+    targets : tuple
+        Stores to load, any of postgres, mongo and chroma
+    batch_size : int
+        Rows per COPY / insert_many / upsert
+    user_skew : float
+        Appointments are assigned to users with probability proportional to
+        rank ** -user_skew, 0 spreads them evenly and larger values create a
+        few users with very long histories
+    npi_start : int
+        NPI of the first provider, by default above the providers seed.py adds
+    spread : float
+        Degrees of latitude / longitude providers are spread over around CENTER
+    embeddings : str
+        "random" stores unit vectors drawn per chunk, "model" embeds the chunk
+        text with the collection's embedding function (e.g. via the OpenAI stub)
+    """
+
+    def __init__(
+        self,
+        targets: tuple = TARGETS,
+        batch_size: int = 10000,
+        chunk_batch_size: int = 1000,
+        user_skew: float = 1.0,
+        npi_start: int = NPI_MIN + 1000000,
+        spread: float = 0.5,
+        embeddings: str = "random",
+        seed: int = 0,
+    ):
+        self.targets = targets
+        self.batch_size = batch_size
+        self.chunk_batch_size = chunk_batch_size
+        self.user_skew = user_skew
+        self.npi_start = npi_start
+        self.spread = spread
+        self.embeddings = embeddings
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed)
+        self.timings: Dict[str, float] = {target: 0.0 for target in TARGETS}
+
+        self.conn = create_connection() if "postgres" in targets else None
+        self.providers_collection: Collection | None = None
+        if "mongo" in targets:
+            self.providers_collection = MongoClient(MONGODB_URL)["wilson_ai"].providers
+        # every shard of the collection read from, chunks go to their user's
+        self.chunk_collections = None
+        if "chroma" in targets:
+            self.chunk_collections = vector_store.collections()
+
+    def run(
+        self, n_users: int, n_providers: int, n_appointments: int, n_chunks: int
+    ) -> Dict[str, Any]:
+        insurance_id = 1
+        if self.conn:
+            insurance_id = seed_relational(self.conn)["insurance_id"]
+
+        user_ids = self.generate_users(n_users, insurance_id)
+        providers = self.generate_providers(n_providers, insurance_id)
+        self.generate_history(user_ids, providers, n_appointments, n_chunks)
+
+        return {
+            "users": n_users,
+            "providers": n_providers,
+            "appointments": n_appointments,
+            "chunks": n_appointments * n_chunks,
+            "seconds": {k: round(v, 1) for k, v in self.timings.items()},
+        }
+
+    def generate_users(self, n_users: int, insurance_id: int) -> List[int]:
+        start_id = next_id(self.conn, "users") if self.conn else 1
+        # bcrypt is slow on purpose, every synthetic user shares one password
+        hashed_pw = get_password_hash("synthetic-password") if self.conn else ""
+        user_ids, rows = [], []
+        for i in range(n_users):
+            user_id = start_id + i
+            user_ids.append(user_id)
+            rows.append(
+                (
+                    user_id,
+                    f"User{user_id}",
+                    "Synthetic",
+                    f"user{user_id}@synthetic.wilson.ai",
+                    insurance_id,
+                    date(1940, 1, 1) + timedelta(days=self.rng.randrange(25000)),
+                    "New York, NY",
+                    hashed_pw,
+                )
+            )
+            if len(rows) == self.batch_size:
+                self._copy("users", USER_COLUMNS, rows)
+        self._copy("users", USER_COLUMNS, rows)
+        if self.conn:
+            sync_sequence(self.conn, "users")
+        logger.info(f"Generated {n_users} users")
+        return user_ids
+
+    def generate_providers(
+        self, n_providers: int, insurance_id: int
+    ) -> List[Dict[str, Any]]:
+        """Providers with NPIs, a specialty and a location around CENTER."""
+        providers, documents = [], []
+        specialties = list(SPECIALTIES)
+        for i in range(n_providers):
+            provider = synthetic_provider(
+                self.rng, self.npi_start + i, specialties[i % len(specialties)]
+            )
+            providers.append(provider)
+            if self.providers_collection is None:
+                continue
+
+            lat = CENTER[0] + self.rng.uniform(-self.spread, self.spread)
+            lng = CENTER[1] + self.rng.uniform(-self.spread, self.spread)
+            documents.append(
+                {
+                    "npi": provider["npi"],
+                    "first_name": provider["first_name"],
+                    "last_name": provider["last_name"],
+                    "email": None,
+                    "phone_number": None,
+                    # same [lat, lng] order get_relevant_providers queries with
+                    "locations": [
+                        {
+                            "street": f"{self.rng.randint(1, 999)} Broadway",
+                            "city": "New York",
+                            "state": "NY",
+                            "zip_code": "10001",
+                            "coordinates": {"type": "Point", "coordinates": [lat, lng]},
+                        }
+                    ],
+                    "specialties": [provider["specialty"]],
+                    "insurances": [{"id": insurance_id}],
+                }
+            )
+            if len(documents) == self.batch_size:
+                self._insert_providers(documents)
+        self._insert_providers(documents)
+
+        if self.providers_collection is not None:
+            # indexes are built once at the end, maintaining them per batch is
+            # much slower than a single build
+            start = time.monotonic()
+            self.providers_collection.create_index(
+                [("locations.coordinates", GEOSPHERE)]
+            )
+            self.providers_collection.create_index("npi")
+            self.timings["mongo"] += time.monotonic() - start
+        logger.info(f"Generated {n_providers} providers")
+        return providers
+
+    def generate_history(
+        self,
+        user_ids: List[int],
+        providers: List[Dict[str, Any]],
+        n_appointments: int,
+        n_chunks: int,
+    ) -> None:
+        """Appointments, their prescriptions and the chunks of their notes."""
+        start_id = next_id(self.conn, "appointment") if self.conn else 1
+        weights = [(rank + 1) ** -self.user_skew for rank in range(len(user_ids))]
+        owners = self.rng.choices(user_ids, weights, k=n_appointments)
+
+        appointments, prescriptions, chunks = [], [], []
+        started = time.monotonic()
+        for i, user_id in enumerate(owners):
+            appointment_id = start_id + i
+            provider = self.rng.choice(providers)
+            visit = synthetic_visit(self.rng, provider, n_paragraphs=n_chunks)
+            # the unique key is (user, provider, datetime), an offset in
+            # microseconds keeps generated visits from ever colliding
+            visit_datetime = visit["appointment_datetime"] + timedelta(microseconds=i)
+            filename = f"s3://synthetic/{user_id}/pdf/{appointment_id}.pdf"
+
+            if self.conn:
+                appointments.append(
+                    (
+                        appointment_id,
+                        user_id,
+                        int(provider["npi"]),
+                        filename,
+                        visit["summary"],
+                        visit_datetime,
+                        json.dumps({"tasks": visit["follow_ups"]}),
+                        json.dumps({"drugs": visit["drugs"]}),
+                    )
+                )
+                prescriptions += [
+                    (
+                        user_id,
+                        appointment_id,
+                        drug["brand_name"],
+                        drug["technical_name"],
+                        drug["instructions"],
+                        int(provider["npi"]),
+                    )
+                    for drug in visit["drugs"]
+                ]
+                if len(appointments) >= self.batch_size:
+                    self._copy("appointment", APPOINTMENT_COLUMNS, appointments)
+                    self._copy("prescriptions", PRESCRIPTION_COLUMNS, prescriptions)
+
+            if self.chunk_collections is not None:
+                metadata = {
+                    "user_id": user_id,
+                    "provider_id": int(provider["npi"]),
+                    "provider_name": f"{provider['first_name']} {provider['last_name']}",
+                    "appointment_datetime": f"{visit_datetime:%Y-%m-%d %H:%M}",
+                    "filename": filename,
+                }
+                chunks += [
+                    (text, {**metadata, "chunk": j})
+                    for j, text in enumerate(_split(visit["text"], n_chunks))
+                ]
+                if len(chunks) >= self.chunk_batch_size:
+                    self._upsert_chunks(chunks)
+
+            if (i + 1) % 100000 == 0:
+                rate = (i + 1) / (time.monotonic() - started)
+                logger.info(f"Generated {i + 1} appointments ({rate:.0f}/s)")
+
+        if self.conn:
+            self._copy("appointment", APPOINTMENT_COLUMNS, appointments)
+            self._copy("prescriptions", PRESCRIPTION_COLUMNS, prescriptions)
+            sync_sequence(self.conn, "appointment")
+        if self.chunk_collections is not None:
+            self._upsert_chunks(chunks)
+        logger.info(f"Generated {n_appointments} appointments")
+
+    def _copy(self, table: str, columns: tuple, rows: List[tuple]) -> None:
+        """COPY the rows if loading postgres, then empty the buffer."""
+        if self.conn and rows:
+            start = time.monotonic()
+            copy_rows(self.conn, table, columns, rows)
+            self.timings["postgres"] += time.monotonic() - start
+        rows.clear()
+
+    def _insert_providers(self, documents: List[Dict[str, Any]]) -> None:
+        if documents:
+            start = time.monotonic()
+            self.providers_collection.insert_many(documents, ordered=False)
+            self.timings["mongo"] += time.monotonic() - start
+        documents.clear()
+
+    def _upsert_chunks(self, chunks: List[tuple]) -> None:
+        if not chunks:
+            return
+        texts = [text for text, _ in chunks]
+        metadatas = [metadata for _, metadata in chunks]
+        if self.embeddings == "random":
+            vectors = self.np_rng.standard_normal(
+                (len(chunks), EMBEDDING_DIMENSIONS), dtype=np.float32
+            )
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            embeddings = vectors.tolist()
+        else:
+            embeddings = embedding_function_for()(texts)
+
+        routed: Dict[int, List[int]] = defaultdict(list)
+        for i, metadata in enumerate(metadatas):
+            routed[shard_of(metadata["user_id"], len(self.chunk_collections))].append(i)
+
+        start = time.monotonic()
+        for shard, rows in routed.items():
+            self.chunk_collections[shard].upsert(
+                ids=[create_hash_id(texts[i], metadatas[i]) for i in rows],
+                documents=[texts[i] for i in rows],
+                metadatas=[metadatas[i] for i in rows],
+                embeddings=[embeddings[i] for i in rows],
+            )
+        self.timings["chroma"] += time.monotonic() - start
+        chunks.clear()
+
+
+def _split(text: str, n_chunks: int) -> List[str]:
+    """Split a note into n_chunks runs of consecutive lines of similar length."""
+    lines = [line for line in text.splitlines() if line]
+    size, extra = divmod(len(lines), n_chunks)
+    chunks, start = [], 0
+    for i in range(min(n_chunks, len(lines))):
+        end = start + size + (i < extra)
+        chunks.append("\n".join(lines[start:end]))
+        start = end
+    return chunks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic data at scale.")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--providers", type=int, default=500000)
+    parser.add_argument("--appointments", type=int, default=1000000)
+    parser.add_argument("--chunks-per-appointment", type=int, default=10)
+    parser.add_argument(
+        "--targets", default=",".join(TARGETS), help="comma separated stores to load"
+    )
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--chunk-batch-size", type=int, default=1000)
+    parser.add_argument("--user-skew", type=float, default=1.0)
+    parser.add_argument("--npi-start", type=int, default=NPI_MIN + 1000000)
+    parser.add_argument("--spread", type=float, default=0.5)
+    parser.add_argument("--embeddings", choices=["random", "model"], default="random")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    targets = tuple(target.strip() for target in args.targets.split(","))
+    if unknown := set(targets) - set(TARGETS):
+        parser.error(f"Unknown targets {unknown}")
+
+    generator = Generator(
+        targets,
+        batch_size=args.batch_size,
+        chunk_batch_size=args.chunk_batch_size,
+        user_skew=args.user_skew,
+        npi_start=args.npi_start,
+        spread=args.spread,
+        embeddings=args.embeddings,
+        seed=args.seed,
+    )
+    summary = generator.run(
+        args.users, args.providers, args.appointments, args.chunks_per_appointment
+    )
+    print(json.dumps(summary, indent=2))
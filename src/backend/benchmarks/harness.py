@@ -0,0 +1,48 @@
+"""
+End to end load test. Starts the backend with local stand ins for postgres,
+mongo, redis, chroma, s3, OpenAI and the external provider APIs, seeds them,
+runs the load test and tears everything down again.
+
+Arguments after -- are passed to the load test, e.g.
+    python -m benchmarks.harness -- --users 20 --duration 120 --output report.json
+"""
+
+import argparse
+import logging
+import subprocess
+import sys
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+COMPOSE_FILE = Path(__file__).parent / "docker-compose.yaml"
+PROJECT = "wilson-bench"
+
+
+def compose(*args: str) -> None:
+    command = ["docker", "compose", "-p", PROJECT, "-f", str(COMPOSE_FILE), *args]
+    logger.info(" ".join(command))
+    subprocess.run(command, check=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the end to end load test.")
+    parser.add_argument(
+        "--keep", action="store_true", help="leave the stack running afterwards"
+    )
+    parser.add_argument("--no-build", action="store_true")
+    parser.add_argument("load_test_args", nargs="*")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        build = [] if args.no_build else ["--build"]
+        compose("up", "-d", "--wait", *build, "backend")
+        result = subprocess.run(
+            [sys.executable, "-m", "benchmarks.load_test", *args.load_test_args],
+            cwd=Path(__file__).parent.parent,
+        )
+    finally:
+        if not args.keep:
+            compose("down", "-v")
+    sys.exit(result.returncode)
@@ -0,0 +1,342 @@
+"""
+Drive a mix of realistic traffic against a running backend and report latency
+percentiles and throughput per endpoint.
+
+Each virtual user logs in as the seeded bench user and repeatedly picks a
+scenario by weight: uploading and analyzing a new visit note, listing
+appointments, listing prescriptions, chatting with their records or asking for
+follow up suggestions. Run with e.g.
+    python -m benchmarks.load_test --duration 120 --users 20
+    python -m benchmarks.load_test --output report.json --baseline main.json
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List
+
+import httpx
+
+from .documents import (
+    BENCH_EMAIL,
+    BENCH_PASSWORD,
+    FOLLOW_UPS,
+    make_pdf,
+    paginate,
+    synthetic_provider,
+    synthetic_visit,
+)
+from .external_stub import CENTER, NPI_MIN
+
+DEFAULT_MIX = "upload_analyze=1,appointments=4,prescriptions=3,chat=2,follow_ups=1"
+QUESTIONS = [
+    "What medications am I currently taking?",
+    "When was my last visit with an ENT?",
+    "What did my doctor say about my blood pressure?",
+    "Summarize my visits from last year.",
+    "Which follow ups have I been asked to schedule?",
+]
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest rank percentile of already sorted values."""
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(q / 100 * len(values) + 0.5) - 1))
+    return values[rank]
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in LoadTest.SCENARIOS:
+            raise ValueError(f"Unknown scenario {name}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+class Recorder:
+    """Latency and outcome of every request, grouped by endpoint."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.recording = False
+
+    def record(self, endpoint: str, latency: float, status: str) -> None:
+        if self.recording:
+            self.latencies[endpoint].append(latency)
+            self.statuses[endpoint][status] += 1
+
+    def report(self, elapsed: float) -> Dict[str, Dict[str, Any]]:
+        report = {}
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            statuses = self.statuses[endpoint]
+            errors = sum(n for status, n in statuses.items() if status != "ok")
+            report[endpoint] = {
+                "requests": len(latencies),
+                "errors": errors,
+                "error_rate": errors / len(latencies),
+                "throughput_rps": len(latencies) / elapsed,
+                **{f"p{q}_ms": percentile(latencies, q) * 1000 for q in PERCENTILES},
+                "statuses": dict(statuses),
+            }
+        return report
+
+
+class LoadTest:
+    """
+    Closed loop load generator. Every virtual user waits for its scenario to
+    finish, plus an optional think time, before starting the next one.
+
+    Parameters
+    ----------
+    base_url : str
+        Root of the backend e.g. http://localhost:8000
+    mix : Dict[str, float]
+        Relative weight of each scenario
+    users : int
+        Number of virtual users running at once
+    think_time : float
+        Mean seconds a user waits between scenarios, exponentially distributed
+    insurance_id : int
+        Insurance of the bench user, used for follow up suggestions
+    """
+
+    SCENARIOS = (
+        "upload_analyze",
+        "appointments",
+        "prescriptions",
+        "chat",
+        "follow_ups",
+    )
+
+    def __init__(
+        self,
+        base_url: str,
+        mix: Dict[str, float],
+        users: int = 10,
+        think_time: float = 0.0,
+        insurance_id: int = 1,
+        timeout: float = 120.0,
+        seed: int | None = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.mix = mix
+        self.users = users
+        self.think_time = think_time
+        self.insurance_id = insurance_id
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.recorder = Recorder()
+        self.user_id: int | None = None
+        self.token: str | None = None
+
+    async def run(self, duration: float, warmup: float = 0.0) -> Dict[str, Any]:
+        limits = httpx.Limits(max_connections=self.users * 2)
+        async with httpx.AsyncClient(
+            base_url=f"{self.base_url}/api/v1", timeout=self.timeout, limits=limits
+        ) as http:
+            await self._login(http)
+            stop_at = time.monotonic() + warmup + duration
+            users = [
+                asyncio.create_task(self._user(http, stop_at))
+                for _ in range(self.users)
+            ]
+            await asyncio.sleep(warmup)
+            self.recorder.recording = True
+            started = time.monotonic()
+            await asyncio.gather(*users)
+            elapsed = time.monotonic() - started
+
+        return {
+            "duration_s": elapsed,
+            "users": self.users,
+            "mix": self.mix,
+            "endpoints": self.recorder.report(elapsed),
+        }
+
+    async def _login(self, http: httpx.AsyncClient) -> None:
+        response = await http.post(
+            "/auth/token", data={"username": BENCH_EMAIL, "password": BENCH_PASSWORD}
+        )
+        response.raise_for_status()
+        self.user_id = response.json()["userId"]
+        self.token = response.json()["access_token"]
+
+    async def _user(self, http: httpx.AsyncClient, stop_at: float) -> None:
+        scenarios, weights = zip(*self.mix.items())
+        while time.monotonic() < stop_at:
+            scenario = self.rng.choices(scenarios, weights)[0]
+            await getattr(self, scenario)(http)
+            if self.think_time:
+                await asyncio.sleep(self.rng.expovariate(1 / self.think_time))
+
+    async def _request(
+        self, http: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs
+    ) -> httpx.Response | None:
+        start = time.perf_counter()
+        try:
+            response = await http.request(method, url, **kwargs)
+        except httpx.TimeoutException:
+            self.recorder.record(endpoint, time.perf_counter() - start, "timeout")
+            return None
+        except httpx.HTTPError as e:
+            self.recorder.record(
+                endpoint, time.perf_counter() - start, type(e).__name__
+            )
+            return None
+
+        status = "ok" if response.is_success else str(response.status_code)
+        self.recorder.record(endpoint, time.perf_counter() - start, status)
+        return response if response.is_success else None
+
+    async def upload_analyze(self, http: httpx.AsyncClient) -> None:
+        # a new note every time, repeated uploads would only measure the cache
+        provider = synthetic_provider(
+            self.rng, NPI_MIN + self.rng.randint(1, 200), "PCP"
+        )
+        visit = synthetic_visit(
+            self.rng, provider, n_paragraphs=self.rng.randint(4, 60)
+        )
+        pdf = make_pdf(paginate(visit["text"]))
+        response = await self._request(
+            http,
+            "upload",
+            "POST",
+            "/appointments/upload",
+            files={"file": ("visit.pdf", pdf, "application/pdf")},
+            headers={"x-user-id": str(self.user_id)},
+        )
+        if response is None:
+            return
+        await self._request(
+            http,
+            "analyze",
+            "POST",
+            "/appointments/analyze",
+            json={"user_id": self.user_id, "data_location": response.json()["s3_uri"]},
+        )
+
+    async def appointments(self, http: httpx.AsyncClient) -> None:
+        await self._request(
+            http, "appointments", "GET", f"/appointments/{self.user_id}"
+        )
+
+    async def prescriptions(self, http: httpx.AsyncClient) -> None:
+        await self._request(
+            http, "prescriptions", "GET", f"/prescriptions/{self.user_id}"
+        )
+
+    async def chat(self, http: httpx.AsyncClient) -> None:
+        await self._request(
+            http,
+            "chat",
+            "POST",
+            f"/chat_w_data/{self.user_id}",
+            json={"query": self.rng.choice(QUESTIONS)},
+        )
+
+    async def follow_ups(self, http: httpx.AsyncClient) -> None:
+        tasks = self.rng.sample(FOLLOW_UPS, self.rng.randint(1, 3))
+        await self._request(
+            http,
+            "follow_ups",
+            "POST",
+            "/follow_ups/",
+            json={
+                "user_info": {
+                    "user_id": self.user_id,
+                    "lat": CENTER[0],
+                    "lng": CENTER[1],
+                    "insurance_id": self.insurance_id,
+                },
+                "follow_ups": {"tasks": [{"task": task} for task in tasks]},
+            },
+            headers={"Authorization": f"Bearer {self.token}"},
+        )
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    header = f"{'endpoint':<15}{'reqs':>7}{'errors':>8}{'rps':>8}"
+    header += "".join(f"{f'p{q} ms':>10}" for q in PERCENTILES)
+    print(header)
+    for endpoint, stats in report["endpoints"].items():
+        row = f"{endpoint:<15}{stats['requests']:>7}{stats['errors']:>8}"
+        row += f"{stats['throughput_rps']:>8.2f}"
+        row += "".join(f"{stats[f'p{q}_ms']:>10.0f}" for q in PERCENTILES)
+        print(row)
+
+
+def compare(
+    report: Dict[str, Any], baseline: Dict[str, Any], max_regression: float
+) -> List[str]:
+    """Endpoints whose p95 / p99 latency or error rate regressed past the limit."""
+    regressions = []
+    for endpoint, stats in report["endpoints"].items():
+        if not (base := baseline["endpoints"].get(endpoint)):
+            continue
+        for q in PERCENTILES[1:]:
+            key = f"p{q}_ms"
+            if stats[key] > base[key] * (1 + max_regression):
+                regressions.append(
+                    f"{endpoint} {key} {base[key]:.0f} -> {stats[key]:.0f}"
+                )
+        if stats["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(
+                f"{endpoint} error rate {base['error_rate']:.2%} -> "
+                f"{stats['error_rate']:.2%}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the backend.")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="scenario=weight,...")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--warmup", type=float, default=10.0)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--insurance-id", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="write the report as json")
+    parser.add_argument("--baseline", help="a previous json report to compare with")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="allowed relative increase in p95 / p99 over the baseline",
+    )
+    args = parser.parse_args()
+
+    load_test = LoadTest(
+        args.base_url,
+        parse_mix(args.mix),
+        users=args.users,
+        think_time=args.think_time,
+        insurance_id=args.insurance_id,
+        timeout=args.timeout,
+        seed=args.seed,
+    )
+    report = asyncio.run(load_test.run(args.duration, args.warmup))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
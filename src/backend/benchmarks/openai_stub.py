@@ -0,0 +1,401 @@
+"""
+A local stand in for the OpenAI API so /analyze, /chat_w_data and /follow_ups
+can be load tested without paying for or waiting on the real API.
+
+In record mode requests are forwarded to OpenAI and every response is saved as
+a fixture. In replay mode fixtures are served back with a configurable latency
+distribution and rate of 429s, server errors and timeouts. Embeddings that were
+never recorded are generated deterministically from the input text, and with
+--synthesize so are chat completions, from the JSON schema in the system message.
+
+Point the app at the stub with OPENAI_BASE_URL=http://localhost:8100/v1, then run
+    python -m benchmarks.openai_stub --mode record
+    python -m benchmarks.openai_stub --mode replay --latency-median 1.5 --error-rate 0.02
+"""
+
+import argparse
+import ast
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import struct
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_URL = "https://api.openai.com/v1"
+DEFAULT_FIXTURES = Path(__file__).parent / "fixtures" / "openai"
+DEFAULT_EMBEDDING_DIMENSIONS = 1536
+Z_99 = 2.326  # z score of the 99th percentile of a standard normal
+
+
+def request_key(body: Dict[str, Any]) -> str:
+    """Hash the parts of a request that determine the response."""
+    relevant = {
+        k: body.get(k)
+        for k in ("model", "messages", "input", "response_format", "tools")
+    }
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def prompt_key(body: Dict[str, Any]) -> str | None:
+    """
+    Hash of the system message. Every extractor has its own system message, so
+    on a miss we can still answer with a response of the right shape.
+    """
+    for message in body.get("messages", []):
+        if message.get("role") == "system":
+            return hashlib.sha256(message["content"].encode()).hexdigest()
+    return None
+
+
+def synthetic_embedding(text: str, dimensions: int) -> List[float]:
+    """A deterministic unit vector derived from the text."""
+    values = []
+    seed = hashlib.sha256(text.encode()).digest()
+    while len(values) < dimensions:
+        seed = hashlib.sha256(seed).digest()
+        values.extend(v / 2**31 for v in struct.unpack("<8i", seed))
+    values = values[:dimensions]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+def _schema_in(text: str) -> Dict[str, Any] | None:
+    """The JSON schema our prompts embed after "JSON Schema:", as a python dict."""
+    start = text.find("{", text.find("JSON Schema:"))
+    if "JSON Schema:" not in text or start < 0:
+        return None
+    depth = 0
+    for end in range(start, len(text)):
+        depth += {"{": 1, "}": -1}.get(text[end], 0)
+        if depth == 0:
+            try:
+                return ast.literal_eval(text[start : end + 1])
+            except (ValueError, SyntaxError):
+                return None
+    return None
+
+
+def example_from_schema(
+    schema: Dict[str, Any], defs: Dict[str, Any], name: str = ""
+) -> Any:
+    """A minimal instance that validates against a pydantic generated schema."""
+    if ref := schema.get("$ref"):
+        return example_from_schema(defs[ref.split("/")[-1]], defs, name)
+    if options := schema.get("anyOf"):
+        option = next((o for o in options if o.get("type") != "null"), options[0])
+        return example_from_schema(option, defs, name)
+    if enum := schema.get("enum"):
+        return enum[0]
+
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {
+            key: example_from_schema(value, defs, key)
+            for key, value in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return [example_from_schema(schema.get("items", {}), defs, name)]
+    if schema_type == "integer":
+        return 1
+    if schema_type == "number":
+        return 1.0
+    if schema_type == "boolean":
+        return True
+    return SYNTHETIC_STRINGS.get(name, f"Synthetic {name.replace('_', ' ')}".strip())
+
+
+# string fields our response models validate or look up
+SYNTHETIC_STRINGS = {
+    "datetime": "2024-01-15 09:30",
+    "npi": "1000000001",
+    "state": "NY",
+    "zip_code": "10001",
+}
+
+
+def synthetic_completion(body: Dict[str, Any]) -> Dict[str, Any]:
+    """A chat completion built from the request alone, for unrecorded prompts."""
+    content = "This is a synthetic answer from the OpenAI stub."
+    if body.get("response_format"):
+        system = next(
+            (m["content"] for m in body["messages"] if m.get("role") == "system"), ""
+        )
+        schema = _schema_in(system) or {}
+        content = json.dumps(example_from_schema(schema, schema.get("$defs", {})))
+
+    # roughly four characters per token is close enough for rate limiting
+    prompt_tokens = sum(len(m.get("content") or "") for m in body["messages"]) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-{request_key(body)[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class FixtureStore:
+    """Recorded responses on disk, grouped by endpoint."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.by_key: Dict[str, Dict[str, Any]] = {}
+        self.by_prompt: Dict[str, List[Dict[str, Any]]] = {}
+        for path in sorted(root.glob("*/*.json")):
+            self._index(json.loads(path.read_text()))
+        logger.info(f"Loaded {len(self.by_key)} fixtures from {root}")
+
+    def _index(self, fixture: Dict[str, Any]) -> None:
+        self.by_key[fixture["key"]] = fixture
+        if fixture.get("prompt_key"):
+            self.by_prompt.setdefault(fixture["prompt_key"], []).append(fixture)
+
+    def save(self, endpoint: str, body: Dict, response: Dict, latency: float) -> None:
+        fixture = {
+            "key": request_key(body),
+            "prompt_key": prompt_key(body),
+            "endpoint": endpoint,
+            "latency": latency,
+            "request": body,
+            "response": response,
+        }
+        path = self.root / endpoint / f"{fixture['key']}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(fixture, indent=2))
+        self._index(fixture)
+
+    def find(self, body: Dict[str, Any]) -> Dict[str, Any] | None:
+        if fixture := self.by_key.get(request_key(body)):
+            return fixture
+        candidates = self.by_prompt.get(prompt_key(body)) or []
+        if candidates:
+            # pick deterministically so repeated runs serve the same responses
+            index = int(request_key(body), 16) % len(candidates)
+            return candidates[index]
+        return None
+
+
+class ReplayPolicy:
+    """
+    Latency and failure injection for replayed responses.
+
+    Parameters
+    ----------
+    latency : str
+        "lognormal" samples from a lognormal with the given median and p99,
+        "recorded" replays the latency measured when the fixture was recorded,
+        "none" responds immediately
+    latency_scale : float
+        Multiplier applied to every sampled latency
+    rate_limit_rate : float
+        Fraction of requests answered with a 429
+    error_rate : float
+        Fraction of requests answered with a 500
+    timeout_rate : float
+        Fraction of requests that hang for hang_seconds before failing
+    """
+
+    def __init__(
+        self,
+        latency: str = "lognormal",
+        latency_median: float = 1.0,
+        latency_p99: float = 6.0,
+        latency_scale: float = 1.0,
+        rate_limit_rate: float = 0.0,
+        error_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        hang_seconds: float = 120.0,
+        retry_after: float = 1.0,
+        seed: int | None = None,
+    ):
+        self.latency = latency
+        self.latency_median = latency_median
+        self.sigma = math.log(max(latency_p99, latency_median) / latency_median) / Z_99
+        self.latency_scale = latency_scale
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+    def sample_latency(self, recorded: float | None) -> float:
+        if self.latency == "none":
+            return 0.0
+        if self.latency == "recorded" and recorded is not None:
+            return recorded * self.latency_scale
+        sample = self.latency_median * math.exp(self.sigma * self.random.gauss(0, 1))
+        return sample * self.latency_scale
+
+    async def inject_failure(self) -> JSONResponse | None:
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return JSONResponse(
+                status_code=429,
+                headers={"retry-after": str(self.retry_after)},
+                content=_error("Rate limit reached", "rate_limit_exceeded"),
+            )
+        roll -= self.rate_limit_rate
+        if roll < self.error_rate:
+            return JSONResponse(
+                status_code=500, content=_error("Injected server error", "server_error")
+            )
+        roll -= self.error_rate
+        if roll < self.timeout_rate:
+            await asyncio.sleep(self.hang_seconds)
+            return JSONResponse(
+                status_code=504, content=_error("Injected timeout", "timeout")
+            )
+        return None
+
+
+def _error(message: str, code: str) -> Dict[str, Any]:
+    return {"error": {"message": message, "type": code, "code": code}}
+
+
+def create_app(
+    mode: str,
+    fixtures: FixtureStore,
+    policy: ReplayPolicy,
+    upstream_url: str = UPSTREAM_URL,
+    synthesize: bool = False,
+) -> FastAPI:
+    app = FastAPI(title="OpenAI stub")
+    upstream = httpx.AsyncClient(base_url=upstream_url, timeout=600)
+    api_key = os.getenv("OPENAI_API_KEY", "")
+
+    async def record(endpoint: str, body: Dict[str, Any]):
+        start = time.monotonic()
+        response = await upstream.post(
+            f"/{endpoint.replace('_', '/')}",
+            json=body,
+            headers={"Authorization": f"Bearer {api_key}"},
+        )
+        latency = time.monotonic() - start
+        if response.status_code == 200:
+            fixtures.save(endpoint, body, response.json(), latency)
+        return JSONResponse(status_code=response.status_code, content=response.json())
+
+    async def replay(body: Dict[str, Any], fallback: Dict[str, Any] | None = None):
+        if failure := await policy.inject_failure():
+            return failure
+
+        fixture = fixtures.find(body)
+        if fixture is None and fallback is None:
+            return JSONResponse(
+                status_code=501,
+                content=_error("No fixture recorded for this request", "no_fixture"),
+            )
+        await asyncio.sleep(
+            policy.sample_latency(fixture["latency"] if fixture else None)
+        )
+        return fixture["response"] if fixture else fallback
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if mode == "record":
+            return await record("chat_completions", body)
+        return await replay(body, synthetic_completion(body) if synthesize else None)
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        if mode == "record":
+            return await record("embeddings", body)
+
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dimensions = body.get("dimensions", DEFAULT_EMBEDDING_DIMENSIONS)
+        synthetic = {
+            "object": "list",
+            "model": body.get("model"),
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": synthetic_embedding(str(text), dimensions),
+                }
+                for i, text in enumerate(inputs)
+            ],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+        return await replay(body, fallback=synthetic)
+
+    @app.on_event("shutdown")
+    async def close_upstream():
+        await upstream.aclose()
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record / replay OpenAI stub server.")
+    parser.add_argument("--mode", choices=["record", "replay"], default="replay")
+    parser.add_argument("--fixtures", type=Path, default=DEFAULT_FIXTURES)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--upstream", default=UPSTREAM_URL)
+    parser.add_argument(
+        "--latency", choices=["lognormal", "recorded", "none"], default="lognormal"
+    )
+    parser.add_argument("--latency-median", type=float, default=1.0)
+    parser.add_argument("--latency-p99", type=float, default=6.0)
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--hang-seconds", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--synthesize",
+        action="store_true",
+        help="answer unrecorded chat completions from the response schema",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    args.fixtures.mkdir(parents=True, exist_ok=True)
+    policy = ReplayPolicy(
+        latency=args.latency,
+        latency_median=args.latency_median,
+        latency_p99=args.latency_p99,
+        latency_scale=args.latency_scale,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate,
+        hang_seconds=args.hang_seconds,
+        seed=args.seed,
+    )
+    app = create_app(
+        args.mode,
+        FixtureStore(args.fixtures),
+        policy,
+        args.upstream,
+        synthesize=args.synthesize,
+    )
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,269 @@
+"""
+Seed the local stand ins with a bench user, providers around them and a visit
+history, so every endpoint in the load test has data to work on.
+
+Run before starting the backend, the app reads the specialty table at import:
+    python -m benchmarks.seed --providers 200 --appointments 25
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+from datetime import date
+from typing import Any, Dict, List
+
+import boto3
+import psycopg2.extras
+from botocore.exceptions import ClientError
+from llama_index.core.schema import Document
+from psycopg2.extensions import connection
+from pymongo import GEOSPHERE, MongoClient, UpdateOne
+from pymongo.collection import Collection
+
+from app.db.relational_db import CREATE_QUERIES, create_connection, create_table
+from app.db.vector_db import load_documents
+from app.security.auth import get_password_hash
+
+from .documents import (
+    BENCH_EMAIL,
+    BENCH_PASSWORD,
+    make_pdf,
+    paginate,
+    synthetic_provider,
+    synthetic_visit,
+)
+from .external_stub import CENTER, NPI_MIN
+
+logger = logging.getLogger(__name__)
+
+MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
+S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "wilson-bench")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+SPECIALTIES = {
+    "PCP": "Primary Care Physician",
+    "ENT": "Ear, Nose and Throat",
+    "SPORTS": "Sports Medicine",
+    "ORTHO": "Orthopedics",
+    "CARDIO": "Cardiology",
+    "DERM": "Dermatology",
+}
+
+# columns and constraints the queries in relational_db rely on that the CREATE
+# queries don't declare. appointments store the provider npi as provider_id,
+# so the foreign key to providers is dropped.
+SCHEMA_PATCHES = [
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS hashed_pw TEXT",
+    "ALTER TABLE location ADD COLUMN IF NOT EXISTS lat DOUBLE PRECISION",
+    "ALTER TABLE location ADD COLUMN IF NOT EXISTS lng DOUBLE PRECISION",
+    "ALTER TABLE providers ADD COLUMN IF NOT EXISTS npi TEXT",
+    "ALTER TABLE providers ADD COLUMN IF NOT EXISTS degree TEXT",
+    "ALTER TABLE providers ADD COLUMN IF NOT EXISTS phone_number TEXT",
+    "ALTER TABLE providers ADD COLUMN IF NOT EXISTS location_id INT",
+    "ALTER TABLE appointment DROP CONSTRAINT IF EXISTS appointment_provider_id_fkey",
+    """CREATE UNIQUE INDEX IF NOT EXISTS appointment_user_provider_datetime
+    ON appointment (user_id, provider_id, appointment_datetime)""",
+    """CREATE UNIQUE INDEX IF NOT EXISTS prescriptions_user_appointment_brand
+    ON prescriptions (user_id, appointment_id, brand_name)""",
+]
+
+
+def seed_relational(conn: connection) -> Dict[str, int]:
+    """Create the schema, specialties, an insurance plan and the bench user."""
+    create_table(conn, CREATE_QUERIES + SCHEMA_PATCHES)
+    with conn.cursor() as cursor:
+        psycopg2.extras.execute_values(
+            cursor,
+            "INSERT INTO specialties (specialty, description) VALUES %s "
+            "ON CONFLICT (specialty) DO NOTHING",
+            list(SPECIALTIES.items()),
+        )
+        cursor.execute("SELECT id FROM insurance WHERE policy_number = 'BENCH'")
+        if row := cursor.fetchone():
+            insurance_id = row[0]
+        else:
+            cursor.execute(
+                "INSERT INTO coverage_type (type) VALUES ('PPO') RETURNING id"
+            )
+            cursor.execute(
+                "INSERT INTO insurance (company_name, insurance_name, policy_number, "
+                "coverage_type_id) VALUES ('Bench Health', 'Bench PPO', 'BENCH', %s) "
+                "RETURNING id",
+                (cursor.fetchone()[0],),
+            )
+            insurance_id = cursor.fetchone()[0]
+
+        cursor.execute("SELECT id FROM users WHERE email = %s", (BENCH_EMAIL,))
+        if row := cursor.fetchone():
+            user_id = row[0]
+        else:
+            cursor.execute(
+                "INSERT INTO users (first_name, last_name, email, insurance_id, "
+                "birthdate, location, hashed_pw) VALUES "
+                "('Bench', 'User', %s, %s, %s, 'New York, NY', %s) RETURNING id",
+                (
+                    BENCH_EMAIL,
+                    insurance_id,
+                    date(1985, 6, 1),
+                    get_password_hash(BENCH_PASSWORD),
+                ),
+            )
+            user_id = cursor.fetchone()[0]
+    conn.commit()
+    return {"user_id": user_id, "insurance_id": insurance_id}
+
+
+def seed_providers(
+    collection: Collection, rng: random.Random, n_providers: int, insurance_id: int
+) -> List[Dict[str, Any]]:
+    """Providers spread within about 5km of the bench user, all in network."""
+    providers, operations = [], []
+    for i in range(n_providers):
+        provider = synthetic_provider(
+            rng, NPI_MIN + i + 1, list(SPECIALTIES)[i % len(SPECIALTIES)]
+        )
+        lat = CENTER[0] + rng.uniform(-0.04, 0.04)
+        lng = CENTER[1] + rng.uniform(-0.04, 0.04)
+        # get_relevant_providers queries with [lat, lng], so points are stored
+        # in the same order
+        location = {
+            "street": f"{rng.randint(1, 999)} Broadway",
+            "city": "New York",
+            "state": "NY",
+            "zip_code": "10001",
+            "coordinates": {"type": "Point", "coordinates": [lat, lng]},
+        }
+        operations.append(
+            UpdateOne(
+                {"npi": provider["npi"]},
+                {
+                    "$set": {
+                        "first_name": provider["first_name"],
+                        "last_name": provider["last_name"],
+                        "email": None,
+                        "phone_number": None,
+                        "locations": [location],
+                        "specialties": [provider["specialty"]],
+                        "insurances": [{"id": insurance_id}],
+                    }
+                },
+                upsert=True,
+            )
+        )
+        providers.append(provider)
+
+    collection.create_index([("locations.coordinates", GEOSPHERE)])
+    collection.create_index("npi")
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    return providers
+
+
+def seed_history(
+    conn: connection,
+    rng: random.Random,
+    user_id: int,
+    providers: List[Dict[str, Any]],
+    n_appointments: int,
+) -> List[Dict[str, Any]]:
+    """Appointments with their prescriptions, as if they had been analyzed."""
+    visits = []
+    with conn.cursor() as cursor:
+        for i in range(n_appointments):
+            provider = rng.choice(providers)
+            visit = synthetic_visit(rng, provider)
+            visit["provider"] = provider
+            visit["filename"] = f"s3://{S3_BUCKET_NAME}/{user_id}/pdf/seed-{i}.pdf"
+            cursor.execute(
+                "INSERT INTO appointment (user_id, provider_id, filename, summary, "
+                "appointment_datetime, follow_ups, perscriptions) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s) "
+                "ON CONFLICT (user_id, provider_id, appointment_datetime) "
+                "DO UPDATE SET filename = EXCLUDED.filename RETURNING id",
+                (
+                    user_id,
+                    int(provider["npi"]),
+                    visit["filename"],
+                    visit["summary"],
+                    visit["appointment_datetime"],
+                    json.dumps({"tasks": visit["follow_ups"]}),
+                    json.dumps({"drugs": visit["drugs"]}),
+                ),
+            )
+            appointment_id = cursor.fetchone()[0]
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO prescriptions (user_id, appointment_id, brand_name, "
+                "technical_name, instructions, provider_id) VALUES %s "
+                "ON CONFLICT (user_id, appointment_id, brand_name) DO NOTHING",
+                [
+                    (
+                        user_id,
+                        appointment_id,
+                        drug["brand_name"],
+                        drug["technical_name"],
+                        drug["instructions"],
+                        int(provider["npi"]),
+                    )
+                    for drug in visit["drugs"]
+                ],
+            )
+            visits.append(visit)
+    conn.commit()
+    return visits
+
+
+def seed_documents(user_id: int, visits: List[Dict[str, Any]]) -> None:
+    """Store every visit note in s3 and index it in the vector db."""
+    s3_client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+    try:
+        s3_client.create_bucket(Bucket=S3_BUCKET_NAME)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "BucketAlreadyOwnedByYou":
+            raise
+
+    for visit in visits:
+        pages = paginate(visit["text"])
+        s3_client.upload_fileobj(
+            io.BytesIO(make_pdf(pages)),
+            S3_BUCKET_NAME,
+            visit["filename"].split(f"{S3_BUCKET_NAME}/", 1)[1],
+        )
+        provider = visit["provider"]
+        metadata = {
+            "user_id": user_id,
+            "provider_id": int(provider["npi"]),
+            "provider_name": f"{provider['first_name']} {provider['last_name']}",
+            "appointment_datetime": f"{visit['appointment_datetime']:%Y-%m-%d %H:%M}",
+            "filename": visit["filename"],
+        }
+        load_documents([Document(text=page) for page in pages], metadata)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed the load test backends.")
+    parser.add_argument("--providers", type=int, default=200)
+    parser.add_argument("--appointments", type=int, default=25)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rng = random.Random(args.seed)
+
+    conn = create_connection()
+    ids = seed_relational(conn)
+    logger.info(f"Seeded bench user {ids['user_id']}")
+
+    collection = MongoClient(MONGODB_URL)["wilson_ai"].providers
+    providers = seed_providers(collection, rng, args.providers, ids["insurance_id"])
+    logger.info(f"Seeded {len(providers)} providers")
+
+    visits = seed_history(conn, rng, ids["user_id"], providers, args.appointments)
+    seed_documents(ids["user_id"], visits)
+    logger.info(f"Seeded {len(visits)} appointments")
+    conn.close()
+
+    print(json.dumps({**ids, "email": BENCH_EMAIL, "password": BENCH_PASSWORD}))
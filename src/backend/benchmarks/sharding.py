@@ -0,0 +1,176 @@
+"""
+Filtered retrieval at scale against the number of shards the vector store is
+split into. For each user count and shard count, the chunks of every user are
+loaded into a fresh collection version and queried by concurrent threads, each
+query routed to the user's shard and filtered by user the way get_context
+does. Besides latency the run measures recall against exact search over the
+user's chunks, since filtered HNSW search loses accuracy as one index spans
+more users.
+
+Embeddings are random unit vectors, so the numbers are those of chroma rather
+than of the embedding API.
+
+Run with e.g.
+    python -m benchmarks.sharding --users 10000,100000 --shards 1,16,64
+    python -m benchmarks.sharding --users 100000 --shards 1,64 --mode http \\
+        --url http://localhost:8000
+"""
+
+import argparse
+import json
+import logging
+import random
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+
+from app.db.vector_db import CHROMADB_URL, VectorStore, shard_of
+
+from .load_test import PERCENTILES, percentile
+
+logger = logging.getLogger(__name__)
+
+
+def unit_vectors(rng: np.random.Generator, n: int, dimensions: int) -> np.ndarray:
+    vectors = rng.standard_normal((n, dimensions), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def run(
+    store: VectorStore,
+    n_users: int,
+    n_shards: int,
+    chunks_per_user: int,
+    dimensions: int,
+    batch_size: int,
+    n_queries: int,
+    concurrency: int,
+    k: int,
+) -> Dict[str, Any]:
+    name = store.create_version(shards=n_shards)
+    store.set_alias(name)
+    collections = store.collections(name)
+
+    rng = random.Random(0)
+    np_rng = np.random.default_rng(0)
+    query_users = [rng.randrange(n_users) for _ in range(n_queries)]
+    # the chunks of the queried users, for exact search
+    kept: Dict[int, List[tuple]] = defaultdict(list)
+    wanted = set(query_users)
+
+    n_chunks = n_users * chunks_per_user
+    start = time.perf_counter()
+    for first in range(0, n_chunks, batch_size):
+        chunk_ids = range(first, min(first + batch_size, n_chunks))
+        users = [i // chunks_per_user for i in chunk_ids]
+        vectors = unit_vectors(np_rng, len(chunk_ids), dimensions)
+        routed: Dict[int, List[int]] = defaultdict(list)
+        for row, user in enumerate(users):
+            routed[shard_of(user, n_shards)].append(row)
+            if user in wanted:
+                kept[user].append((f"chunk-{chunk_ids[row]}", vectors[row]))
+        for shard, rows in routed.items():
+            collections[shard].upsert(
+                ids=[f"chunk-{chunk_ids[row]}" for row in rows],
+                embeddings=vectors[rows].tolist(),
+                metadatas=[{"user_id": users[row]} for row in rows],
+            )
+    ingest_seconds = time.perf_counter() - start
+    logger.info(f"Loaded {n_chunks} chunks in {ingest_seconds:.1f}s")
+
+    query_vectors = unit_vectors(np_rng, n_queries, dimensions)
+
+    def query(i: int) -> tuple:
+        user = query_users[i]
+        start = time.perf_counter()
+        result = store.collection_for(user).query(
+            query_embeddings=[query_vectors[i].tolist()],
+            n_results=k,
+            where={"user_id": user},
+            include=["distances"],
+        )
+        latency = time.perf_counter() - start
+        ids = [id_ for id_, _ in kept[user]]
+        scores = np.stack([vector for _, vector in kept[user]]) @ query_vectors[i]
+        exact = {ids[j] for j in np.argsort(-scores)[:k]}
+        return latency, len(exact & set(result["ids"][0])) / len(exact)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies, recalls = zip(*pool.map(query, range(n_queries)))
+    query_seconds = time.perf_counter() - start
+
+    for collection in collections:
+        store.client.delete_collection(collection.name)
+    store.close()
+    result = {
+        "ingest_chunks_per_s": n_chunks / ingest_seconds,
+        "query_qps": n_queries / query_seconds,
+        f"recall_at_{k}": sum(recalls) / len(recalls),
+    }
+    for q in PERCENTILES:
+        result[f"query_p{q}_ms"] = percentile(latencies, q) * 1000
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vector store sharding.")
+    parser.add_argument("--users", default="10000,100000")
+    parser.add_argument("--shards", default="1,16,64")
+    parser.add_argument("--chunks-per-user", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("-k", type=int, default=5, help="chunks per query")
+    parser.add_argument("--mode", choices=["embedded", "http"], default="embedded")
+    parser.add_argument("--url", default=CHROMADB_URL or "http://localhost:8000")
+    parser.add_argument("--output", help="write the results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results = {}
+    for n_users in map(int, args.users.split(",")):
+        for n_shards in map(int, args.shards.split(",")):
+            with tempfile.TemporaryDirectory() as tmp:
+                alias = f"bench_shards_{int(time.time())}"
+                store = VectorStore(
+                    mode=args.mode,
+                    path=tmp,
+                    url=args.url,
+                    collection=alias,
+                    alias=alias,
+                )
+                logger.info(f"Benchmarking {n_users} users in {n_shards} shards")
+                results[f"{n_users}x{n_shards}"] = {
+                    "users": n_users,
+                    "shards": n_shards,
+                    **run(
+                        store,
+                        n_users,
+                        n_shards,
+                        args.chunks_per_user,
+                        args.dimensions,
+                        args.batch_size,
+                        args.queries,
+                        args.concurrency,
+                        args.k,
+                    ),
+                }
+
+    header = f"{'users':>8}{'shards':>8}{'ingest/s':>10}{'qps':>9}{'recall':>8}"
+    header += "".join(f"{f'p{q} ms':>10}" for q in PERCENTILES)
+    print(header)
+    for result in results.values():
+        row = f"{result['users']:>8}{result['shards']:>8}"
+        row += f"{result['ingest_chunks_per_s']:>10.0f}{result['query_qps']:>9.1f}"
+        row += f"{result[f'recall_at_{args.k}']:>8.3f}"
+        row += "".join(f"{result[f'query_p{q}_ms']:>10.1f}" for q in PERCENTILES)
+        print(row)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,146 @@
+"""
+Ingest and query throughput of the vector store with embedded and client /
+server chroma. Each mode gets a fresh collection, is loaded with batched
+upserts and then queried by concurrent threads filtered by user, the way
+chat_w_data queries it.
+
+Embeddings are random unit vectors by default so the numbers are those of
+chroma rather than of the embedding API, use --embeddings model to include it.
+
+Run with e.g.
+    python -m benchmarks.vector_store --documents 20000 --queries 2000 \\
+        --concurrency 8 --url http://localhost:8000
+"""
+
+import argparse
+import json
+import logging
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+
+from app.db.vector_db import CHROMADB_URL, VectorStore
+
+from .documents import FINDINGS
+from .generate import EMBEDDING_DIMENSIONS
+from .load_test import PERCENTILES, percentile
+
+logger = logging.getLogger(__name__)
+
+MODES = ("embedded", "http")
+
+
+def run_mode(
+    store: VectorStore,
+    texts: List[str],
+    metadatas: List[Dict[str, Any]],
+    embeddings: np.ndarray | None,
+    batch_size: int,
+    n_queries: int,
+    concurrency: int,
+    n_users: int,
+) -> Dict[str, Any]:
+    collection = store.collections()[0]
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        batch = slice(i, i + batch_size)
+        collection.upsert(
+            ids=[f"bench-{j}" for j in range(i, i + len(texts[batch]))],
+            documents=texts[batch],
+            metadatas=metadatas[batch],
+            embeddings=embeddings[batch].tolist() if embeddings is not None else None,
+        )
+    ingest_seconds = time.perf_counter() - start
+
+    rng = random.Random(0)
+    queries = [(rng.choice(FINDINGS), rng.randrange(n_users)) for _ in range(n_queries)]
+
+    def query(query: tuple) -> float:
+        text, user_id = query
+        start = time.perf_counter()
+        if embeddings is None:
+            collection.query(query_texts=[text], where={"user_id": user_id})
+        else:
+            vector = embeddings[rng.randrange(len(embeddings))].tolist()
+            collection.query(query_embeddings=[vector], where={"user_id": user_id})
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(query, queries))
+    query_seconds = time.perf_counter() - start
+
+    store.client.delete_collection(store.collection_name)
+    store.close()
+    result = {
+        "ingest_docs_per_s": len(texts) / ingest_seconds,
+        "query_qps": n_queries / query_seconds,
+    }
+    for q in PERCENTILES:
+        result[f"query_p{q}_ms"] = percentile(latencies, q) * 1000
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark chroma access modes.")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--url", default=CHROMADB_URL or "http://localhost:8000")
+    parser.add_argument("--path", help="embedded store, a temporary dir by default")
+    parser.add_argument("--embeddings", choices=["random", "model"], default="random")
+    parser.add_argument("--output", help="write the results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    rng = random.Random(0)
+    texts = [" ".join(rng.choices(FINDINGS, k=4)) for _ in range(args.documents)]
+    metadatas = [{"user_id": rng.randrange(args.users)} for _ in texts]
+    embeddings = None
+    if args.embeddings == "random":
+        vectors = np.random.default_rng(0).normal(
+            size=(args.documents, EMBEDDING_DIMENSIONS)
+        )
+        embeddings = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    results = {}
+    for mode in args.modes.split(","):
+        with tempfile.TemporaryDirectory() as tmp:
+            name = f"bench_{mode}_{int(time.time())}"
+            store = VectorStore(
+                mode=mode,
+                path=args.path or tmp,
+                url=args.url,
+                collection=name,
+                alias=name,
+            )
+            logger.info(f"Benchmarking {mode} chroma")
+            results[mode] = run_mode(
+                store,
+                texts,
+                metadatas,
+                embeddings,
+                args.batch_size,
+                args.queries,
+                args.concurrency,
+                args.users,
+            )
+
+    header = f"{'mode':<10}{'ingest docs/s':>15}{'query qps':>11}"
+    header += "".join(f"{f'p{q} ms':>10}" for q in PERCENTILES)
+    print(header)
+    for mode, result in results.items():
+        row = f"{mode:<10}{result['ingest_docs_per_s']:>15.0f}"
+        row += f"{result['query_qps']:>11.1f}"
+        row += "".join(f"{result[f'query_p{q}_ms']:>10.1f}" for q in PERCENTILES)
+        print(row)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)